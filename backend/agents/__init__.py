@@ -1,4 +1,5 @@
 from .commit_metadata_extractor import CommitMetadataExtractorNode
 from .code_change_analyzer import CodeChangeAnalyzerNode
 from .fix_suggester import FixSuggesterNode
-from .store_results import StoreResultsNode
\ No newline at end of file
+from .store_results import StoreResultsNode
+from .report_merger import ReportMergerNode
\ No newline at end of file
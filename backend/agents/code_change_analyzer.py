@@ -1,38 +1,18 @@
-from models.graph_state import GraphState
+from models.graph_state import GraphState, stream_writer
+import asyncio
+import logging
 import os
-from google import genai
+import re
+from typing import Optional
+from llm import LLMClient, LLMError, get_llm
+from diff_chunker import DiffChunk, DiffPiece, combine_fingerprints, pack_pieces, split_pieces
+from diff_compactor import compact_diff
+from result_store import ResultStore
+from telemetry import PROMPT_TOKENS_SAVED, log_content
 
-class CodeChangeAnalyzerNode:
-    def __init__(self):
-        self.client = genai.Client(api_key=os.environ["GOOGLE_API_KEY"])
-
-    def analyze_changes(self, state: GraphState) -> GraphState:
-        print("---ANALYZING CODE CHANGES---")
-        commit_metadata = state.get("commit_metadata")
-        if not commit_metadata:
-            raise ValueError("Commit metadata not found in state for analysis.")
-
-        diff = commit_metadata.get("diff")
-        if not diff:
-            print("Error: Diff not found in commit metadata.")
-            return state
-
-        # TODO: Fill in the prompt for Gemini API
-        prompt = f"""
-You are a senior software engineer and expert code assistant.  
-Your goal is to read the following git diff and produce an **in-depth, well-structured report** that helps developers understand exactly *what* changed, *why*, and *how* it fits into the repo history—without getting lost in the code.
+logger = logging.getLogger(__name__)
 
----
-## GOAL
-Analyze the diff and generate:
-1. A concise commit summary.
-2. Detailed breakdown of changes by file/module:
-   - What was added, removed, or modified.
-   - How these changes affect logic, APIs, or data structures.
-3. Context comparison:
-   - Reference previous behavior and highlight modifications to logic, interfaces, dependencies.
----
-## RETURN FORMAT (in Markdown)
+REPORT_FORMAT = """## RETURN FORMAT (in Markdown)
 ```markdown
 ### 1. Commit summary  
 *…*
@@ -57,16 +37,217 @@ Repeat for each changed file.
 * If uncertain, flag it as a **"potential"** issue.
 * Keep analysis tight, readable, and developer‑friendly.
 
+"""
+
+# Notes on every hunk ("piece") of a diff, stored by the hunk's fingerprint. A diff too large for one
+# prompt gets one pass per chunk of pieces...
+MAP_PROMPT = """
+You are a senior software engineer and expert code assistant.
+The following is part {part} of {parts} of a git diff, split into numbered pieces of one hunk each. Other parts are analyzed separately.
+
+Commit message: {commit_message}
+
+For each piece, write concise notes in exactly this format:
+#### Piece N: path/to/file.ext
+- **Change type**: added/removed/modified
+- **Details**:
+  - *what changed and how it affects logic, APIs, or data structures*
+
+Avoid hallucinating code not present in the diff. Do not write a commit summary.
+
+The code changes are:
+{diff}
+"""
+
+# ...and the notes, including those of hunks analyzed in earlier commits, are reduced into the usual report
+REDUCE_PROMPT = """
+You are a senior software engineer and expert code assistant.
+A commit was analyzed hunk by hunk. Combine the per-hunk notes below into one
+**in-depth, well-structured report** that helps developers understand exactly *what* changed, *why*, and *how* it fits into the repo history.
+
+Commit message: {commit_message}
+{skipped_note}
+""" + REPORT_FORMAT + """
+The per-hunk notes, by file, are:
+{notes}
+"""
+
+PIECE_HEADING_RE = re.compile(r"^#+\s*\**Piece\s+(\d+)")
+
+# Added to the prompts when a range of commits is analyzed as one change set
+RANGE_NOTE = """
+## COMMIT RANGE
+The diff is the net change of several commits, analyzed as one change set. Summarize the range as a whole,
+and in the file‑by‑file details name the commits (short hashes) that changed each file.
+"""
+
+class CodeChangeAnalyzerNode:
+    MODEL = os.environ.get("CTM_ANALYZER_MODEL", "gemini-2.5-flash")
+    # Bump whenever the prompt changes so cached results are not reused
+    PROMPT_VERSION = "5"
+
+    def __init__(self, store: Optional[ResultStore] = None, llm: Optional[LLMClient] = None):
+        self.llm = llm or get_llm()
+        # Output is also stored by patch fingerprint, so a cherry-picked, rebased
+        # or forked change (new SHA, same patch) is not sent to the model again
+        self.store = store
+
+    async def analyze_changes(self, state: GraphState) -> dict:
+        logger.debug("---ANALYZING CODE CHANGES---")
+        commit_metadata = state.get("commit_metadata")
+        if not commit_metadata:
+            raise ValueError("Commit metadata not found in state for analysis.")
+
+        diff = commit_metadata.get("diff")
+        if not diff:
+            logger.error("Diff not found in commit metadata.")
+            return {}
+
+        # Whitespace-only edits, moved blocks, renames and noise files are folded before anything is sent.
+        # That is CPU work on diffs of any size, so it runs off the event loop
+        files, skipped, compaction = await asyncio.to_thread(compact_diff, diff, state.get("token_budget"))
+        PROMPT_TOKENS_SAVED.inc(compaction.saved_tokens, node="code_analyzer")
+        skipped_note = f"Skipped generated, vendored and lock files: {', '.join(skipped)}" if skipped else ""
+        pieces = split_pieces(files)
+        extra = [f"skipped:{path}" for path in skipped]
+        # A range report names its commits, so it is only reused for the same net patch made by the same commits
+        is_range = "commits" in commit_metadata
+        kind = "range" if is_range else "commit"
+        if is_range:
+            extra.append(f"range:{commit_metadata.get('message')}")
+        fingerprint = combine_fingerprints([piece.fingerprint for piece in pieces] + extra)
+        # LLM failures (LLMError) propagate, so the request fails instead of storing an error text
+        analysis = (await self._load_patch_analyses(kind, [fingerprint])).get(fingerprint)
+        if analysis:
+            logger.info("♻️ Same patch was analyzed before (cherry-pick, rebase or fork), reusing its analysis")
+            stream_writer()({"field": "analysis", "text": analysis})
+        else:
+            # Hunk notes don't depend on the commits, so they are shared between commits and ranges
+            commit_message = commit_metadata.get("message") or "N/A"
+            reused = await self._load_patch_analyses("unit", [piece.fingerprint for piece in pieces])
+            chunks = pack_pieces([piece for piece in pieces if piece.fingerprint not in reused])
+            if not reused and len(chunks) <= 1:
+                # Nothing to reuse and small enough for one prompt: the report is written from the diff directly,
+                # while the hunk notes later commits can reuse are generated alongside it
+                chunk_text = chunks[0].text if chunks else "(only generated, vendored or lock files changed)"
+                range_note = f"{RANGE_NOTE}\n{commit_metadata['message']}\n" if is_range else ""
+                analysis, _ = await asyncio.gather(
+                    self._generate(self._single_prompt(chunk_text, skipped_note, range_note), stream=True),
+                    self._store_notes(chunks, commit_message),
+                )
+            else:
+                note = skipped_note + (RANGE_NOTE if is_range else "")
+                analysis = await self._map_reduce(pieces, reused, chunks, commit_message, note)
+            await self._save_patch_analyses(kind, {fingerprint: analysis})
+
+        log_content(logger, "Generated analysis", analysis)
+        return {"analysis": analysis, "prompt_tokens": {"code_analyzer": compaction.to_dict()}}
+
+    def _single_prompt(self, diff: str, skipped_note: str, range_note: str = "") -> str:
+        return f"""
+You are a senior software engineer and expert code assistant.  
+Your goal is to read the following git diff and produce an **in-depth, well-structured report** that helps developers understand exactly *what* changed, *why*, and *how* it fits into the repo history—without getting lost in the code.
+
+---
+## GOAL
+Analyze the diff and generate:
+1. A concise commit summary.
+2. Detailed breakdown of changes by file/module:
+   - What was added, removed, or modified.
+   - How these changes affect logic, APIs, or data structures.
+3. Context comparison:
+   - Reference previous behavior and highlight modifications to logic, interfaces, dependencies.
+---
+{REPORT_FORMAT}{skipped_note}{range_note}
 The code changes are:
 {diff}
         """
+
+    async def _map_reduce(self, pieces: list[DiffPiece], reused: dict[str, str], chunks: list[DiffChunk],
+                          commit_message: str, skipped_note: str) -> str:
+        """The report from notes on every hunk; `chunks` hold the hunks without notes in `reused`"""
+        logger.info("Analyzing the diff hunk by hunk: %d chunks concurrently, %d of %d hunks analyzed before",
+                    len(chunks), sum(piece.fingerprint in reused for piece in pieces), len(pieces))
+        notes, unsplit = await generate_notes(self.llm, self.MODEL, chunks, commit_message)
+        await self._save_patch_analyses("unit", notes)
+        joined = join_notes(pieces, {**reused, **notes}, unsplit)
+        return await self._generate(REDUCE_PROMPT.format(commit_message=commit_message, skipped_note=skipped_note, notes=joined), stream=True)
+
+    async def _store_notes(self, chunks: list[DiffChunk], commit_message: str):
+        """Generate and store hunk notes for later reuse; if that fails, only the reuse is lost"""
         try:
-            response = self.client.models.generate_content(model="gemini-2.5-flash", contents=prompt)
-            analysis = response.text
-        except Exception as e:
-            print(f"Error generating analysis with Gemini: {e}")
-            analysis = "Error generating analysis."
-
-        state["analysis"] = analysis
-        print(f"Generated analysis: {analysis}")
-        return state
\ No newline at end of file
+            notes, _ = await generate_notes(self.llm, self.MODEL, chunks, commit_message)
+        except LLMError as e:
+            logger.warning("Could not generate hunk notes, they are not stored: %s", e)
+            return
+        await self._save_patch_analyses("unit", notes)
+
+    async def _load_patch_analyses(self, kind: str, fingerprints: list[str]) -> dict[str, str]:
+        if self.store is None:
+            return {}
+        return await asyncio.to_thread(self.store.get_patch_analyses, kind, fingerprints, self.llm.cache_model(self.MODEL), self.PROMPT_VERSION)
+
+    async def _save_patch_analyses(self, kind: str, texts: dict[str, str]):
+        if self.store is not None and texts:
+            await asyncio.to_thread(self.store.save_patch_analyses, kind, self.llm.cache_model(self.MODEL), self.PROMPT_VERSION, texts)
+
+    async def _generate(self, prompt: str, stream: bool = False) -> str:
+        """Generate a completion; with stream=True tokens are also sent to the graph's custom stream"""
+        on_token = None
+        if stream:
+            writer = stream_writer()
+            on_token = lambda text: writer({"field": "analysis", "text": text})
+        return await self.llm.generate(prompt, self.MODEL, on_token)
+
+
+async def generate_notes(llm: LLMClient, model: str, chunks: list[DiffChunk], commit_message: str) -> tuple[dict[str, str], list[str]]:
+    """
+    Map notes on each chunk, concurrently, split per piece
+
+    Returns:
+        tuple: (notes by piece fingerprint, whole notes of the chunks that could not be split per piece)
+    """
+    chunk_notes = await asyncio.gather(*[
+        llm.generate(MAP_PROMPT.format(part=i + 1, parts=len(chunks), commit_message=commit_message, diff=chunk.labeled_text), model)
+        for i, chunk in enumerate(chunks)
+    ])
+    notes: dict[str, str] = {}
+    unsplit = []
+    for chunk, text in zip(chunks, chunk_notes):
+        split = split_notes(chunk, text)
+        notes.update(split)
+        if not split:
+            unsplit.append(text)
+    return notes, unsplit
+
+
+def split_notes(chunk: DiffChunk, notes: str) -> dict[str, str]:
+    """Split the map notes of a chunk per piece, keyed by the piece's fingerprint
+
+    If the section of any piece is missing the notes are not split at all;
+    they are used whole for this analysis and the pieces are analyzed again
+    next time.
+    """
+    sections: dict[int, str] = {}
+    number = None
+    for line in notes.splitlines(keepends=True):
+        match = PIECE_HEADING_RE.match(line)
+        if match:
+            number = int(match[1])
+            sections[number] = ""
+        elif number is not None:
+            sections[number] += line
+    if not all(sections.get(i + 1, "").strip() for i in range(len(chunk.pieces))):
+        return {}
+    return {piece.fingerprint: sections[i + 1].strip() for i, piece in enumerate(chunk.pieces)}
+
+
+def join_notes(pieces: list[DiffPiece], notes: dict[str, str], unsplit: list[str]) -> str:
+    """Notes of the pieces in diff order under their file's name, then the notes that could not be split"""
+    sections = []
+    path = None
+    for piece in pieces:
+        if piece.fingerprint in notes:
+            sections.append((f"#### File: {piece.path}\n" if piece.path != path else "") + notes[piece.fingerprint])
+            path = piece.path
+    return "\n\n".join(sections + unsplit)
@@ -1,68 +1,171 @@
 from models.graph_state import GraphState, CommitMetadata
 from function_utils import *
+from concurrency import run_git
+from diff_reader import read_commit_diff, read_range_commits
 import git
 from datetime import datetime
 import os
+import asyncio
+import logging
+from typing import Optional
+from repo_pool import RepoPool
+from result_store import ResultStore
+from telemetry import log_content
+
+logger = logging.getLogger(__name__)
 
 class CommitMetadataExtractorNode:
-    def __init__(self, repo: git.Repo):
-        try:
-            self.repo = repo
-        except git.InvalidGitRepositoryError:
-            print(f"Error: Not a valid Git repository at {self.repo_path}")
-            self.repo = None
-        except Exception as e:
-            print(f"Error initializing GitPython Repo: {e}")
-            self.repo = None
+    def __init__(self, repo: Optional[git.Repo] = None, store: Optional[ResultStore] = None, pool: Optional[RepoPool] = None):
+        # Without a repo here, every run passes the one to read (the pipeline shares one node across repos)
+        self.repo = repo
+        # Metadata stored earlier (by the background indexer or a previous analysis)
+        # is read from here instead of running git again
+        self.store = store
+        # Objects missing from shallow and partial mirrors are fetched through the pool, which keeps
+        # fetches into one mirror from overlapping; without one (scripts) they are fetched inline
+        self.pool = pool
 
-    def extract_metadata(self, state: GraphState) -> GraphState:
-        print("---EXTRACTING COMMIT METADATA---")
-        if not self.repo:
+    async def extract_metadata(self, state: GraphState, config: Optional[dict] = None) -> dict:
+        """Graph node; the repo is taken from config["configurable"]["repo"] if given, else the node's own"""
+        repo = (config or {}).get("configurable", {}).get("repo") or self.repo
+        commit_hash = state.get("commit_hash")
+        if self.store and state.get("repo_url") and is_full_commit_hash(commit_hash):
+            stored = await asyncio.to_thread(self.store.get_commit, state["repo_url"], commit_hash)
+            if stored:
+                logger.info("⚡ Metadata of %s was indexed before, skipping git", commit_hash)
+                return {"commit_metadata": stored}
+        if commit_hash and state.get("repo_url"):
+            await self.fetch_objects(state["repo_url"], repo or self.repo, [commit_hash])
+        # GitPython and the git subprocesses block, so keep them off the event loop
+        return await run_git(self._extract_metadata, state, repo)
+
+    async def fetch_objects(self, repo_url: str, repo: git.Repo, commit_hashes: list[str]):
+        """Fetch what the diffs of these commits (or "base..head" ranges) need from a shallow or partial mirror"""
+        if self.pool is None or not await run_git(needs_object_fetches, repo):
+            return
+        for commit_hash in commit_hashes:
+            commit_range = split_range_key(commit_hash)
+            args = (commit_range[1], commit_range[0]) if commit_range else (commit_hash,)
+            try:
+                await asyncio.wrap_future(self.pool.fetch_objects(repo_url, fetch_diff_objects, *args))
+            except git.GitCommandError as e:
+                # Reported by the extraction, which runs into the same missing objects
+                logger.warning("Fetching the objects of %s failed: %s", commit_hash, e)
+
+    def _extract_metadata(self, state: GraphState, repo: Optional[git.Repo] = None) -> dict:
+        logger.debug("---EXTRACTING COMMIT METADATA---")
+        repo = repo or self.repo
+        if not repo:
             raise RuntimeError("Git repository not initialized properly.")
 
         commit_hash = state.get("commit_hash")
         if not commit_hash:
             raise ValueError("Commit hash not found in state")
+        commit_range = split_range_key(commit_hash)
+        if commit_range:
+            return self._extract_range_metadata(repo, *commit_range)
 
         try:
-            commit = self.repo.commit(commit_hash)
-            author_name = commit.author.name
-            # Convert commit.authored_datetime to ISO 8601 string format
-            commit_date = commit.authored_datetime.isoformat()
-            commit_message = commit.message.strip()
-            files_changed = list(commit.stats.files.keys())
+            # Shallow clones cut history at a boundary and partial clones lack blobs; fetch the
+            # parent so the diff isn't taken against an empty tree, and the diff's blobs in one batch
+            if self.pool is None:
+                fetch_diff_objects(repo, commit_hash)
+            commit = repo.commit(commit_hash)
 
             # For the initial commit, there's no parent, so diff against an empty tree
             if not commit.parents:
-                EMPTY_TREE_SHA1 = "4b825dc642cb6eb9a060e54bf8d69288fbee4904"
-                parent_commit = self.repo.tree(EMPTY_TREE_SHA1)
+                parent_commit = repo.tree(EMPTY_TREE_SHA1)
             else:
                 parent_commit = commit.parents[0]
-            
-            diff_output = self.repo.git.diff(parent_commit.hexsha, commit.hexsha, unified=3)
+
+            author_name = commit.author.name
+            # Convert commit.authored_datetime to ISO 8601 string format
+            commit_date = commit.authored_datetime.isoformat()
+            commit_message = commit.message.strip()
+
+            # File list, numstat and patch come from one git process, within a byte budget
+            commit_diff = read_commit_diff(repo, parent_commit.hexsha, commit.hexsha)
+            if commit_diff.truncated:
+                logger.warning("Diff of %s was truncated to fit the byte budget", commit_hash)
 
             extracted_metadata = CommitMetadata(
                 hash=commit_hash,
                 author=author_name,
                 date=commit_date,
                 message=commit_message,
-                diff=diff_output,
-                files_changed=files_changed
+                diff=commit_diff.patch,
+                files_changed=commit_diff.files,
+                file_stats=commit_diff.stats,
             )
 
-            state["commit_metadata"] = extracted_metadata
-            print(f"Extracted metadata for commit: {commit_hash}")
-            print(f"  Author: {author_name}")
-            print(f"  Date: {commit_date}")
-            # print(f"  Message: {commit_message}") # Can be long
-            # print(f"  Diff: {diff_output}") # Can be very long
+            update = {"commit_metadata": extracted_metadata}
+            logger.info("Extracted metadata for commit %s (%s, %s, %d files)", commit_hash, author_name, commit_date, len(commit_diff.files))
+            log_content(logger, "Commit message", commit_message)
+            log_content(logger, "Diff", commit_diff.patch)
 
         except git.exc.GitCommandError as e:
-            print(f"Git command error: {e}")
+            logger.error("Git command error: %s", e)
             # Populate with error or empty data, or raise
-            state["commit_metadata"] = CommitMetadata(author="Error", date="Error", message=f"Error: {e}", diff="Error")
+            update = {"commit_metadata": CommitMetadata(author="Error", date="Error", message=f"Error: {e}", diff="Error")}
         except Exception as e:
-            print(f"An unexpected error occurred: {e}")
-            state["commit_metadata"] = CommitMetadata(author="Error", date="Error", message=f"Error: {e}", diff="Error")
+            logger.exception("An unexpected error occurred: %s", e)
+            update = {"commit_metadata": CommitMetadata(author="Error", date="Error", message=f"Error: {e}", diff="Error")}
         
-        return state
\ No newline at end of file
+        return update
+
+    def _extract_range_metadata(self, repo: git.Repo, base: str, head: str) -> dict:
+        """Net diff of base..head as one change set, with the commits that made up each file's change"""
+        commit_hash = f"{base}..{head}"
+        try:
+            if self.pool is None:
+                fetch_diff_objects(repo, head, base)
+            commits, total = read_range_commits(repo, base, head)
+            # Files changed several times in the range appear once, with their net change
+            commit_diff = read_commit_diff(repo, base, head)
+            if commit_diff.truncated:
+                logger.warning("Diff of %s was truncated to fit the byte budget", commit_hash)
+            head_commit = repo.commit(head)
+
+            extracted_metadata = CommitMetadata(
+                hash=commit_hash,
+                author=", ".join(dict.fromkeys(c["author"] for c in commits)),
+                date=head_commit.authored_datetime.isoformat(),
+                message=range_message(base, head, commits, total, commit_diff.files),
+                diff=commit_diff.patch,
+                files_changed=commit_diff.files,
+                file_stats=commit_diff.stats,
+                commits=commits,
+            )
+            update = {"commit_metadata": extracted_metadata}
+            logger.info("Extracted metadata for range %s (%d commits, %d files)", commit_hash, total, len(commit_diff.files))
+            log_content(logger, "Range", extracted_metadata["message"])
+            log_content(logger, "Diff", commit_diff.patch)
+        except git.exc.GitCommandError as e:
+            logger.error("Git command error: %s", e)
+            update = {"commit_metadata": CommitMetadata(author="Error", date="Error", message=f"Error: {e}", diff="Error")}
+        return update
+
+
+def range_message(base: str, head: str, commits: list[dict], total: int, files_changed: list[str]) -> str:
+    """
+    Describe a range for the prompts: its commits, then which of them touched each changed file
+
+    Files touched in the range without a net change (changed, then reverted) are
+    listed too, so the report can mention them.
+    """
+    lines = [f"Combined change of {total} commits ({base[:10]}..{head[:10]}):"]
+    if total > len(commits):
+        lines.append(f"- ... {total - len(commits)} older commits not listed")
+    lines += [f"- {c['hash'][:10]} {c['author']}: {c['message']}" for c in commits]
+
+    touched: dict[str, list[str]] = {}
+    for c in commits:
+        for path in c["files"]:
+            touched.setdefault(path, []).append(c["hash"][:10])
+    lines += ["", "Commits per file:"]
+    for path in files_changed:
+        lines.append(f"- {path}: {', '.join(touched.get(path, [])) or 'not listed'}")
+    changed = set(files_changed)
+    for path in [p for p in touched if p not in changed]:
+        lines.append(f"- {path}: {', '.join(touched[path])} (no net change)")
+    return "\n".join(lines)
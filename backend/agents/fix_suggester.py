@@ -1,28 +1,66 @@
-from models.graph_state import GraphState
+from models.graph_state import GraphState, stream_writer
 import os
-from google import genai
+import asyncio
+import logging
+from typing import Optional
+from llm import LLMClient, get_llm
+from diff_chunker import chunk_files
+from diff_compactor import compact_diff
+from telemetry import PROMPT_TOKENS_SAVED, log_content
+
+logger = logging.getLogger(__name__)
 
 class FixSuggesterNode:
-    def __init__(self):
-        self.client = genai.Client(api_key=os.environ["GOOGLE_API_KEY"])
+    MODEL = os.environ.get("CTM_FIX_MODEL", "gemini-2.0-flash")
+    # Bump whenever the prompt changes so cached results are not reused
+    PROMPT_VERSION = "3"
+
+    def __init__(self, llm: Optional[LLMClient] = None):
+        self.llm = llm or get_llm()
 
-    def suggest_fix(self, state: GraphState) -> GraphState:
-        print("---SUGGESTING FIXES---")
+    async def suggest_fix(self, state: GraphState) -> dict:
+        logger.debug("---SUGGESTING FIXES---")
         analysis = state.get("analysis")
         diff = state.get("commit_metadata", {}).get("diff") # Safely get diff
         commit_message = state.get("commit_metadata", {}).get("message") # Safely get commit message
         user_query = state.get("user_query")
+        # In parallel mode the analysis is produced alongside us, so work from the diff alone
+        parallel = state.get("pipeline_mode") == "parallel"
 
-        if not analysis:
+        if not analysis and not parallel:
             raise ValueError("Analysis not found in state for fix suggestion.")
         if not diff:
-            print("Warning: Diff not found in state for fix suggestion.")
+            logger.warning("Diff not found in state for fix suggestion.")
         if not commit_message:
-            print("Warning: Commit message not found in state for fix suggestion.")
+            logger.warning("Commit message not found in state for fix suggestion.")
+
+        # Lock, generated and vendored files are dropped and the diff compacted; large diffs are split into chunks
+        files, _, compaction = await asyncio.to_thread(compact_diff, diff, state.get("token_budget")) if diff else ([], [], None)
+        chunks = chunk_files(files)
+        # The diff is sent anyway, so the file-by-file part of the analysis would only repeat it
+        summary = "" if parallel else summary_section(analysis)
+        analysis_section = f"Summary of the whole commit: {summary}\n" if summary else ""
+        if len(chunks) <= 1:
+            chunk_text = chunks[0].text if chunks else diff and "(only generated, vendored or lock files changed)"
+            fix_suggestion = await self._generate(self._prompt(analysis_section, chunk_text, commit_message, user_query), stream=True)
+        else:
+            logger.info("Diff too large for one prompt, reviewing %d chunks concurrently", len(chunks))
+            suggestions = await asyncio.gather(*[
+                self._generate(self._prompt(analysis_section, chunk.text, commit_message, user_query))
+                for chunk in chunks
+            ])
+            fix_suggestion = combine_chunk_suggestions(chunks, suggestions)
+            stream_writer()({"field": "fix_suggestion", "text": fix_suggestion})
 
-        prompt = f"""Based on the following information:
-Analysis of changes: {analysis}
-Code diff: {diff if diff else 'N/A'}
+        log_content(logger, "Generated fix suggestion", fix_suggestion)
+        if compaction is None:
+            return {"fix_suggestion": fix_suggestion}
+        PROMPT_TOKENS_SAVED.inc(compaction.saved_tokens, node="fix_suggester")
+        return {"fix_suggestion": fix_suggestion, "prompt_tokens": {"fix_suggester": compaction.to_dict()}}
+
+    def _prompt(self, analysis_section: str, diff, commit_message, user_query) -> str:
+        return f"""Based on the following information:
+{analysis_section}Code diff: {diff if diff else 'N/A'}
 Commit message: {commit_message if commit_message else 'N/A'}
 User query: {user_query if user_query else 'N/A'}
 
@@ -33,14 +71,29 @@ User query: {user_query if user_query else 'N/A'}
 
 If there are no issues or suggestions, just say "No issues found."
 """
-        
-        try:
-            response = self.client.models.generate_content(model="gemini-2.0-flash", contents=prompt)
-            fix_suggestion = response.text
-        except Exception as e:
-            print(f"Error generating fix suggestion with Gemini: {e}")
-            fix_suggestion = "Error generating fix suggestion."
-
-        state["fix_suggestion"] = fix_suggestion
-        print(f"Generated fix suggestion: {fix_suggestion}")
-        return state
\ No newline at end of file
+
+    async def _generate(self, prompt: str, stream: bool = False) -> str:
+        """Generate a completion; with stream=True tokens are also sent to the graph's custom stream"""
+        on_token = None
+        if stream:
+            writer = stream_writer()
+            on_token = lambda text: writer({"field": "fix_suggestion", "text": text})
+        return await self.llm.generate(prompt, self.MODEL, on_token)
+
+
+def summary_section(analysis: str) -> str:
+    """The "### 1. Commit summary" section of an analysis report (or its start if the format differs)"""
+    start = analysis.find("### 1.")
+    end = analysis.find("### 2.", start + 1)
+    if start == -1:
+        return analysis[:2000]
+    return analysis[start:end if end != -1 else start + 2000].strip()
+
+
+def combine_chunk_suggestions(chunks, suggestions: list[str]) -> str:
+    sections = [
+        f"#### {', '.join(chunk.files)}\n{suggestion.strip()}"
+        for chunk, suggestion in zip(chunks, suggestions)
+        if "no issues found" not in suggestion.strip().lower()[:40]
+    ]
+    return "\n\n".join(sections) if sections else "No issues found."
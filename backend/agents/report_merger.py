@@ -0,0 +1,55 @@
+from models.graph_state import GraphState
+import os
+import logging
+from typing import Optional
+from llm import LLMClient, LLMError, get_llm
+from telemetry import log_content
+
+logger = logging.getLogger(__name__)
+
+class ReportMergerNode:
+    """Optional last step of the parallel pipeline
+
+    The fix suggestions were written without seeing the analysis, so this pass
+    reconciles the two: it drops suggestions the analysis contradicts and
+    removes duplicates, keeping the fix suggestion format.
+    """
+    MODEL = os.environ.get("CTM_MERGE_MODEL", "gemini-2.0-flash")
+    # Bump whenever the prompt changes so cached results are not reused
+    PROMPT_VERSION = "1"
+
+    def __init__(self, llm: Optional[LLMClient] = None):
+        self.llm = llm or get_llm()
+
+    async def merge_reports(self, state: GraphState) -> dict:
+        logger.debug("---MERGING ANALYSIS AND FIX SUGGESTIONS---")
+        analysis = state.get("analysis")
+        fix_suggestion = state.get("fix_suggestion")
+
+        if not analysis or not fix_suggestion:
+            logger.warning("Nothing to merge, keeping fix suggestions as they are.")
+            return {}
+
+        prompt = f"""You are reviewing fix suggestions that were written from a git diff without the full change analysis.
+
+Analysis of changes: {analysis}
+
+Fix suggestions: {fix_suggestion}
+
+## TASKS:
+- Remove suggestions that the analysis shows to be incorrect or already handled.
+- Merge duplicate suggestions.
+- Keep everything else unchanged, in the same Markdown format.
+
+If no suggestions remain, just say "No issues found."
+"""
+
+        try:
+            merged = await self.llm.generate(prompt, self.MODEL)
+        except LLMError as e:
+            # The unmerged suggestions are still useful, so keep them
+            logger.error("Error merging fix suggestions: %s", e)
+            return {}
+
+        log_content(logger, "Merged fix suggestion", merged)
+        return {"fix_suggestion": merged}
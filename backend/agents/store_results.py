@@ -1,58 +1,49 @@
-import sqlite3
+import asyncio
+import logging
+from typing import Optional
+
+from diff_compactor import budget_version
+from embedder import Embedder
+from llm import LLMError
 from models.graph_state import GraphState
-import os
+from result_cache import ResultCache
+
+logger = logging.getLogger(__name__)
+
+
+def is_cacheable(state: dict) -> bool:
+    """Never store incomplete runs, so the next request retries them"""
+    return bool(state.get("analysis")) and bool(state.get("fix_suggestion"))
+
 
 class StoreResultsNode:
-    def __init__(self, db_path: str = "results.db"):
-        self.db_path = db_path
-        # Create the table once during initialization
-        self._ensure_table_exists()
-
-    def _ensure_table_exists(self):
-        """Create the table and index if they don't exist"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS results (
-                commit_hash TEXT PRIMARY KEY,
-                commit_metadata TEXT,
-                analysis TEXT
-            )
-        """)
-        conn.commit()
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_commit_hash ON results (commit_hash)")
-        conn.commit()
-        conn.close()
+    def __init__(self, cache: ResultCache, model: str, prompt_version: str, embedder: Optional[Embedder] = None):
+        self.cache = cache
+        self.model = model
+        # The graph's prompt version; a run's non-default token budget is added to it when storing
+        self.prompt_version = prompt_version
+        self.embedder = embedder
+
+    async def store_results(self, state: GraphState) -> dict:
+        if not is_cacheable(state):
+            logger.warning("Not storing results for commit %s: the analysis is incomplete", state["commit_hash"])
+            return {}
 
-    def store_results(self, state: GraphState) -> GraphState:
         try:
-            # Create a new connection for this operation
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-
-            # Extract values from state
-            commit_hash = state["commit_hash"]
-            commit_metadata = str(state["commit_metadata"])  # Convert to string for storage
-            analysis = state["analysis"]
-
-            # Store the results in the database
-            cursor.execute("""
-                INSERT OR REPLACE INTO results (commit_hash, commit_metadata, analysis)
-                VALUES (?, ?, ?)
-            """, (commit_hash, commit_metadata, analysis))
-            conn.commit()
-
-            print(f"Stored results for commit {commit_hash}")
-            
+            await asyncio.to_thread(
+                self.cache.put, state["repo_url"], state["commit_hash"], self.model,
+                self.prompt_version + budget_version(state.get("token_budget")),
+                state["commit_metadata"], state.get("analysis"), state.get("fix_suggestion"),
+            )
+            logger.info("Stored results for commit %s", state["commit_hash"])
         except Exception as e:
-            print(f"Error storing results: {e}")
+            logger.error("Error storing results: %s", e)
             raise e
-        finally:
-            # Always close the connection
-            if 'conn' in locals():
-                conn.close()
-
-        return state
-
 
-        
\ No newline at end of file
+        if self.embedder is not None:
+            # Embeds this result together with any others still waiting for a vector
+            try:
+                await self.embedder.index_pending()
+            except LLMError as e:
+                logger.warning("Could not embed stored results for search, retrying with the next ones: %s", e)
+        return {}
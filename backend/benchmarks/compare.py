@@ -0,0 +1,59 @@
+"""
+Compare two benchmark result files and flag stages that got slower
+
+Run from backend/:
+    python -m benchmarks.compare before.json after.json --threshold 0.2
+
+Exits with status 1 if any stage regressed by more than the threshold.
+"""
+import argparse
+import json
+import sys
+
+# Differences below this many seconds are noise, whatever the ratio
+MIN_DELTA_SECONDS = 0.005
+
+
+def load(path: str) -> dict[tuple, dict]:
+    with open(path) as f:
+        report = json.load(f)
+    return {(row["profile"], row["stage"], row["commit"] or ""): row for row in report["results"]}
+
+
+def compare(before: dict[tuple, dict], after: dict[tuple, dict], threshold: float) -> list[tuple]:
+    """
+    Pair up the rows of two runs
+
+    Returns:
+        list: (key, seconds before, seconds after, relative change, regressed) per stage present in both runs
+    """
+    rows = []
+    for key in before:
+        if key not in after:
+            continue
+        old, new = before[key]["seconds"], after[key]["seconds"]
+        change = (new - old) / old if old else 0.0
+        regressed = change > threshold and new - old > MIN_DELTA_SECONDS
+        rows.append((key, old, new, change, regressed))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("before")
+    parser.add_argument("after")
+    parser.add_argument("--threshold", type=float, default=0.2, help="relative slowdown that counts as a regression")
+    args = parser.parse_args()
+
+    rows = compare(load(args.before), load(args.after), args.threshold)
+    for (profile, stage, commit), old, new, change, regressed in rows:
+        flag = "  REGRESSION" if regressed else ""
+        print(f"{profile:<10} {stage:<28} {commit:<10} {old:>9.4f}s -> {new:>9.4f}s  {change:>+7.1%}{flag}")
+
+    regressions = sum(1 for row in rows if row[4])
+    print(f"\n{len(rows)} stages compared, {regressions} regressed by more than {args.threshold:.0%}")
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
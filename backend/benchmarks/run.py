@@ -0,0 +1,282 @@
+"""
+Benchmark the analysis pipeline and the API end to end, on synthetic repos with a stubbed LLM
+
+Run from backend/:
+    python -m benchmarks.run --profiles tiny,small --output before.json
+    python -m benchmarks.compare before.json after.json
+"""
+import argparse
+import asyncio
+import inspect
+import json
+import os
+import platform
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from benchmarks.synthetic_repos import PROFILES, build_repo
+
+
+class PeakRss:
+    """Peak resident set size of the process while a stage runs
+
+    Sampled from /proc on Linux; elsewhere the process-wide ru_maxrss is used,
+    which only ever grows.
+    """
+
+    INTERVAL = 0.005
+
+    def __init__(self):
+        self.peak_bytes = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    @staticmethod
+    def current_bytes() -> int:
+        try:
+            with open("/proc/self/statm") as f:
+                return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except OSError:
+            usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            return usage if sys.platform == "darwin" else usage * 1024
+
+    def _sample(self):
+        while not self._stop.wait(self.INTERVAL):
+            self.peak_bytes = max(self.peak_bytes, self.current_bytes())
+
+    def __enter__(self):
+        self.peak_bytes = self.current_bytes()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak_bytes = max(self.peak_bytes, self.current_bytes())
+
+    @property
+    def peak_mb(self) -> float:
+        return round(self.peak_bytes / (1024 * 1024), 1)
+
+
+class LLMRecorder:
+    """Counts calls, prompt sizes and time spent waiting on the (fake) LLM"""
+
+    def __init__(self, client):
+        from diff_chunker import estimate_tokens
+        self.reset()
+        generate = client.generate
+
+        async def recorded(prompt, model, on_token=None):
+            start = time.perf_counter()
+            try:
+                return await generate(prompt, model, on_token)
+            finally:
+                self.calls += 1
+                self.prompt_chars += len(prompt)
+                self.prompt_tokens += estimate_tokens(prompt)
+                self.wait_seconds += time.perf_counter() - start
+
+        client.generate = recorded
+
+    def reset(self):
+        self.calls = 0
+        self.prompt_chars = 0
+        self.prompt_tokens = 0
+        self.wait_seconds = 0.0
+
+    def snapshot(self) -> dict:
+        return {
+            "llm_calls": self.calls,
+            "prompt_chars": self.prompt_chars,
+            "prompt_tokens_est": self.prompt_tokens,
+            "llm_wait_seconds": round(self.wait_seconds, 4),
+        }
+
+
+class Bench:
+    def __init__(self, repeat: int):
+        self.repeat = repeat
+        self.results: list[dict] = []
+
+    async def measure(self, profile: str, stage: str, fn, commit: str = None, repeat: int = 1) -> tuple[dict, object]:
+        """Time `fn` (sync or async) `repeat` times and record one result row with the median"""
+        times = []
+        value = None
+        with PeakRss() as rss:
+            for _ in range(repeat):
+                start = time.perf_counter()
+                value = fn()
+                if inspect.isawaitable(value):
+                    value = await value
+                times.append(time.perf_counter() - start)
+        row = {
+            "profile": profile,
+            "stage": stage,
+            "commit": commit,
+            "seconds": round(statistics.median(times), 5),
+            "min_seconds": round(min(times), 5),
+            "runs": repeat,
+            "peak_rss_mb": rss.peak_mb,
+        }
+        self.results.append(row)
+        print(f"  {stage:<28} {commit or '':<10} {row['seconds']:>9.4f}s  {rss.peak_mb:>8.1f} MB", file=sys.stderr)
+        return row, value
+
+
+async def bench_profile(bench: Bench, profile_name: str, repos_root: str, mode: str, recorder: LLMRecorder):
+    import main
+    from agents import CommitMetadataExtractorNode
+    from models.graph_state import GraphState
+    import httpx
+
+    profile = PROFILES[profile_name]
+    print(f"{profile_name}: {profile.files} files, {profile.history} history commits", file=sys.stderr)
+    row, (path, commits) = await bench.measure(profile_name, "generate_repo", lambda: build_repo(profile, repos_root))
+    url = f"file://{path}"
+
+    # Mirror pool (empty at the start of a run): cold clone, reopen of a fresh mirror, and a no-op incremental fetch
+    row, repo = await bench.measure(profile_name, "clone_cold", lambda: main.repo_pool.get(url))
+    row["mirror_mb"] = round(sum(
+        os.path.getsize(os.path.join(d, f)) for d, _, files in os.walk(main.repo_pool.mirror_path(url)) for f in files
+    ) / (1024 * 1024), 1)
+    row["strategy"] = main.repo_pool.strategy
+    await bench.measure(profile_name, "clone_warm", lambda: main.repo_pool.get(url), repeat=bench.repeat)
+    await bench.measure(profile_name, "fetch_warm", lambda: main.repo_pool.fetch(url), repeat=bench.repeat)
+
+    for name, commit_hash in commits.items():
+        extractor = CommitMetadataExtractorNode(repo)
+        row, update = await bench.measure(profile_name, "diff_extraction",
+                                          lambda: extractor._extract_metadata({"commit_hash": commit_hash}),
+                                          commit=name, repeat=bench.repeat)
+        metadata = update["commit_metadata"]
+        row["files_changed"] = len(metadata["files_changed"])
+        row["diff_bytes"] = len(metadata["diff"].encode())
+
+        # First run does all LLM work; the second reuses per-patch analyses
+        for stage in ("pipeline_cold", "pipeline_warm"):
+            graph = main.get_graph(mode)
+            state = GraphState(repo_url=url, commit_hash=commit_hash, commit_metadata=None, analysis=None,
+                               fix_suggestion=None, user_query=None, pipeline_mode=mode, token_budget=None,
+                               timings={}, prompt_tokens={})
+            recorder.reset()
+            config = {"configurable": {"repo": repo}}
+            row, final = await bench.measure(profile_name, stage, lambda: graph.ainvoke(state, config), commit=name)
+            row.update(recorder.snapshot())
+            row["node_seconds"] = final["timings"]
+            row["prompt_tokens_saved"] = sum(stats["saved_tokens"] for stats in final["prompt_tokens"].values())
+            row["sqlite_write_seconds"] = final["timings"].get("store_results")
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://bench") as client:
+        async def post(endpoint: str, body: dict) -> dict:
+            response = await client.post(endpoint, json=body)
+            response.raise_for_status()
+            return response.json()
+
+        async def get(endpoint: str, **params):
+            response = await client.get(endpoint, params=params)
+            response.raise_for_status()
+            return response.json()
+
+        first_commit = next(iter(commits.values()))
+        await bench.measure(profile_name, "endpoint_analyze_cached",
+                            lambda: post("/analyze-commit", {"repo_url": url, "commit_hash": first_commit}),
+                            repeat=bench.repeat)
+        # The parent of the first benchmark commit was never analyzed
+        parent = repo.commit(first_commit).parents[0].hexsha
+        recorder.reset()
+        row, _ = await bench.measure(profile_name, "endpoint_analyze_cold",
+                                     lambda: post("/analyze-commit", {"repo_url": url, "commit_hash": parent, "pipeline_mode": mode}))
+        row.update(recorder.snapshot())
+
+        row, page = await bench.measure(profile_name, "endpoint_commits_first_page",
+                                        lambda: get("/commits", repo_url=url, count=50))
+        if page:
+            await bench.measure(profile_name, "endpoint_commits_next_page",
+                                lambda: get("/commits", repo_url=url, count=50, after=page[-1]["hash"]), repeat=bench.repeat)
+        row, response = await bench.measure(profile_name, "endpoint_query",
+                                            lambda: post("/query", {"query": "which commits changed the handlers", "repo_url": url}),
+                                            repeat=bench.repeat)
+        row["results"] = len(response["results"])
+
+
+def git_version() -> str:
+    return subprocess.run(["git", "--version"], capture_output=True, text=True).stdout.strip()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--profiles", default="tiny,small,medium",
+                        help=f"comma separated, from {', '.join(PROFILES)} (default: tiny,small,medium)")
+    parser.add_argument("--mode", choices=["linear", "parallel"], default="linear", help="pipeline mode")
+    parser.add_argument("--strategy", help="clone strategy of the mirror pool (default: CTM_CLONE_STRATEGY or full)")
+    parser.add_argument("--repeat", type=int, default=3, help="runs of each repeatable stage (median is reported)")
+    parser.add_argument("--llm-latency-ms", type=float, default=0, help="simulated latency of the fake LLM")
+    parser.add_argument("--work-dir", default=os.path.join(tempfile.gettempdir(), "ctm-bench"),
+                        help="generated repos are kept here between runs")
+    parser.add_argument("--output", help="JSON results file (default: <work-dir>/results-<timestamp>.json)")
+    parser.add_argument("--verbose", action="store_true", help="keep the pipeline's own logging")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    profiles = [p.strip() for p in args.profiles.split(",") if p.strip()]
+    unknown = [p for p in profiles if p not in PROFILES]
+    if unknown:
+        sys.exit(f"Unknown profiles: {', '.join(unknown)}")
+
+    repos_root = os.path.join(args.work_dir, "repos")
+    os.makedirs(repos_root, exist_ok=True)
+    run_dir = tempfile.mkdtemp(prefix="run-", dir=args.work_dir)
+    # Set before the app is imported: its database, mirrors and LLM backend all come from the environment
+    os.environ["CTM_DB_PATH"] = os.path.join(run_dir, "results.db")
+    os.environ["CTM_REPOS_PATH"] = os.path.join(run_dir, "mirrors")
+    os.environ["CTM_LLM_BACKEND"] = "fake"
+    os.environ["CTM_FAKE_LLM_LATENCY_MS"] = str(args.llm_latency_ms)
+    # Keep the pipeline's own logging out of the way of the results
+    os.environ["CTM_LOG_LEVEL"] = "DEBUG" if args.verbose else "WARNING"
+    if args.strategy:
+        os.environ["CTM_CLONE_STRATEGY"] = args.strategy
+
+    import llm
+    recorder = LLMRecorder(llm.get_llm())
+    bench = Bench(args.repeat)
+
+    async def run():
+        for profile in profiles:
+            await bench_profile(bench, profile, repos_root, args.mode, recorder)
+
+    started = time.time()
+    try:
+        asyncio.run(run())
+    finally:
+        shutil.rmtree(run_dir, ignore_errors=True)
+
+    report = {
+        "meta": {
+            "started_at": started,
+            "duration_seconds": round(time.time() - started, 2),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "git": git_version(),
+            "args": vars(args),
+        },
+        "results": bench.results,
+    }
+    output = args.output or os.path.join(args.work_dir, f"results-{int(started)}.json")
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {output}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+"""
+Measure backend startup and per-request overhead, and check them against a budget
+
+Each run starts a fresh interpreter with an empty database, as an autoscaled
+instance would. Run from backend/:
+    python -m benchmarks.startup --runs 5 --output startup.json
+
+Exits with status 1 if the median import time or request overhead is over budget.
+The results file has the same format as benchmarks.run, so benchmarks.compare works on it.
+"""
+import argparse
+import asyncio
+import json
+import os
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+REQUESTS = 50
+# Default budgets; tests/test_startup.py holds the import and the cached request to the same ones
+MAX_IMPORT_SECONDS = 1.0
+MAX_REQUEST_MS = 10.0
+
+
+def child():
+    """One measurement in this (fresh) process; prints the timings as JSON"""
+    start = time.perf_counter()
+    import main
+    import_seconds = time.perf_counter() - start
+    heavy_loaded = sorted(name for name in ("langgraph", "google.genai") if name in sys.modules)
+
+    import httpx
+    commit_hash = "0" * 40
+    url = "file:///startup-bench"
+    main.result_cache.put(url, commit_hash, main.CACHE_MODEL, main.cache_prompt_version(main.DEFAULT_PIPELINE_MODE, False),
+                          {"hash": commit_hash, "author": "bench", "date": "", "message": "", "diff": "",
+                           "files_changed": [], "file_stats": {}}, "analysis", "fix suggestion")
+
+    async def requests() -> tuple[list[float], list[float]]:
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://bench") as client:
+            root, cached = [], []
+            for _ in range(REQUESTS):
+                start = time.perf_counter()
+                (await client.get("/")).raise_for_status()
+                root.append(time.perf_counter() - start)
+            for _ in range(REQUESTS):
+                start = time.perf_counter()
+                (await client.post("/analyze-commit", json={"repo_url": url, "commit_hash": commit_hash})).raise_for_status()
+                cached.append(time.perf_counter() - start)
+            return root, cached
+
+    root, cached = asyncio.run(requests())
+
+    start = time.perf_counter()
+    main.get_graph(main.DEFAULT_PIPELINE_MODE)
+    graph_seconds = time.perf_counter() - start
+
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(json.dumps({
+        "import": import_seconds,
+        "first_request": root[0],
+        "request_root": statistics.median(root[1:]),
+        "request_cached_analysis": statistics.median(cached[1:]),
+        "graph_build": graph_seconds,
+        "peak_rss_mb": round((usage if sys.platform == "darwin" else usage * 1024) / (1024 * 1024), 1),
+        "heavy_modules_at_import": heavy_loaded,
+    }))
+
+
+def run_child(work_dir: str) -> tuple[dict, float]:
+    run_dir = tempfile.mkdtemp(prefix="startup-", dir=work_dir)
+    env = {
+        **os.environ,
+        "CTM_DB_PATH": os.path.join(run_dir, "results.db"),
+        "CTM_REPOS_PATH": os.path.join(run_dir, "mirrors"),
+        "CTM_LLM_BACKEND": "fake",
+        "CTM_LOG_LEVEL": "WARNING",
+    }
+    start = time.perf_counter()
+    try:
+        result = subprocess.run([sys.executable, "-m", "benchmarks.startup", "--child"], env=env, capture_output=True,
+                                text=True, cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    finally:
+        shutil.rmtree(run_dir, ignore_errors=True)
+    process_seconds = time.perf_counter() - start
+    if result.returncode != 0:
+        sys.exit(f"Startup measurement failed:\n{result.stderr}")
+    return json.loads(result.stdout.strip().splitlines()[-1]), process_seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5, help="fresh processes to start (medians are reported)")
+    parser.add_argument("--max-import-seconds", type=float, default=MAX_IMPORT_SECONDS, help="budget for importing the app")
+    parser.add_argument("--max-request-ms", type=float, default=MAX_REQUEST_MS,
+                        help="budget for the overhead of a request answered from the cache")
+    parser.add_argument("--work-dir", default=os.path.join(tempfile.gettempdir(), "ctm-bench"))
+    parser.add_argument("--output", help="JSON results file")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child()
+        return
+
+    os.makedirs(args.work_dir, exist_ok=True)
+    runs = []
+    for _ in range(args.runs):
+        measured, process_seconds = run_child(args.work_dir)
+        runs.append({**measured, "process": process_seconds})
+
+    results = []
+    for stage in ("process", "import", "first_request", "request_root", "request_cached_analysis", "graph_build"):
+        times = [run[stage] for run in runs]
+        row = {
+            "profile": "startup",
+            "stage": stage,
+            "commit": None,
+            "seconds": round(statistics.median(times), 5),
+            "min_seconds": round(min(times), 5),
+            "runs": len(times),
+            "peak_rss_mb": max(run["peak_rss_mb"] for run in runs),
+        }
+        results.append(row)
+        print(f"  {stage:<28} {row['seconds']:>9.4f}s", file=sys.stderr)
+
+    heavy = runs[0]["heavy_modules_at_import"]
+    if heavy:
+        print(f"  loaded at import time: {', '.join(heavy)}", file=sys.stderr)
+
+    over = []
+    by_stage = {row["stage"]: row["seconds"] for row in results}
+    if by_stage["import"] > args.max_import_seconds:
+        over.append(f"import took {by_stage['import']:.3f}s (budget {args.max_import_seconds}s)")
+    if by_stage["request_cached_analysis"] * 1000 > args.max_request_ms:
+        over.append(f"a cached request took {by_stage['request_cached_analysis'] * 1000:.1f}ms (budget {args.max_request_ms}ms)")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"meta": {"args": vars(args), "python": sys.version.split()[0]}, "results": results}, f, indent=2)
+        print(f"Results written to {args.output}", file=sys.stderr)
+    for line in over:
+        print(f"OVER BUDGET: {line}", file=sys.stderr)
+    sys.exit(1 if over else 0)
+
+
+if __name__ == "__main__":
+    main()
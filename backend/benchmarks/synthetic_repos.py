@@ -0,0 +1,130 @@
+import os
+import random
+import shutil
+import subprocess
+from dataclasses import dataclass, field
+
+# Bump when the generated content changes, so cached repos are rebuilt
+GENERATOR_VERSION = "1"
+LINES_PER_FILE = 40
+FILES_PER_DIR = 100
+AUTHORS = ["Alice <alice@example.com>", "Bob <bob@example.com>", "Carol <carol@example.com>"]
+START_TIME = 1_700_000_000
+
+
+@dataclass(frozen=True)
+class RepoProfile:
+    name: str
+    # Files in the tree
+    files: int
+    # Small commits before the benchmark commits
+    history: int
+    # Benchmark commit name -> number of files it changes (1 means a one-line change)
+    commits: dict[str, int] = field(default_factory=dict)
+
+
+PROFILES = {
+    "tiny": RepoProfile("tiny", files=20, history=10, commits={"1-line": 1}),
+    "small": RepoProfile("small", files=500, history=100, commits={"1-line": 1, "10-files": 10}),
+    "medium": RepoProfile("medium", files=5000, history=500, commits={"1-line": 1, "100-files": 100, "1k-files": 1000}),
+    "monorepo": RepoProfile("monorepo", files=30000, history=2000, commits={"1-line": 1, "1k-files": 1000, "10k-files": 10000}),
+}
+
+
+def file_path(index: int) -> str:
+    return f"pkg{index // FILES_PER_DIR:04d}/module_{index:06d}.py"
+
+
+def file_content(index: int, revisions: dict[int, int]) -> bytes:
+    """Content of a file, where line k has been edited at revision revisions[k]"""
+    path = file_path(index)
+    lines = []
+    for k in range(LINES_PER_FILE):
+        rev = revisions.get(k)
+        suffix = f"  # rev {rev}" if rev else ""
+        lines.append(f"def handler_{index}_{k}(request):  return process('{path}', {k}){suffix}\n")
+    return "".join(lines).encode()
+
+
+def build_repo(profile: RepoProfile, root: str) -> tuple[str, dict[str, str]]:
+    """
+    Build (or reuse) a bare repo for a profile
+
+    Args:
+        profile: Repo shape
+        root: Directory holding the generated repos
+
+    Returns:
+        tuple: (path of the bare repo, benchmark commit name -> commit hash)
+    """
+    path = os.path.join(root, profile.name)
+    marker = os.path.join(path, "ctm-bench-version")
+    key = f"{GENERATOR_VERSION} {profile}"
+    if os.path.exists(marker) and open(marker).read() == key:
+        return path, _bench_commits(path, profile)
+
+    shutil.rmtree(path, ignore_errors=True)
+    subprocess.run(["git", "init", "-q", "--bare", path], check=True)
+    subprocess.run(["git", "symbolic-ref", "HEAD", "refs/heads/main"], cwd=path, check=True)
+    # Allow partial and shallow clones of this repo over file://
+    subprocess.run(["git", "config", "uploadpack.allowFilter", "true"], cwd=path, check=True)
+    subprocess.run(["git", "config", "uploadpack.allowAnySHA1InWant", "true"], cwd=path, check=True)
+
+    process = subprocess.Popen(["git", "fast-import", "--quiet"], cwd=path, stdin=subprocess.PIPE)
+    _write_history(process.stdin, profile)
+    process.stdin.close()
+    if process.wait() != 0:
+        raise RuntimeError(f"git fast-import failed for {profile.name}")
+
+    with open(marker, "w") as f:
+        f.write(key)
+    return path, _bench_commits(path, profile)
+
+
+def _write_history(out, profile: RepoProfile):
+    rng = random.Random(profile.name)
+    revisions: dict[int, dict[int, int]] = {}
+    mark = 0
+    clock = START_TIME
+
+    def commit(message: str, changed: list[int], tag: str = ""):
+        nonlocal mark, clock
+        mark += 1
+        clock += 3600
+        author = AUTHORS[mark % len(AUTHORS)]
+        msg = message.encode()
+        out.write(f"commit refs/heads/main\nmark :{mark}\n".encode())
+        out.write(f"author {author} {clock} +0000\ncommitter {author} {clock} +0000\n".encode())
+        out.write(b"data %d\n%s\n" % (len(msg), msg))
+        for index in changed:
+            content = file_content(index, revisions.get(index, {}))
+            out.write(f"M 100644 inline {file_path(index)}\n".encode())
+            out.write(b"data %d\n%s\n" % (len(content), content))
+        out.write(b"\n")
+        if tag:
+            out.write(f"reset refs/tags/bench/{tag}\nfrom :{mark}\n\n".encode())
+
+    commit("Initial import", list(range(profile.files)))
+
+    for i in range(profile.history):
+        changed = rng.sample(range(profile.files), min(rng.randint(1, 5), profile.files))
+        for index in changed:
+            revisions.setdefault(index, {})[rng.randrange(LINES_PER_FILE)] = mark
+        commit(f"Update {len(changed)} handlers ({i})", changed)
+
+    for name, count in profile.commits.items():
+        changed = rng.sample(range(profile.files), min(count, profile.files))
+        # A one-line commit edits one line; larger commits edit a few lines per file
+        edits = 1 if count == 1 else 3
+        for index in changed:
+            for line in rng.sample(range(LINES_PER_FILE), edits):
+                revisions.setdefault(index, {})[line] = mark + 1
+        commit(f"Benchmark commit {name}", changed, tag=name)
+
+
+def _bench_commits(path: str, profile: RepoProfile) -> dict[str, str]:
+    return {
+        name: subprocess.run(["git", "rev-parse", f"refs/tags/bench/{name}"], cwd=path, check=True,
+                             capture_output=True, text=True).stdout.strip()
+        for name in profile.commits
+    }
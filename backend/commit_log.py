@@ -0,0 +1,152 @@
+import git
+import re
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+# One record per commit: hash, (rewritten) parents, author name and email, ISO date, full message
+LOG_FORMAT = "%H%x1f%P%x1f%an%x1f%ae%x1f%aI%x1f%B%x1e"
+# Commits read from git per extension of a cached listing
+LOG_BATCH_SIZE = 200
+
+
+class CommitLogCache:
+    """Commit listings read with `git log --format` and cached per (repo, ref tip, filters)
+
+    A listing is read lazily: each page only extends it as far as needed, and
+    pages that were already read are served without touching git. Listings are
+    keyed by the ref's tip, so new commits after a fetch start a new listing.
+
+    Each extension resumes the walk from its frontier (the parents of walked
+    commits not walked yet) rather than re-walking with --skip, so reading N
+    commits costs O(N) however many pages it takes. The author filter is
+    applied here, not by git, so every commit walked is seen and the frontier
+    is exact.
+    """
+
+    def __init__(self, max_entries: int = 64):
+        self.max_entries = max_entries
+        self._listings: "OrderedDict[tuple, dict]" = OrderedDict()
+        # (repo path, ref) -> (pool generation the tip was resolved at, tip hash)
+        self._tips: dict[tuple[str, str], tuple[int, str]] = {}
+        self._lock = threading.Lock()
+
+    def page(self, repo: git.Repo, generation: int, count: int, after: Optional[str] = None,
+             branch: Optional[str] = None, path: Optional[str] = None, author: Optional[str] = None) -> list[dict]:
+        """
+        Return up to `count` commits, starting right after the `after` cursor
+
+        Args:
+            repo: Repository to list
+            generation: Fetch generation of the repo; a new generation re-resolves ref tips
+            count: Page size
+            after: Hash of the last commit of the previous page
+            branch: Branch or ref to list (HEAD if None)
+            path: Only commits touching this path
+            author: Only commits whose author matches this pattern
+
+        Returns:
+            list[dict]: Commits with hash, message, author and date
+        """
+        tip = self._resolve_tip(repo, generation, branch or "HEAD")
+        try:
+            matcher = re.compile(author) if author else None
+        except re.error as e:
+            raise ValueError(f"Invalid author pattern: {e}")
+        key = (repo.git_dir, tip, path, author)
+        with self._lock:
+            listing = self._listings.get(key)
+            if listing is None:
+                listing = {"commits": [], "index": {}, "frontier": [tip], "walked": set(), "exhausted": False,
+                           "lock": threading.Lock()}
+                self._listings[key] = listing
+                while len(self._listings) > self.max_entries:
+                    self._listings.popitem(last=False)
+            self._listings.move_to_end(key)
+
+        with listing["lock"]:
+            if after is None:
+                start = 0
+            else:
+                if after not in listing["index"]:
+                    after = self._check_cursor(repo, tip, after, path, matcher)
+                batch = LOG_BATCH_SIZE
+                while after not in listing["index"] and not listing["exhausted"]:
+                    self._extend(repo, listing, path, matcher, batch)
+                    batch *= 2
+                if after not in listing["index"]:
+                    raise ValueError(f"Cursor {after} is not in the commit listing")
+                start = listing["index"][after] + 1
+
+            while len(listing["commits"]) < start + count and not listing["exhausted"]:
+                self._extend(repo, listing, path, matcher, max(start + count - len(listing["commits"]), LOG_BATCH_SIZE))
+            return listing["commits"][start:start + count]
+
+    def _resolve_tip(self, repo: git.Repo, generation: int, ref: str) -> str:
+        key = (repo.git_dir, ref)
+        cached = self._tips.get(key)
+        if cached and cached[0] == generation:
+            return cached[1]
+        tip = repo.git.rev_parse("--verify", f"{ref}^{{commit}}")
+        self._tips[key] = (generation, tip)
+        return tip
+
+    @staticmethod
+    def _check_cursor(repo: git.Repo, tip: str, after: str, path: Optional[str], matcher: Optional[re.Pattern]) -> str:
+        """
+        Make sure a cursor not read yet is in the listing at all, so a bad one is rejected instead of walking to the root
+
+        Returns:
+            str: The cursor as a full hash
+        """
+        try:
+            after = repo.git.rev_parse("--verify", f"{after}^{{commit}}")
+            repo.git.merge_base("--is-ancestor", after, tip)
+        except git.GitCommandError:
+            raise ValueError(f"Cursor {after} is not a commit of this listing (unknown, or no longer on the branch)")
+        args = ["-1", "--format=%H%x1f%an%x1f%ae", after]
+        if path:
+            args += ["--", path]
+        record = repo.git.log(*args).split("\x1f")
+        if record[0] != after or (matcher and not matcher.search(f"{record[1]} <{record[2]}>")):
+            raise ValueError(f"Cursor {after} does not match the path or author filter")
+        return after
+
+    def _extend(self, repo: git.Repo, listing: dict, path: Optional[str], matcher: Optional[re.Pattern], batch: int):
+        """Walk the next `batch` commits of a listing from its frontier with a single `git log`"""
+        start_points = listing["frontier"]
+        if not start_points:
+            listing["exhausted"] = True
+            return
+        # With a path, --parents rewrites parents to the nearest commits touching it
+        args = [*start_points, "--parents", f"--format={LOG_FORMAT}", f"--max-count={batch}"]
+        if path:
+            args += ["--", path]
+
+        walked = listing["walked"]
+        first = not walked
+        frontier = set(start_points)
+        read = 0
+        for record in repo.git.log(*args).split("\x1e"):
+            record = record.strip("\n")
+            if not record:
+                continue
+            read += 1
+            commit_hash, parents, author_name, author_email, date, message = record.split("\x1f", 5)
+            if commit_hash in walked:
+                # Only with clock skew can a commit be reached again from the frontier
+                continue
+            walked.add(commit_hash)
+            frontier.discard(commit_hash)
+            frontier.update(parent for parent in parents.split() if parent not in walked)
+            if matcher and not matcher.search(f"{author_name} <{author_email}>"):
+                continue
+            listing["index"][commit_hash] = len(listing["commits"])
+            listing["commits"].append({"hash": commit_hash, "message": message.strip(), "author": author_name, "date": date})
+        if first and read:
+            # The tip is walked first even when the path filter hides it; later start points are all shown
+            walked.update(start_points)
+            frontier.difference_update(start_points)
+        listing["frontier"] = list(frontier)
+        if read < batch or not frontier:
+            listing["exhausted"] = True
@@ -0,0 +1,45 @@
+import asyncio
+import contextvars
+import os
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+
+from telemetry import span
+
+# Git work (clone, fetch, diff) is blocking and IO/CPU heavy, so it runs on a
+# bounded thread pool; LLM calls are async but rate limited by the provider
+GIT_CONCURRENCY = int(os.environ.get("CTM_GIT_CONCURRENCY", 4))
+LLM_CONCURRENCY = int(os.environ.get("CTM_LLM_CONCURRENCY", 16))
+
+_git_executor = ThreadPoolExecutor(max_workers=GIT_CONCURRENCY, thread_name_prefix="ctm-git")
+# asyncio primitives belong to one event loop, so keep one semaphore per loop
+_llm_semaphores: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Semaphore]" = weakref.WeakKeyDictionary()
+
+
+async def run_git(func, *args, **kwargs):
+    """Run a blocking git operation on the git executor without blocking the event loop
+
+    At most CTM_GIT_CONCURRENCY git operations run at once; the rest queue up.
+    """
+    loop = asyncio.get_running_loop()
+    # The thread runs in a copy of our context, so its logs and spans belong to the same request
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(_git_executor, context.run, _traced, func, args, kwargs)
+
+
+def _traced(func, args, kwargs):
+    with span("git", getattr(func, "__qualname__", "call")):
+        return func(*args, **kwargs)
+
+
+@asynccontextmanager
+async def llm_slot():
+    """Hold one of the CTM_LLM_CONCURRENCY slots for an LLM call"""
+    loop = asyncio.get_running_loop()
+    semaphore = _llm_semaphores.get(loop)
+    if semaphore is None:
+        semaphore = _llm_semaphores[loop] = asyncio.Semaphore(LLM_CONCURRENCY)
+    async with semaphore:
+        yield
+
@@ -0,0 +1,223 @@
+import codecs
+import fnmatch
+import hashlib
+import os
+from dataclasses import dataclass, field
+from typing import Optional
+
+# Token budget for a single LLM prompt's worth of diff
+CHUNK_TOKEN_BUDGET = int(os.environ.get("CTM_CHUNK_TOKEN_BUDGET", 30000))
+
+# Files that cost tokens without telling the model anything about intent
+NOISE_FILE_PATTERNS = [
+    # Lockfiles
+    "package-lock.json", "yarn.lock", "pnpm-lock.yaml", "npm-shrinkwrap.json", "poetry.lock",
+    "Pipfile.lock", "uv.lock", "Cargo.lock", "go.sum", "composer.lock", "Gemfile.lock", "*.lock",
+    # Generated or minified output
+    "*.min.js", "*.min.css", "*.map", "*_pb2.py", "*_pb2_grpc.py", "*.pb.go", "*.generated.*", "*.snap",
+    # Vendored and build directories
+    "vendor/*", "*/vendor/*", "node_modules/*", "*/node_modules/*", "third_party/*", "*/third_party/*",
+    "dist/*", "build/*",
+]
+
+
+@dataclass
+class FileDiff:
+    path: str
+    header: str
+    hunks: list[str] = field(default_factory=list)
+
+    @property
+    def text(self) -> str:
+        return self.header + "".join(self.hunks)
+
+
+@dataclass
+class DiffPiece:
+    """One hunk of a file diff with the file's header, or the header alone for a file without hunks
+
+    Notes are stored per piece, so a hunk that shows up again in another
+    commit (cherry-picked, rebased, or part of a squash) is not analyzed twice.
+    """
+    path: str
+    header: str
+    hunk: str = ""
+
+    @property
+    def text(self) -> str:
+        return self.header + self.hunk
+
+    @property
+    def fingerprint(self) -> str:
+        return patch_id(self.text)
+
+
+@dataclass
+class DiffChunk:
+    files: list[str]
+    text: str
+    tokens: int
+    pieces: list[DiffPiece] = field(default_factory=list)
+
+    @property
+    def labeled_text(self) -> str:
+        """The pieces under numbered headings, for prompts asking for notes per piece (see split_notes)"""
+        return "".join(f"### Piece {i + 1}: {piece.path}\n{piece.text}" for i, piece in enumerate(self.pieces))
+
+
+def estimate_tokens(text: str) -> int:
+    """Cheap token estimate (~4 characters per token), good enough for budgeting"""
+    return len(text) // 4 + 1
+
+
+def patch_id(diff: str) -> str:
+    """Content fingerprint of a diff, in the spirit of `git patch-id --stable`
+
+    Whitespace, hunk line numbers and blob ids are ignored, so the same change
+    cherry-picked, rebased or pushed to a fork gets the same id.
+    """
+    digest = hashlib.sha1()
+    for line in diff.splitlines():
+        if line.startswith(("index ", "similarity index ", "dissimilarity index ")):
+            continue
+        if line.startswith("@@"):
+            line = "@@"
+        digest.update("".join(line.split()).encode())
+        digest.update(b"\n")
+    return digest.hexdigest()
+
+
+def combine_fingerprints(fingerprints: list[str]) -> str:
+    """Order-independent fingerprint of a set of pieces (file order in a diff may differ)"""
+    return hashlib.sha1("\n".join(sorted(fingerprints)).encode()).hexdigest()
+
+
+def is_noise_file(path: str) -> bool:
+    name = os.path.basename(path)
+    return any(fnmatch.fnmatch(path, pattern) or fnmatch.fnmatch(name, pattern) for pattern in NOISE_FILE_PATTERNS)
+
+
+def parse_diff(diff: str) -> list[FileDiff]:
+    """Split a `git diff` into per-file headers and hunks"""
+    files: list[FileDiff] = []
+    current = None
+    for line in diff.splitlines(keepends=True):
+        if line.startswith('diff --git '):
+            current = FileDiff(path=diff_header_path(line), header=line)
+            files.append(current)
+        elif current is None:
+            # Not a git diff (or a preamble); keep it rather than losing content
+            current = FileDiff(path="", header=line)
+            files.append(current)
+        elif line.startswith('@@'):
+            current.hunks.append(line)
+        elif current.hunks:
+            current.hunks[-1] += line
+        else:
+            current.header += line
+            # "rename to", "copy to" and "+++" name the new path unambiguously
+            current.path = header_line_path(line) or current.path
+    return files
+
+
+def unquote_path(path: str) -> str:
+    """Undo git's C-style quoting of paths with special or non-ASCII characters (core.quotepath)"""
+    if len(path) < 2 or path[0] != '"' or path[-1] != '"':
+        return path
+    # Octal escapes are the bytes of the UTF-8 encoded path
+    return codecs.escape_decode(path[1:-1].encode())[0].decode("utf-8", errors="replace")
+
+
+def diff_header_path(line: str) -> str:
+    """New path of a file from its "diff --git a/<old> b/<new>" line
+
+    The line is ambiguous when a path contains " b/", so it is split where both
+    halves name the same file (always the case unless the file was renamed or
+    copied; then the "rename to" or "copy to" line that follows has the path).
+    """
+    rest = line.rstrip("\n")[len("diff --git "):]
+    half = (len(rest) - 1) // 2
+    old, new = rest[:half], rest[half + 1:]
+    if rest[half:half + 1] == " " and old.replace("a/", "b/", 1) == new:
+        return unquote_path(new).removeprefix("b/")
+    # Renames and copies: the best guess until the extended header is read
+    if rest.endswith('"'):
+        start = rest.rfind(' "')
+        return unquote_path(rest[start + 1:]).removeprefix("b/") if start >= 0 else rest
+    return rest.rsplit(" b/", 1)[-1]
+
+
+def header_line_path(line: str) -> Optional[str]:
+    """The new path named by a "rename to", "copy to" or "+++ b/" line of an extended diff header"""
+    line = line.rstrip("\n")
+    for prefix in ("rename to ", "copy to "):
+        if line.startswith(prefix):
+            return unquote_path(line[len(prefix):])
+    if line.startswith("+++ ") and line != "+++ /dev/null":
+        # git ends the name with a tab when it contains spaces, for GNU patch
+        return unquote_path(line[len("+++ "):].removesuffix("\t")).removeprefix("b/")
+    return None
+
+
+def filter_noise(files: list[FileDiff]) -> tuple[list[FileDiff], list[str]]:
+    """Drop lockfiles, generated and vendored files before any tokens are spent on them"""
+    kept, skipped = [], []
+    for file_diff in files:
+        (skipped if is_noise_file(file_diff.path) else kept).append(file_diff)
+    return kept, [f.path for f in skipped]
+
+
+def split_pieces(files: list[FileDiff], budget: int = CHUNK_TOKEN_BUDGET) -> list[DiffPiece]:
+    """Split file diffs into one piece per hunk; a hunk larger than `budget` tokens is truncated"""
+    pieces: list[DiffPiece] = []
+    for file_diff in files:
+        if not file_diff.hunks:
+            pieces.append(DiffPiece(file_diff.path, file_diff.header))
+        hunk_budget = budget - estimate_tokens(file_diff.header)
+        pieces.extend(DiffPiece(file_diff.path, file_diff.header, truncate_to_budget(hunk, hunk_budget)) for hunk in file_diff.hunks)
+    return pieces
+
+
+def pack_pieces(pieces: list[DiffPiece], budget: int = CHUNK_TOKEN_BUDGET) -> list[DiffChunk]:
+    """Pack pieces into chunks of at most `budget` tokens, in order
+
+    A file's header is written once for consecutive pieces of the file, so a
+    chunk's text is a regular diff.
+    """
+    chunks: list[DiffChunk] = []
+    current: list[DiffPiece] = []
+    text = ""
+    for piece in pieces:
+        continues_file = bool(current) and current[-1].header == piece.header
+        addition = piece.hunk if continues_file else piece.text
+        if current and estimate_tokens(text + addition) > budget:
+            chunks.append(DiffChunk(files=list(dict.fromkeys(p.path for p in current)), text=text, tokens=estimate_tokens(text), pieces=current))
+            current, text, addition = [], "", piece.text
+        current.append(piece)
+        text += addition
+    if current:
+        chunks.append(DiffChunk(files=list(dict.fromkeys(p.path for p in current)), text=text, tokens=estimate_tokens(text), pieces=current))
+    return chunks
+
+
+def chunk_files(files: list[FileDiff], budget: int = CHUNK_TOKEN_BUDGET) -> list[DiffChunk]:
+    """Pack file diffs into chunks of at most `budget` tokens (small files are packed together)"""
+    return pack_pieces(split_pieces(files, budget), budget)
+
+
+def truncate_to_budget(text: str, budget: int) -> str:
+    max_chars = max(budget, 1) * 4
+    if len(text) <= max_chars:
+        return text
+    cut = text.rfind('\n', 0, max_chars)
+    return text[:cut + 1 if cut > 0 else max_chars] + f"... [truncated {len(text) - max_chars} characters]\n"
+
+
+def chunk_diff(diff: str, budget: int = CHUNK_TOKEN_BUDGET) -> tuple[list[DiffChunk], list[str]]:
+    """Parse, filter and chunk a diff
+
+    Returns:
+        tuple: (chunks to analyze, paths of skipped noise files)
+    """
+    files, skipped = filter_noise(parse_diff(diff))
+    return chunk_files(files, budget), skipped
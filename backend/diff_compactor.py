@@ -0,0 +1,371 @@
+import difflib
+import functools
+import logging
+import os
+import re
+from collections import Counter
+from dataclasses import asdict, dataclass, field
+from typing import Optional
+
+from diff_chunker import CHUNK_TOKEN_BUDGET, FileDiff, estimate_tokens, filter_noise, parse_diff
+
+logger = logging.getLogger(__name__)
+
+# Tokens of diff a prompt should carry; context lines are trimmed (3 down to 0) until the diff fits.
+# Diffs that still don't fit are split into chunks as before
+PROMPT_TOKEN_BUDGET = int(os.environ.get("CTM_PROMPT_TOKEN_BUDGET", CHUNK_TOKEN_BUDGET))
+# Shorter runs of lines are not reported as moved (a blank line or a lone brace moves all the time)
+MOVED_MIN_LINES = 3
+# Positions a removed block is compared against; a block repeated more often than this is boilerplate
+MOVED_MAX_CANDIDATES = 8
+# An identifier substitution has to repeat this often to be summarized as a rename
+RENAME_MIN_LINES = 3
+# Context lines git was asked for (unified=3 in diff_reader)
+MAX_CONTEXT_LINES = 3
+
+# Header lines the model learns nothing from: blob ids, and ---/+++ lines repeating the "diff --git" paths
+BOILERPLATE_HEADER = ("index ", "--- ", "+++ ", "similarity index ", "dissimilarity index ")
+IDENTIFIER_TOKENS = re.compile(r"\w+|\S")
+# Polynomial hash of a run of lines, so every window of a run can be hashed in constant time
+_HASH_BASE = 1_000_003
+_HASH_MOD = (1 << 61) - 1
+
+
+@dataclass
+class CompactionStats:
+    tokens_before: int = 0
+    tokens_after: int = 0
+    context_lines: int = MAX_CONTEXT_LINES
+    whitespace_lines: int = 0
+    moved_lines: int = 0
+    renamed_lines: int = 0
+    boilerplate_lines: int = 0
+    skipped_files: int = 0
+
+    @property
+    def saved_tokens(self) -> int:
+        return max(self.tokens_before - self.tokens_after, 0)
+
+    def to_dict(self) -> dict:
+        return {**asdict(self), "saved_tokens": self.saved_tokens}
+
+
+@dataclass
+class _Hunk:
+    header: str
+    # (tag, text without the tag and newline); tags are " ", "-", "+", or "." for notes
+    lines: list[tuple[str, str]] = field(default_factory=list)
+
+
+@dataclass
+class _File:
+    path: str
+    header: list[str]
+    hunks: list[_Hunk]
+    notes: list[str] = field(default_factory=list)
+
+
+def compact_diff(diff: str, token_budget: Optional[int] = None) -> tuple[list[FileDiff], list[str], CompactionStats]:
+    """
+    Shrink a diff before it is put in a prompt, keeping what the change does
+
+    - Lockfiles, generated and vendored files are dropped (see diff_chunker)
+    - Changes that only touch whitespace become context
+    - Blocks of lines moved unchanged are replaced by a one-line note on both ends
+    - An identifier renamed on many lines is summarized once per file
+    - Blob ids and the ---/+++ lines are stripped from file headers
+    - Context lines are trimmed until the diff fits `token_budget`
+
+    Args:
+        diff: Output of `git diff`
+        token_budget: Tokens the compacted diff should fit in (CTM_PROMPT_TOKEN_BUDGET if None)
+
+    Returns:
+        tuple: (compacted file diffs, paths of skipped noise files, what was removed)
+    """
+    return _compact_diff(diff, token_budget or PROMPT_TOKEN_BUDGET)
+
+
+def budget_version(token_budget: Optional[int]) -> str:
+    """Suffix of the cache prompt version for results whose diffs were trimmed to a non-default budget"""
+    if not token_budget or token_budget == PROMPT_TOKEN_BUDGET:
+        return ""
+    return f"-budget{token_budget}"
+
+
+# The analyzer and the fix suggester compact the same diff one after the other
+@functools.lru_cache(maxsize=8)
+def _compact_diff(diff: str, token_budget: int) -> tuple[list[FileDiff], list[str], CompactionStats]:
+    stats = CompactionStats(tokens_before=estimate_tokens(diff))
+    file_diffs, skipped = filter_noise(parse_diff(diff))
+    stats.skipped_files = len(skipped)
+
+    files = [_parse_file(file_diff, stats) for file_diff in file_diffs]
+    for file in files:
+        for hunk in file.hunks:
+            stats.whitespace_lines += _fold_whitespace(hunk)
+    stats.renamed_lines = _fold_renames(files)
+    stats.moved_lines = _fold_moves(files)
+
+    for context in range(MAX_CONTEXT_LINES, -1, -1):
+        compacted = [_render(file, context) for file in files]
+        tokens = sum(estimate_tokens(file_diff.text) for file_diff in compacted)
+        if tokens <= token_budget:
+            break
+    stats.context_lines = context
+    stats.tokens_after = tokens
+    logger.info("✂️ Compacted diff from %d to %d tokens (%d context lines)", stats.tokens_before, tokens, context)
+    return compacted, skipped, stats
+
+
+def _parse_file(file_diff: FileDiff, stats: CompactionStats) -> _File:
+    header = []
+    for line in file_diff.header.splitlines():
+        if line.startswith(BOILERPLATE_HEADER):
+            stats.boilerplate_lines += 1
+        else:
+            header.append(line)
+
+    hunks = []
+    for text in file_diff.hunks:
+        lines = text.splitlines()
+        hunk = _Hunk(lines[0])
+        for line in lines[1:]:
+            if line.startswith("\\"):
+                # "\ No newline at end of file"
+                stats.boilerplate_lines += 1
+            elif line[:1] in (" ", "-", "+"):
+                hunk.lines.append((line[0], line[1:]))
+            elif not line:
+                hunk.lines.append((" ", ""))
+            else:
+                # Truncation notes of diff_reader
+                hunk.lines.append((".", line))
+        hunks.append(hunk)
+    return _File(file_diff.path, header, hunks)
+
+
+def _normalize(text: str) -> str:
+    return "".join(text.split())
+
+
+def _change_blocks(hunk: _Hunk) -> list[tuple[int, int, int]]:
+    """(start, first added line, end) of every run of removed lines followed by added lines"""
+    blocks = []
+    i = 0
+    while i < len(hunk.lines):
+        if hunk.lines[i][0] not in "-+":
+            i += 1
+            continue
+        start = i
+        while i < len(hunk.lines) and hunk.lines[i][0] == "-":
+            i += 1
+        middle = i
+        while i < len(hunk.lines) and hunk.lines[i][0] == "+":
+            i += 1
+        blocks.append((start, middle, i))
+    return blocks
+
+
+def _fold_whitespace(hunk: _Hunk) -> int:
+    """Turn removed/added pairs that only differ in whitespace into context (new version); returns lines folded"""
+    folded = 0
+    result = []
+    last = 0
+    for start, middle, end in _change_blocks(hunk):
+        result.extend(hunk.lines[last:start])
+        removed, added = hunk.lines[start:middle], hunk.lines[middle:end]
+        matcher = difflib.SequenceMatcher(None, [_normalize(t) for _, t in removed], [_normalize(t) for _, t in added],
+                                          autojunk=False)
+        for op, i1, i2, j1, j2 in matcher.get_opcodes():
+            if op == "equal":
+                result.extend((" ", text) for _, text in added[j1:j2])
+                folded += i2 - i1
+            else:
+                result.extend(removed[i1:i2])
+                result.extend(added[j1:j2])
+        last = end
+    result.extend(hunk.lines[last:])
+    hunk.lines = result
+    return folded
+
+
+def _substitution(old: str, new: str) -> Optional[tuple[str, str]]:
+    """The single identifier swapped between two lines, if that is all that changed"""
+    old_tokens, new_tokens = IDENTIFIER_TOKENS.findall(old), IDENTIFIER_TOKENS.findall(new)
+    if len(old_tokens) != len(new_tokens):
+        return None
+    swaps = {(a, b) for a, b in zip(old_tokens, new_tokens) if a != b}
+    if len(swaps) != 1:
+        return None
+    a, b = swaps.pop()
+    if not (a[0].isalpha() or a[0] == "_") or not (b[0].isalpha() or b[0] == "_"):
+        return None
+    return a, b
+
+
+def _fold_renames(files: list[_File]) -> int:
+    """Fold lines whose only change is a repeated identifier rename into context, noting the rename per file"""
+    candidates: list[tuple[_File, _Hunk, int, int, tuple[str, str]]] = []
+    for file in files:
+        for hunk in file.hunks:
+            for start, middle, end in _change_blocks(hunk):
+                if middle - start != end - middle:
+                    continue
+                for offset in range(middle - start):
+                    swap = _substitution(hunk.lines[start + offset][1], hunk.lines[middle + offset][1])
+                    if swap:
+                        candidates.append((file, hunk, start + offset, middle + offset, swap))
+
+    counts = Counter(swap for *_, swap in candidates)
+    renames = {swap for swap, count in counts.items() if count >= RENAME_MIN_LINES}
+    folded: dict[int, set[int]] = {}
+    per_file: dict[int, Counter] = {}
+    for file, hunk, old, new, swap in candidates:
+        if swap not in renames:
+            continue
+        hunk.lines[new] = (" ", hunk.lines[new][1])
+        folded.setdefault(id(hunk), set()).add(old)
+        per_file.setdefault(id(file), Counter())[swap] += 1
+
+    for file in files:
+        for hunk in file.hunks:
+            dropped = folded.get(id(hunk))
+            if dropped:
+                hunk.lines = [line for i, line in enumerate(hunk.lines) if i not in dropped]
+        for (a, b), count in sorted(per_file.get(id(file), Counter()).items()):
+            file.notes.append(f"... [renamed `{a}` to `{b}` on {count} lines, shown as unchanged with the new name]")
+    return sum(len(lines) for lines in folded.values())
+
+
+def _runs(files: list[_File], tag: str) -> list[tuple[_File, _Hunk, int, int]]:
+    """(file, hunk, start, end) of every run of lines with the given tag"""
+    runs = []
+    for file in files:
+        for hunk in file.hunks:
+            i = 0
+            while i < len(hunk.lines):
+                if hunk.lines[i][0] != tag:
+                    i += 1
+                    continue
+                start = i
+                while i < len(hunk.lines) and hunk.lines[i][0] == tag:
+                    i += 1
+                runs.append((file, hunk, start, i))
+    return runs
+
+
+def _prefix_hashes(lines: list[str]) -> list[int]:
+    """prefix[i] is the hash of lines[:i]; lines[i:j] hashes to prefix[j] - prefix[i] * BASE ** (j - i)"""
+    prefix = [0]
+    for line in lines:
+        prefix.append((prefix[-1] * _HASH_BASE + hash(line)) % _HASH_MOD)
+    return prefix
+
+
+def _fold_moves(files: list[_File]) -> int:
+    """
+    Replace blocks removed in one place and added unchanged (up to whitespace) in another with notes
+
+    A whole run of removed lines is looked up inside the runs of added lines, and
+    the other way round, so moving a function next to other edits is still found.
+    Every window of a target run as long as some source block is indexed by its
+    hash, so each block is looked up at once instead of compared at every position
+    where its first line occurs.
+    """
+    moved = 0
+    # (hunk id, line index) of lines replaced by a note
+    replaced: dict[int, dict[int, Optional[str]]] = {}
+
+    def claimed(hunk: _Hunk, start: int, end: int) -> bool:
+        taken = replaced.get(id(hunk), {})
+        return any(i in taken for i in range(start, end))
+
+    def replace(hunk: _Hunk, start: int, end: int, note: str):
+        taken = replaced.setdefault(id(hunk), {})
+        taken[start] = note
+        for i in range(start + 1, end):
+            taken[i] = None
+
+    for source_tag, target_tag in (("-", "+"), ("+", "-")):
+        sources = []
+        for file, hunk, start, end in _runs(files, source_tag):
+            block = [_normalize(text) for _, text in hunk.lines[start:end]]
+            if sum(1 for line in block if line) >= MOVED_MIN_LINES:
+                sources.append((file, hunk, start, block))
+        lengths = {len(block) for *_, block in sources}
+
+        targets = _runs(files, target_tag)
+        normalized = [[_normalize(text) for _, text in hunk.lines[start:end]] for _, hunk, start, end in targets]
+        # (length, hash) of a window of target lines -> (target run, offset) where it occurs
+        index: dict[tuple[int, int], list[tuple[int, int]]] = {}
+        for t, lines in enumerate(normalized):
+            prefix = _prefix_hashes(lines)
+            for length in lengths:
+                scale = pow(_HASH_BASE, length, _HASH_MOD)
+                for offset in range(len(lines) - length + 1):
+                    key = (length, (prefix[offset + length] - prefix[offset] * scale) % _HASH_MOD)
+                    candidates = index.setdefault(key, [])
+                    if len(candidates) < MOVED_MAX_CANDIDATES:
+                        candidates.append((t, offset))
+
+        for file, hunk, start, block in sources:
+            if claimed(hunk, start, start + len(block)):
+                continue
+            for t, offset in index.get((len(block), _prefix_hashes(block)[-1]), []):
+                target_file, target_hunk, target_start, _ = targets[t]
+                first = target_start + offset
+                if target_hunk is hunk or claimed(target_hunk, first, first + len(block)):
+                    continue
+                # Hashes can collide
+                if normalized[t][offset:offset + len(block)] != block:
+                    continue
+                source, target = (file, hunk, start), (target_file, target_hunk, first)
+                removed, added = (source, target) if source_tag == "-" else (target, source)
+                replace(removed[1], removed[2], removed[2] + len(block), f"... [{len(block)} lines moved to {added[0].path}]")
+                replace(added[1], added[2], added[2] + len(block), f"... [{len(block)} lines moved here from {removed[0].path}]")
+                moved += len(block)
+                break
+
+    for file in files:
+        for hunk in file.hunks:
+            taken = replaced.get(id(hunk))
+            if not taken:
+                continue
+            lines = []
+            for i, line in enumerate(hunk.lines):
+                if i not in taken:
+                    lines.append(line)
+                elif taken[i] is not None:
+                    lines.append((".", taken[i]))
+            hunk.lines = lines
+    return moved
+
+
+def _render(file: _File, context: int) -> FileDiff:
+    """Back to diff text, keeping `context` lines around every change; hunks left without changes are dropped"""
+    hunks = []
+    for hunk in file.hunks:
+        changed = [i for i, (tag, _) in enumerate(hunk.lines) if tag != " "]
+        if not changed:
+            continue
+        keep = set()
+        for i in changed:
+            keep.update(range(max(i - context, 0), min(i + context + 1, len(hunk.lines))))
+        out = [hunk.header]
+        previous = None
+        for i in sorted(keep):
+            if previous is not None and i != previous + 1:
+                # Context between two changes was trimmed; start a new (unnumbered) hunk
+                out.append("@@")
+            tag, line = hunk.lines[i]
+            out.append(line if tag == "." else tag + line)
+            previous = i
+        hunks.append("\n".join(out) + "\n")
+
+    header = "\n".join(file.header) + "\n"
+    notes = list(file.notes)
+    if file.hunks and not hunks and not notes:
+        notes.append("... [only whitespace changed]")
+    header += "".join(note + "\n" for note in notes)
+    return FileDiff(path=file.path, header=header, hunks=hunks)
@@ -0,0 +1,321 @@
+import os
+import re
+from dataclasses import dataclass, field
+
+import git
+
+from diff_chunker import diff_header_path, header_line_path, unquote_path
+from telemetry import span
+
+# Patch text kept per commit; git is stopped once this much has been read
+DIFF_MAX_BYTES = int(os.environ.get("CTM_DIFF_MAX_BYTES", 2 * 1024 * 1024))
+# Patch text kept per file; the rest of that file's diff is dropped
+DIFF_FILE_MAX_BYTES = int(os.environ.get("CTM_DIFF_FILE_MAX_BYTES", 256 * 1024))
+# Bytes read from git at a time, and the longest line kept in one piece
+READ_BLOCK_SIZE = 64 * 1024
+# Commits of a range listed with their files; the net diff of the range is never limited by this
+RANGE_MAX_COMMITS = int(os.environ.get("CTM_RANGE_MAX_COMMITS", 200))
+# Commits of a file's history read per request (the newest ones)
+FILE_HISTORY_MAX_COMMITS = int(os.environ.get("CTM_FILE_HISTORY_MAX_COMMITS", 200))
+
+
+@dataclass
+class CommitDiff:
+    files: list[str] = field(default_factory=list)
+    # path -> {"additions", "deletions", "binary", "renamed_from"}; additions/deletions are None for binaries
+    stats: dict[str, dict] = field(default_factory=dict)
+    patch: str = ""
+    truncated: bool = False
+
+
+def read_commit_diff(repo: git.Repo, parent: str, commit: str, max_bytes: int = DIFF_MAX_BYTES,
+                     max_file_bytes: int = DIFF_FILE_MAX_BYTES) -> CommitDiff:
+    """
+    Read the changed files, their numstat and the patch of a commit with a single `git diff`
+
+    Renames are detected (-M). Binary files only get git's one-line notice, each
+    file's patch is cut at `max_file_bytes` and git is stopped once `max_bytes`
+    of patch have been kept, so memory stays flat on huge commits.
+
+    Args:
+        repo: Repository containing both revisions
+        parent: Revision to diff against (a parent commit or the empty tree)
+        commit: Commit to diff
+
+    Returns:
+        CommitDiff: Files in diff order, per-file stats and the (possibly truncated) patch
+    """
+    with span("git", "diff") as trace:
+        process = repo.git.diff(parent, commit, "--numstat", "--patch", "-M", "-z", "--no-color", "--no-ext-diff",
+                                unified=3, as_process=True)
+        stdout = process.proc.stdout
+        result = CommitDiff()
+
+        reader = _StreamReader(stdout)
+        # With -z the numstat records come first, NUL separated and ended by an empty record
+        _parse_numstat(reader.read_until(b"\0\0"), result)
+
+        finished = _read_patch(reader, result, max_bytes, max_file_bytes)
+        if finished:
+            process.wait()
+        else:
+            process.proc.kill()
+            process.proc.wait()
+        trace.set("files", len(result.files))
+        trace.set("patch_bytes", len(result.patch))
+        trace.set("truncated", result.truncated)
+    return result
+
+
+def read_range_commits(repo: git.Repo, base: str, head: str, max_commits: int = RANGE_MAX_COMMITS) -> tuple[list[dict], int]:
+    """
+    List the commits of base..head with the files each of them touched, in one `git log`
+
+    Args:
+        repo: Repository containing both revisions
+        base: Commit the range starts after
+        head: Last commit of the range
+        max_commits: Only the newest this many commits are listed
+
+    Returns:
+        tuple: (commits oldest first as dicts with hash, author, date, message and files; total commits in the range)
+    """
+    with span("git", "log") as trace:
+        total = int(repo.git.rev_list("--count", f"{base}..{head}"))
+        # Records start with RS; fields are separated by US, and the file names follow the header
+        output = repo.git.log(f"--max-count={max_commits}", "--format=%x1e%H%x1f%an%x1f%aI%x1f%s%x1f", "--name-only",
+                              "--no-color", f"{base}..{head}")
+        commits = []
+        for record in output.split("\x1e")[1:]:
+            commit_hash, author, date, subject, files = record.split("\x1f", 4)
+            commits.append({
+                "hash": commit_hash,
+                "author": author,
+                "date": date,
+                "message": subject,
+                "files": [line for line in files.splitlines() if line],
+            })
+        commits.reverse()
+        trace.set("commits", total)
+    return commits, total
+
+
+def read_file_history(repo: git.Repo, path: str, rev: str = "HEAD", max_commits: int = FILE_HISTORY_MAX_COMMITS,
+                      max_file_bytes: int = DIFF_FILE_MAX_BYTES) -> list[dict]:
+    """
+    Read the history of one file with its patches, following renames, in one `git log --follow`
+
+    Only the file's own patch is read for each commit, so the size of the
+    commits it was part of doesn't matter. Merge commits are left out; the
+    commits they merged are listed instead.
+
+    Args:
+        repo: Repository to read
+        path: Path of the file at `rev`
+        rev: Revision or range to walk, e.g. "HEAD" or "v1.2..v1.3"
+        max_commits: Only the newest this many commits are read
+        max_file_bytes: Each commit's patch is cut after this many bytes
+
+    Returns:
+        list[dict]: Commits oldest first, with hash, author, date, message, the file's path and
+            previous path at that commit, additions, deletions, patch and whether it was truncated
+    """
+    with span("git", "log_follow") as trace:
+        process = repo.git.log(f"--max-count={max_commits}", "--follow", "--no-merges", "--patch", "-M", "--no-color",
+                               "--no-ext-diff", "--format=%x1e%H%x1f%an%x1f%aI%x1f%s", rev, "--", path,
+                               unified=3, as_process=True)
+        reader = _StreamReader(process.proc.stdout)
+        commits: list[dict] = []
+        current = None
+        kept = 0
+        in_header = False
+        while True:
+            line = reader.readline()
+            if not line:
+                break
+            if line.startswith(b"\x1e"):
+                commit_hash, author, date, subject = _decode(line[1:]).rstrip("\n").split("\x1f", 3)
+                current = {"hash": commit_hash, "author": author, "date": date, "message": subject, "path": path,
+                           "renamed_from": None, "additions": 0, "deletions": 0, "patch": [], "truncated": False}
+                commits.append(current)
+                kept = 0
+                continue
+            if current is None or (not current["patch"] and not line.startswith(b"diff --git ")):
+                # The blank line between the header and the patch
+                continue
+            text = _decode(line)
+            if text.startswith("diff --git "):
+                current["path"] = diff_header_path(text)
+                in_header = True
+            elif text.startswith("@@"):
+                in_header = False
+            elif in_header:
+                if text.startswith("rename from "):
+                    current["renamed_from"] = unquote_path(text[len("rename from "):].rstrip("\n"))
+                current["path"] = header_line_path(text) or current["path"]
+            elif text.startswith("+"):
+                current["additions"] += 1
+            elif text.startswith("-"):
+                current["deletions"] += 1
+            if current["truncated"]:
+                continue
+            if kept + len(line) > max_file_bytes:
+                current["patch"].append(f"... [truncated after {kept} bytes]\n")
+                current["truncated"] = True
+                continue
+            current["patch"].append(text)
+            kept += len(line)
+        process.wait()
+        for commit in commits:
+            commit["patch"] = "".join(commit["patch"])
+        commits.reverse()
+        trace.set("commits", len(commits))
+    return commits
+
+
+def read_blame(repo: git.Repo, path: str, rev: str = "HEAD") -> dict[str, int]:
+    """
+    Count the lines of a file at `rev` by the commit that last changed them, with `git blame --porcelain`
+
+    Returns:
+        dict: Commit hash -> lines; empty if the file does not exist at `rev`
+    """
+    with span("git", "blame") as trace:
+        try:
+            output = repo.git.blame("--porcelain", rev, "--", path)
+        except git.GitCommandError:
+            return {}
+        lines: dict[str, int] = {}
+        # Every group of consecutive lines from one commit starts with "<hash> <orig> <final> <count>"
+        for match in _BLAME_GROUP.finditer(output):
+            lines[match.group(1)] = lines.get(match.group(1), 0) + int(match.group(2))
+        trace.set("lines", sum(lines.values()))
+    return lines
+
+
+_BLAME_GROUP = re.compile(r"^([0-9a-f]{40}) \d+ \d+ (\d+)$", re.MULTILINE)
+
+
+class _StreamReader:
+    """Buffered reads from git's stdout, able to skip ahead without splitting lines"""
+
+    FILE_HEADER = b"\ndiff --git "
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.buffer = b""
+        self.pos = 0
+
+    def _fill(self) -> bool:
+        block = self.stream.read1(READ_BLOCK_SIZE)
+        if block:
+            self.buffer = self.buffer[self.pos:] + block
+            self.pos = 0
+        return bool(block)
+
+    def read_until(self, separator: bytes) -> bytes:
+        while self.buffer.find(separator, self.pos) < 0 and self._fill():
+            pass
+        end = self.buffer.find(separator, self.pos)
+        if end < 0:
+            end = len(self.buffer)
+        data = self.buffer[self.pos:end]
+        self.pos = min(end + len(separator), len(self.buffer))
+        return data
+
+    def readline(self) -> bytes:
+        """Next line, or the next READ_BLOCK_SIZE bytes of a longer one"""
+        while True:
+            limit = self.pos + READ_BLOCK_SIZE
+            end = self.buffer.find(b"\n", self.pos, limit)
+            if end >= 0 or len(self.buffer) >= limit or not self._fill():
+                break
+        end = end + 1 if end >= 0 else min(limit, len(self.buffer))
+        line = self.buffer[self.pos:end]
+        self.pos = end
+        return line
+
+    def skip_to_next_file(self) -> int:
+        """Discard input up to the next file's "diff --git" line, returning the bytes skipped"""
+        skipped = 0
+        while True:
+            index = self.buffer.find(self.FILE_HEADER, self.pos)
+            if index >= 0:
+                skipped += index + 1 - self.pos
+                self.pos = index + 1
+                return skipped
+            # Keep a tail in case the header straddles two reads
+            tail = max(self.pos, len(self.buffer) - len(self.FILE_HEADER) + 1)
+            skipped += tail - self.pos
+            self.pos = tail
+            if not self._fill():
+                skipped += len(self.buffer) - self.pos
+                self.pos = len(self.buffer)
+                return skipped
+
+
+def _parse_numstat(numstat: bytes, result: CommitDiff):
+    tokens = numstat.split(b"\0")
+    i = 0
+    while i < len(tokens) and tokens[i]:
+        additions, deletions, path = tokens[i].split(b"\t", 2)
+        renamed_from = None
+        if not path:
+            # Renames and copies: "add\tdel\t" followed by the old and new path
+            renamed_from, path = _decode(tokens[i + 1]), tokens[i + 2]
+            i += 3
+        else:
+            i += 1
+        path = _decode(path)
+        binary = additions == b"-"
+        result.files.append(path)
+        result.stats[path] = {
+            "additions": None if binary else int(additions),
+            "deletions": None if binary else int(deletions),
+            "binary": binary,
+            "renamed_from": renamed_from,
+        }
+
+
+def _read_patch(reader: _StreamReader, result: CommitDiff, max_bytes: int, max_file_bytes: int) -> bool:
+    """Keep the patch within the budgets; returns False if git was not read to the end"""
+    kept: list[str] = []
+    total = 0
+    file_index = -1
+    file_bytes = 0
+    at_line_start = True
+
+    while True:
+        line = reader.readline()
+        if not line:
+            break
+        if at_line_start and line.startswith(b"diff --git "):
+            file_index += 1
+            file_bytes = 0
+        at_line_start = line.endswith(b"\n")
+
+        if file_bytes + len(line) > max_file_bytes:
+            # The rest of this file is dropped without going through it line by line
+            dropped = len(line) + reader.skip_to_next_file()
+            newline = "" if not kept or kept[-1].endswith("\n") else "\n"
+            kept.append(f"{newline}... [truncated {dropped} bytes]\n")
+            result.truncated = True
+            at_line_start = True
+            continue
+        if total + len(line) > max_bytes:
+            remaining = len(result.files) - file_index
+            kept.append(f"... [diff truncated, {remaining} of {len(result.files)} files not fully shown]\n")
+            result.truncated = True
+            result.patch = "".join(kept)
+            return False
+
+        kept.append(_decode(line))
+        file_bytes += len(line)
+        total += len(line)
+
+    result.patch = "".join(kept)
+    return True
+
+
+def _decode(data: bytes) -> str:
+    return data.decode("utf-8", errors="replace")
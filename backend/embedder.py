@@ -0,0 +1,77 @@
+import asyncio
+import logging
+import os
+import threading
+from typing import Optional
+
+from llm import LLMClient, LLMError, get_llm
+from result_store import ResultStore
+from search_index import pack_vector
+
+logger = logging.getLogger(__name__)
+
+# Documents and queries have to be embedded by the same model to be comparable
+EMBEDDING_MODEL = os.environ.get("CTM_EMBEDDING_MODEL", "text-embedding-004")
+# Search documents embedded per call of index_pending
+EMBED_BATCH_SIZE = 64
+
+
+class Embedder:
+    """Embeds search documents in batches as analyses are stored, and each /query's text
+
+    Documents are picked up by what lacks a vector in results.db rather than
+    passed in, so ones left over by a failed call (or stored before embeddings
+    existed) are embedded with the next batch.
+    """
+
+    def __init__(self, store: ResultStore, llm: Optional[LLMClient] = None, model: str = EMBEDDING_MODEL):
+        self.store = store
+        self.llm = llm or get_llm()
+        self.model = model
+        # Documents being embedded right now, so concurrent calls don't embed them twice
+        self._claimed: set[int] = set()
+        self._lock = threading.Lock()
+
+    @property
+    def stored_model(self) -> str:
+        """Name the vectors are stored under; vectors of the fake backend never mix with real ones"""
+        return self.llm.cache_model(self.model)
+
+    async def index_pending(self) -> int:
+        """
+        Embed up to EMBED_BATCH_SIZE documents without a vector, in one backend call
+
+        Returns:
+            int: Number of documents embedded
+
+        Raises:
+            LLMError: The embedding call failed; the documents stay pending
+        """
+        with self._lock:
+            claimed = len(self._claimed)
+        docs = await asyncio.to_thread(self.store.unembedded_documents, self.stored_model, EMBED_BATCH_SIZE + claimed)
+        with self._lock:
+            docs = [doc for doc in docs if doc[0] not in self._claimed][:EMBED_BATCH_SIZE]
+            self._claimed.update(doc_id for doc_id, _, _ in docs)
+        if not docs:
+            return 0
+
+        try:
+            vectors = await self.llm.embed([text for _, _, text in docs], self.model)
+            await asyncio.to_thread(self.store.save_vectors, self.stored_model, {
+                (doc_id, updated_at): pack_vector(vector) for (doc_id, updated_at, _), vector in zip(docs, vectors)
+            })
+        finally:
+            with self._lock:
+                self._claimed.difference_update(doc_id for doc_id, _, _ in docs)
+        logger.debug("Embedded %d search documents", len(docs))
+        return len(docs)
+
+    async def embed_query(self, query: str) -> Optional[bytes]:
+        """The query's packed vector, or None (keyword search only) if the embedding call fails"""
+        try:
+            vector, = await self.llm.embed([query], self.model)
+        except LLMError as e:
+            logger.warning("Searching by keyword only, embedding the query failed: %s", e)
+            return None
+        return pack_vector(vector)
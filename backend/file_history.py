@@ -0,0 +1,235 @@
+import asyncio
+import hashlib
+import logging
+import os
+from typing import AsyncIterator, Optional
+
+from agents.code_change_analyzer import CodeChangeAnalyzerNode, generate_notes, join_notes
+from diff_chunker import CHUNK_TOKEN_BUDGET, DiffPiece, estimate_tokens, pack_pieces, split_pieces
+from diff_compactor import compact_diff
+from llm import LLMClient, get_llm
+from result_store import ResultStore
+from telemetry import PROMPT_TOKENS_SAVED, log_content
+
+logger = logging.getLogger(__name__)
+
+EVOLUTION_FORMAT = """## RETURN FORMAT (in Markdown)
+```markdown
+### 1. Overview
+*What the file does today and how it got there, in a few sentences.*
+
+### 2. Timeline
+- **Phase title** (`short hash`…`short hash`): *what changed and why it mattered*
+
+Group related commits into phases, oldest first.
+
+### 3. Hotspots & risks
+- *Areas changed over and over, changes that were reverted or reworked, and anything that looks fragile.*
+```
+
+* Name commits by their short hash.
+* Avoid hallucinating changes not present in the notes.
+* Keep the report tight, readable, and developer‑friendly.
+"""
+
+# The first part of a history, or all of it when it fits in one prompt...
+EVOLUTION_PROMPT = """
+You are a senior software engineer and expert code assistant.
+Below are notes on every commit that changed `{path}`, oldest first. Write an **evolution report** of the file
+that helps developers understand how it came to be the way it is.
+
+""" + EVOLUTION_FORMAT + """
+The commits are:
+{commits}
+"""
+
+# ...and every later part extends the report written so far
+EVOLUTION_UPDATE_PROMPT = """
+You are a senior software engineer and expert code assistant.
+Here is the evolution report of `{path}` up to commit {through}:
+
+{report}
+
+Newer commits changed the file since. Update the report with them: extend the timeline, and rewrite the
+overview and the hotspots where the newer commits change the picture. Keep the same format.
+
+""" + EVOLUTION_FORMAT + """
+The newer commits, oldest first, are:
+{commits}
+"""
+
+# Commits whose diff has nothing to send (binary, generated or vendored files)
+NO_TEXT_NOTE = "- *No textual change to analyze (binary, generated or vendored file).*"
+
+
+def history_fingerprint(commit: dict) -> str:
+    """Key of the file's evolution report through a commit
+
+    Only the file's path and the commit: the history up to a commit can't change
+    without its hash changing, so the key doesn't depend on where the part of the
+    history being analyzed starts.
+    """
+    return hashlib.sha1("\n".join([commit["path"], commit["hash"]]).encode()).hexdigest()
+
+
+class FileHistoryAnalyzer:
+    """Notes on every commit that changed one file, and an evolution report built from them
+
+    Per-commit notes are the analyzer's per-hunk notes ("unit" patch analyses),
+    so a hunk analyzed as part of a commit is not sent to the model again here,
+    and the other way around. The report is stored after each part of
+    the history it covers, so when new commits land only they are added to the
+    stored report. Reports are keyed by the newest commit they cover and remember
+    the oldest one, so a stored report is still found after the max_commits
+    window has moved past older commits.
+    """
+    MODEL = os.environ.get("CTM_HISTORY_MODEL", CodeChangeAnalyzerNode.MODEL)
+    # Bump whenever the prompts change so stored reports are not reused
+    PROMPT_VERSION = "1"
+
+    def __init__(self, store: Optional[ResultStore] = None, llm: Optional[LLMClient] = None):
+        self.llm = llm or get_llm()
+        self.store = store
+
+    async def events(self, commits: list[dict], path: str, token_budget: Optional[int] = None,
+                     partial: bool = False) -> AsyncIterator[tuple[str, dict]]:
+        """
+        Analyze a file's history, yielding (event, payload) pairs as results become available
+
+        Events are "commit" (a commit of `commits`, oldest first, with its
+        notes once they are known), "delta" ({"field": "report", "text"} as the
+        report is generated) and finally "report" ({"report", "reused_report",
+        "reused_notes", "generated_notes", "prompt_tokens_saved"}).
+
+        Args:
+            commits: Output of read_file_history, oldest first
+            path: Path of the file at the newest commit
+            token_budget: Tokens of diff per prompt (CTM_PROMPT_TOKEN_BUDGET if None)
+            partial: `commits` are only the newest part of the history (max_commits was reached)
+        """
+        pieces: list[list[DiffPiece]] = []
+        saved = 0
+        # Up to FILE_HISTORY_MAX_COMMITS diffs to compact; kept off the event loop
+        compacted = await asyncio.to_thread(lambda: [compact_diff(commit["patch"], token_budget) for commit in commits])
+        for files, _, compaction in compacted:
+            saved += compaction.saved_tokens
+            pieces.append(split_pieces(files))
+        PROMPT_TOKENS_SAVED.inc(saved, node="file_history")
+
+        fingerprints = [piece.fingerprint for commit_pieces in pieces for piece in commit_pieces]
+        reused = await self._load("unit", fingerprints, CodeChangeAnalyzerNode.MODEL, CodeChangeAnalyzerNode.PROMPT_VERSION)
+        tasks = [
+            asyncio.create_task(self._notes(commit, commit_pieces, reused))
+            for commit, commit_pieces in zip(commits, pieces)
+            if any(piece.fingerprint not in reused for piece in commit_pieces)
+        ]
+        generated = iter(tasks)
+        logger.info("📜 History of %s: %d commits, %d need new notes", path, len(commits), len(tasks))
+
+        notes = []
+        try:
+            for commit, commit_pieces in zip(commits, pieces):
+                if all(piece.fingerprint in reused for piece in commit_pieces):
+                    note = join_notes(commit_pieces, reused, []) or NO_TEXT_NOTE
+                    is_reused = True
+                else:
+                    # Yielded in history order, while the notes of later commits are still being generated
+                    note = await next(generated)
+                    is_reused = False
+                notes.append(note)
+                yield "commit", {**{k: v for k, v in commit.items() if k != "patch"}, "notes": note, "reused": is_reused}
+        finally:
+            for task in tasks:
+                task.cancel()
+
+        keys = [history_fingerprint(commit) for commit in commits]
+        stored = await self._load("evolution", keys, self.MODEL, self.PROMPT_VERSION)
+        starts = await self._load("evolution-start", [key for key in keys if key in stored], self.MODEL, self.PROMPT_VERSION)
+        # The newest commit covered by a stored report that also covers our first commit. A report that starts
+        # before it does when the window has moved on; one that starts later lacks the commits in between
+        in_window = {commit["hash"] for commit in commits}
+        done = max((i + 1 for i, key in enumerate(keys) if key in starts
+                    and (starts[key] == commits[0]["hash"] or (partial and starts[key] not in in_window))), default=0)
+        report = stored[keys[done - 1]] if done else ""
+        origin = starts[keys[done - 1]] if done else commits[0]["hash"]
+        if done == len(commits):
+            logger.info("♻️ Reusing the stored evolution report of %s", path)
+            yield "delta", {"field": "report", "text": report}
+        else:
+            logger.info("Updating the evolution report of %s with %d of %d commits", path, len(commits) - done, len(commits))
+            batches = self._batches(commits, notes, done, estimate_tokens(report))
+            for i, (start, end) in enumerate(batches):
+                entries = "\n\n".join(commit_entry(commit, note) for commit, note in zip(commits[start:end], notes[start:end]))
+                if report:
+                    prompt = EVOLUTION_UPDATE_PROMPT.format(path=path, through=commits[start - 1]["hash"][:8], report=report, commits=entries)
+                else:
+                    prompt = EVOLUTION_PROMPT.format(path=path, commits=entries)
+                # Only the last pass is streamed; the earlier ones are rewritten by it
+                if i == len(batches) - 1:
+                    generated_report: list[str] = []
+                    async for event in self._stream(prompt, generated_report):
+                        yield event
+                    report = generated_report[0]
+                else:
+                    report = await self.llm.generate(prompt, self.MODEL)
+                # The oldest commit covered goes last: a report is only reused once both are stored
+                await self._save("evolution", {keys[end - 1]: report}, self.MODEL, self.PROMPT_VERSION)
+                await self._save("evolution-start", {keys[end - 1]: origin}, self.MODEL, self.PROMPT_VERSION)
+
+        log_content(logger, "Generated evolution report", report)
+        yield "report", {
+            "report": report,
+            "reused_report": done == len(commits),
+            "reused_notes": len(commits) - len(tasks),
+            "generated_notes": len(tasks),
+            "prompt_tokens_saved": saved,
+        }
+
+    async def _notes(self, commit: dict, pieces: list[DiffPiece], reused: dict[str, str]) -> str:
+        """Notes on one commit's change to the file; only hunks never analyzed before are sent to the model"""
+        chunks = pack_pieces([piece for piece in pieces if piece.fingerprint not in reused])
+        notes, unsplit = await generate_notes(self.llm, CodeChangeAnalyzerNode.MODEL, chunks, commit["message"] or "N/A")
+        await self._save("unit", notes, CodeChangeAnalyzerNode.MODEL, CodeChangeAnalyzerNode.PROMPT_VERSION)
+        return join_notes(pieces, {**reused, **notes}, unsplit)
+
+    @staticmethod
+    def _batches(commits: list[dict], notes: list[str], start: int, report_tokens: int) -> list[tuple[int, int]]:
+        """Split commits[start:] into runs whose notes fit one prompt next to the report"""
+        batches = []
+        tokens = report_tokens
+        for i in range(start, len(commits)):
+            entry_tokens = estimate_tokens(commit_entry(commits[i], notes[i]))
+            if i > start and tokens + entry_tokens > CHUNK_TOKEN_BUDGET:
+                batches.append((start, i))
+                start, tokens = i, report_tokens
+            tokens += entry_tokens
+        batches.append((start, len(commits)))
+        return batches
+
+    async def _stream(self, prompt: str, result: list[str]) -> AsyncIterator[tuple[str, dict]]:
+        """Generate the report, yielding its tokens as "delta" events; the full text is appended to `result`"""
+        queue: asyncio.Queue = asyncio.Queue()
+        task = asyncio.create_task(self.llm.generate(prompt, self.MODEL, queue.put_nowait))
+        task.add_done_callback(lambda _: queue.put_nowait(None))
+        try:
+            while (text := await queue.get()) is not None:
+                yield "delta", {"field": "report", "text": text}
+            result.append(await task)
+        finally:
+            task.cancel()
+
+    async def _load(self, kind: str, fingerprints: list[str], model: str, prompt_version: str) -> dict[str, str]:
+        if self.store is None:
+            return {}
+        return await asyncio.to_thread(self.store.get_patch_analyses, kind, fingerprints, self.llm.cache_model(model), prompt_version)
+
+    async def _save(self, kind: str, texts: dict[str, str], model: str, prompt_version: str):
+        if self.store is not None and texts:
+            await asyncio.to_thread(self.store.save_patch_analyses, kind, self.llm.cache_model(model), prompt_version, texts)
+
+
+def commit_entry(commit: dict, notes: str) -> str:
+    """A commit's notes as they appear in the evolution prompts"""
+    renamed = f" (renamed from {commit['renamed_from']})" if commit.get("renamed_from") else ""
+    return (f"### {commit['hash'][:8]} — {commit['date']} — {commit['author']}{renamed}\n"
+            f"Commit message: {commit['message']}\n{notes}")
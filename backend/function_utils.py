@@ -1,80 +1,33 @@
 import git 
+import logging
 import shutil
 import os
 import stat
+import string
+from typing import Optional
 
-def is_same_repo(repo_path: str, repo_url: str) -> bool:
-    """Check if the existing repo at repo_path matches the requested repo_url"""
-    try:
-        if not os.path.exists(repo_path):
-            return False
-            
-        if not os.path.exists(os.path.join(repo_path, '.git')):
-            return False
-            
-        repo = git.Repo(repo_path)
-        
-        # Check if remote origin matches the expected URL
-        if 'origin' in repo.remotes:
-            origin_url = repo.remotes.origin.url
-            # Normalize URLs for comparison (handle .git suffix and trailing slashes)
-            normalized_origin = origin_url.rstrip('/').rstrip('.git')
-            normalized_expected = repo_url.rstrip('/').rstrip('.git')
-            
-            return normalized_origin == normalized_expected
-        
-        return False
-        
-    except (git.InvalidGitRepositoryError, Exception):
-        return False
+logger = logging.getLogger(__name__)
 
-def clone_repo(repo_url: str, repo_path: str):
-    """Clone a repository from a URL to a local path
-    
-    Args:
-        repo_url: URL of the repository to clone
-        repo_path: Path to the local repository
-        
-    Returns:
-        git.Repo: The cloned repository
-    """
-    # Check if we already have the same repo
-    if is_same_repo(repo_path, repo_url):
-        print(f"✅ Same repo already exists at {repo_path}, skipping clone")
-        return git.Repo(repo_path)
-    
-    # Different repo or no repo exists - delete existing and clone fresh
-    if os.path.exists(repo_path) and os.listdir(repo_path):
-        print(f"🗑️ Different repo detected, deleting existing repo at {repo_path}")
-        delete_cloned_repo(repo_path)
+# Hash of git's empty tree, used as the "parent" of root commits
+EMPTY_TREE_SHA1 = "4b825dc642cb6eb9a060e54bf8d69288fbee4904"
 
-    # Check if repo path exists
-    if not os.path.exists(repo_path):
-        print(f"📁 Creating repo folder: {repo_path}")
-        os.makedirs(repo_path)
+def normalize_repo_url(repo_url: str) -> str:
+    """Normalize a repo URL (handle .git suffix, trailing slashes and whitespace)"""
+    url = repo_url.strip().rstrip('/')
+    if url.endswith('.git'):
+        url = url[:-len('.git')]
+    return url
 
-    print(f"📥 Cloning {repo_url} to {repo_path}")
-    
-    try:
-        # Try cloning main branch first
-        repo = git.Repo.clone_from(repo_url, repo_path, branch="main")
-        print(f"✅ Repo cloned successfully (main branch): {repo_path}")
-        return repo
-    except git.GitCommandError:
-        try:
-            # Fallback to master branch
-            repo = git.Repo.clone_from(repo_url, repo_path, branch="master")
-            print(f"✅ Repo cloned successfully (master branch): {repo_path}")
-            return repo
-        except git.GitCommandError:
-            try:
-                # Clone without specifying branch (get default)
-                repo = git.Repo.clone_from(repo_url, repo_path)
-                print(f"✅ Repo cloned successfully (default branch): {repo_path}")
-                return repo
-            except Exception as e:
-                print(f"❌ Repo cloning failed: {e}")
-                raise e
+def is_full_commit_hash(commit_hash: Optional[str]) -> bool:
+    """Check if a string is a full (unabbreviated) SHA-1 or SHA-256 commit hash"""
+    return bool(commit_hash) and len(commit_hash) in (40, 64) and all(c in string.hexdigits for c in commit_hash)
+
+def split_range_key(commit_hash: Optional[str]) -> Optional[tuple[str, str]]:
+    """Split the "<base>..<head>" key a range analysis is stored under; None for a single commit"""
+    if not commit_hash or ".." not in commit_hash:
+        return None
+    base, head = commit_hash.split("..", 1)
+    return base, head
 
 def delete_cloned_repo(repo_path: str) -> bool:
     """
@@ -89,12 +42,12 @@ def delete_cloned_repo(repo_path: str) -> bool:
     try:
         # Check if path exists
         if not os.path.exists(repo_path):
-            print(f"Path does not exist: {repo_path}")
+            logger.warning("Path does not exist: %s", repo_path)
             return False
             
-        # Verify it's actually a git repository
-        if not os.path.exists(os.path.join(repo_path, '.git')):
-            print(f"Warning: Path does not appear to be a git repository: {repo_path}")
+        # Verify it's actually a git repository (working tree or bare mirror)
+        if not os.path.exists(os.path.join(repo_path, '.git')) and not os.path.exists(os.path.join(repo_path, 'HEAD')):
+            logger.warning("Path does not appear to be a git repository: %s", repo_path)
             
         # Handle Windows read-only files in git repos
         def handle_remove_readonly(func, path, exc):
@@ -105,18 +58,136 @@ def delete_cloned_repo(repo_path: str) -> bool:
                 
         # Delete the repository
         shutil.rmtree(repo_path)
-        print(f"Successfully deleted repository: {repo_path}")
+        logger.info("Successfully deleted repository: %s", repo_path)
         return True
         
     except PermissionError as e:
-        print(f"Permission error deleting {repo_path}: {e}")
+        logger.error("Permission error deleting %s: %s", repo_path, e)
         return False
     except Exception as e:
-        print(f"Error deleting repository {repo_path}: {e}")
+        logger.error("Error deleting repository %s: %s", repo_path, e)
         return False
     
 def get_most_recent_commit(repo: git.Repo) -> git.Commit:
     """
     Get the most recent commit in a repository
     """
-    return repo.head.commit
\ No newline at end of file
+    return repo.head.commit
+
+def resolve_default_branch(repo_url: str) -> Optional[str]:
+    """
+    Resolve the default branch of a remote with a single `git ls-remote`
+
+    Returns:
+        str: Branch name (e.g. "main"), or None if the remote HEAD is detached
+    """
+    output = git.cmd.Git().ls_remote("--symref", repo_url, "HEAD")
+    for line in output.splitlines():
+        # ref: refs/heads/main\tHEAD
+        if line.startswith("ref: refs/heads/"):
+            return line[len("ref: refs/heads/"):].split("\t")[0]
+    return None
+
+def is_partial_clone(repo: git.Repo) -> bool:
+    """Check if a repository was cloned with a --filter (blobless or treeless)"""
+    try:
+        return repo.git.config("--get", "remote.origin.promisor") == "true"
+    except git.GitCommandError:
+        return False
+
+def is_shallow_boundary(repo: git.Repo, commit_hash: str) -> bool:
+    """Check if a commit sits on the shallow boundary, i.e. its parents were not fetched"""
+    shallow_file = os.path.join(repo.git_dir, 'shallow')
+    if not os.path.exists(shallow_file):
+        return False
+    with open(shallow_file) as f:
+        return commit_hash in {line.strip() for line in f}
+
+def deepen_to_parent(repo: git.Repo, commit_hash: str):
+    """Fetch the parent of a commit on the shallow boundary of a shallow clone"""
+    logger.info("📥 Deepening shallow clone to reach the parent of %s", commit_hash)
+    try:
+        repo.git.fetch("origin", commit_hash, depth=2)
+    except git.GitCommandError:
+        # Servers that refuse fetching by SHA still allow deepening every tip
+        repo.git.fetch("origin", deepen=1)
+
+def prefetch_diff_blobs(repo: git.Repo, parent_hash: str, commit_hash: str) -> int:
+    """
+    Fetch only the objects a single diff needs from a partial clone, in one request
+
+    Without this git would lazily fetch every missing blob with its own round trip.
+
+    Args:
+        repo: Partial (blobless or treeless) clone
+        parent_hash: Commit or tree the diff starts from
+        commit_hash: Commit the diff ends at
+
+    Returns:
+        int: Number of objects fetched
+    """
+    fetch_args = ["-c", "fetch.negotiationAlgorithm=noop", "fetch", "origin",
+                  "--no-tags", "--no-write-fetch-head", "--recurse-submodules=no", "--filter=blob:none"]
+    commits = [h for h in (parent_hash, commit_hash) if h != EMPTY_TREE_SHA1]
+
+    # Treeless clones are missing the trees too; fetching the commits with a blob
+    # filter brings in just their trees
+    if _partial_clone_filter(repo) == "tree:0":
+        without_trees = [c for c in commits if _root_tree_missing(repo, c)]
+        if without_trees:
+            repo.git.execute(["git", *fetch_args, *without_trees])
+
+    raw = repo.git.diff_tree("-r", "--raw", "--no-abbrev", parent_hash, commit_hash)
+    needed = set()
+    for line in raw.splitlines():
+        # :100644 100644 <old oid> <new oid> M\tpath
+        fields = line.split("\t")[0].split()
+        if len(fields) >= 4:
+            needed.update(oid for oid in fields[2:4] if set(oid) != {"0"})
+
+    wanted = sorted(needed & _missing_objects(repo, commits))
+    for i in range(0, len(wanted), 500):
+        repo.git.execute(["git", *fetch_args, *wanted[i:i + 500]])
+    if wanted:
+        logger.info("📥 Prefetched %d blobs for %s", len(wanted), commit_hash)
+    return len(wanted)
+
+def needs_object_fetches(repo: git.Repo) -> bool:
+    """Whether diffs in this clone may need objects from the remote (shallow or partial clones)"""
+    return os.path.exists(os.path.join(repo.git_dir, 'shallow')) or is_partial_clone(repo)
+
+def fetch_diff_objects(repo: git.Repo, commit_hash: str, base: Optional[str] = None):
+    """
+    Fetch what diffing a commit needs in a shallow or partial clone: the parent
+    past a shallow boundary, and the blobs of the diff in one batch
+
+    Args:
+        repo: Clone to fetch into
+        commit_hash: Commit the diff ends at
+        base: Where the diff starts; the commit's first parent if None
+    """
+    commit = repo.commit(commit_hash)
+    if base is None and is_shallow_boundary(repo, commit.hexsha):
+        deepen_to_parent(repo, commit.hexsha)
+        commit = repo.commit(commit.hexsha)
+    if is_partial_clone(repo):
+        if base is None:
+            base = commit.parents[0].hexsha if commit.parents else EMPTY_TREE_SHA1
+        prefetch_diff_blobs(repo, base, commit.hexsha)
+
+def _missing_objects(repo: git.Repo, commits: list[str]) -> set[str]:
+    """Objects introduced by `commits` that are missing locally, listed without triggering lazy fetches"""
+    parents = [f"{c}^@" for c in commits]
+    output = repo.git.rev_list("--objects", "--missing=print", "--no-object-names", *commits, "--not", *parents)
+    return {line[1:] for line in output.splitlines() if line.startswith("?")}
+
+def _partial_clone_filter(repo: git.Repo) -> Optional[str]:
+    try:
+        return repo.git.config("--get", "remote.origin.partialclonefilter")
+    except git.GitCommandError:
+        return None
+
+def _root_tree_missing(repo: git.Repo, commit_hash: str) -> bool:
+    tree = repo.git.rev_parse(f"{commit_hash}^{{tree}}")
+    output = repo.git.rev_list("--objects", "--missing=print", "--no-object-names", "--no-walk", commit_hash)
+    return f"?{tree}" in output.splitlines()
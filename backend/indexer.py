@@ -0,0 +1,166 @@
+import asyncio
+import contextvars
+import logging
+import os
+import time
+from typing import Awaitable, Callable, Optional
+
+import git
+
+from agents import CommitMetadataExtractorNode
+from concurrency import run_git
+from repo_pool import RepoPool, has_commit
+from result_store import ResultStore
+from telemetry import span
+
+logger = logging.getLogger(__name__)
+
+# Off by default: indexing costs git work (and LLM calls when pre-warming) for commits nobody may open
+PREFETCH_ENABLED = os.environ.get("CTM_PREFETCH_ENABLED", "").lower() in ("1", "true", "yes")
+# Newest commits of the default branch indexed per clone or fetch; older new commits are left to on-demand extraction
+PREFETCH_MAX_COMMITS = int(os.environ.get("CTM_PREFETCH_MAX_COMMITS", 50))
+# Of those, how many of the newest are also analyzed ahead of time (LLM calls); 0 only stores metadata and diffs
+PREFETCH_ANALYSES = int(os.environ.get("CTM_PREFETCH_ANALYSES", 0))
+# Commits stored per transaction
+INDEX_BATCH_SIZE = 20
+
+
+class RepoIndexer:
+    """Background worker that stores the metadata and diffs of new commits after each clone or fetch
+
+    Each run walks the default branch from its tip back to the tip indexed last
+    time, so a re-fetch only extracts the commits it brought in. Analyses of the
+    newest commits can optionally be pre-warmed too. Repos are indexed one at a
+    time, so the indexer never takes more than one git worker from requests.
+    """
+
+    def __init__(self, store: ResultStore, pool: RepoPool, analyze: Callable[[str, str], Awaitable[None]],
+                 is_analyzed: Callable[[str, list[str]], set[str]], enabled: bool = PREFETCH_ENABLED,
+                 max_commits: int = PREFETCH_MAX_COMMITS, analyses: int = PREFETCH_ANALYSES):
+        self.store = store
+        self.pool = pool
+        self.analyze = analyze
+        self.is_analyzed = is_analyzed
+        self.enabled = enabled
+        self.max_commits = max_commits
+        self.analyses = analyses
+        self.indexed = 0
+        self.prewarmed = 0
+        self.errors = 0
+        # repo URL -> mirror generation last queued, so each clone or fetch is indexed once
+        self._generations: dict[str, int] = {}
+        self._pending: set[str] = set()
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def notify(self, repo_url: str, generation: int):
+        """Called after a repo was handed out by the pool; queues indexing if it was cloned or fetched since"""
+        if not self.enabled or self._generations.get(repo_url) == generation:
+            return
+        self._generations[repo_url] = generation
+        self._ensure_worker()
+        if repo_url not in self._pending:
+            self._pending.add(repo_url)
+            self._queue.put_nowait(repo_url)
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "queued": len(self._pending),
+            "indexed_commits": self.indexed,
+            "prewarmed_analyses": self.prewarmed,
+            "errors": self.errors,
+        }
+
+    def _ensure_worker(self):
+        # Started lazily so the queue and task belong to the server's event loop
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+        if self._task is None or self._task.done():
+            # A fresh context, so background work isn't logged and traced as part of the request that started it
+            self._task = asyncio.get_running_loop().create_task(self._worker(), context=contextvars.Context())
+
+    async def _worker(self):
+        while True:
+            repo_url = await self._queue.get()
+            # A fetch that lands while this repo is being indexed queues it again
+            self._pending.discard(repo_url)
+            try:
+                await self.index(repo_url)
+            except Exception as e:
+                self.errors += 1
+                logger.error("Indexing %s failed: %s", repo_url, e)
+            finally:
+                self._queue.task_done()
+
+    async def index(self, repo_url: str) -> list[str]:
+        """
+        Store metadata of the commits added to the default branch since the last run
+
+        Returns:
+            list[str]: Hashes of the newly stored commits, newest first
+        """
+        lease = await self.pool.lease_existing(repo_url)
+        if lease is None:
+            return []
+        with span("prefetch", "index") as trace, lease as repo:
+            last_tip = await asyncio.to_thread(self.store.indexed_tip, repo_url)
+            tip, hashes = await run_git(self._new_commits, repo, last_tip)
+            if tip is None or tip == last_tip:
+                return []
+            stored = await asyncio.to_thread(self.store.stored_commits, repo_url, hashes)
+            new = [h for h in hashes if h not in stored]
+            trace.set("new_commits", len(new))
+
+            extractor = CommitMetadataExtractorNode(repo, pool=self.pool)
+            for i in range(0, len(new), INDEX_BATCH_SIZE):
+                batch = new[i:i + INDEX_BATCH_SIZE]
+                await extractor.fetch_objects(repo_url, repo, batch)
+                commits = await run_git(self._extract, extractor, batch)
+                last = i + INDEX_BATCH_SIZE >= len(new)
+                # The tip is only recorded with the last batch, so an interrupted run starts over
+                await asyncio.to_thread(self.store.save_commits, repo_url, commits, tip if last else None)
+                self.indexed += len(commits)
+            if not new:
+                await asyncio.to_thread(self.store.save_commits, repo_url, [], tip)
+            logger.info("🗂️ Indexed %d new commits of %s", len(new), repo_url)
+
+        await self._prewarm(repo_url, hashes[:self.analyses])
+        return new
+
+    def _new_commits(self, repo: git.Repo, last_tip: Optional[str]) -> tuple[Optional[str], list[str]]:
+        try:
+            tip = repo.git.rev_parse("HEAD")
+        except git.GitCommandError:
+            # Empty repository
+            return None, []
+        args = [f"--max-count={self.max_commits}", tip]
+        # After a force push the old tip may be gone; then just take the newest commits
+        if last_tip and has_commit(repo, last_tip):
+            args.append(f"^{last_tip}")
+        return tip, repo.git.rev_list(*args).split()
+
+    @staticmethod
+    def _extract(extractor: CommitMetadataExtractorNode, hashes: list[str]) -> list[dict]:
+        commits = []
+        for commit_hash in hashes:
+            metadata = extractor._extract_metadata({"commit_hash": commit_hash})["commit_metadata"]
+            if metadata.get("author") != "Error":
+                commits.append(metadata)
+        return commits
+
+    async def _prewarm(self, repo_url: str, hashes: list[str]):
+        if not hashes:
+            return
+        analyzed = await asyncio.to_thread(self.is_analyzed, repo_url, hashes)
+        for commit_hash in hashes:
+            if commit_hash in analyzed:
+                continue
+            start = time.perf_counter()
+            try:
+                await self.analyze(repo_url, commit_hash)
+                self.prewarmed += 1
+                logger.info("🔥 Pre-warmed the analysis of %s in %.1fs", commit_hash, time.perf_counter() - start)
+            except Exception as e:
+                self.errors += 1
+                logger.error("Pre-warming the analysis of %s failed: %s", commit_hash, e)
@@ -0,0 +1,104 @@
+import asyncio
+import logging
+import os
+import time
+import uuid
+from collections import OrderedDict
+from typing import Awaitable, Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+# How many commits of all batch jobs are analyzed at once; git and LLM work
+# inside each analysis is further bounded by CTM_GIT_CONCURRENCY / CTM_LLM_CONCURRENCY
+BATCH_WORKERS = int(os.environ.get("CTM_BATCH_WORKERS", 4))
+# Finished jobs are kept in memory for polling, oldest dropped first
+MAX_RETAINED_JOBS = int(os.environ.get("CTM_MAX_RETAINED_JOBS", 100))
+
+
+class Job:
+    def __init__(self, repo_url: str, commit_hashes: list[str], cached: set[str], options: dict):
+        self.id = uuid.uuid4().hex
+        self.repo_url = repo_url
+        self.commit_hashes = commit_hashes
+        self.options = options
+        self.created_at = time.time()
+        self.finished_at: Optional[float] = None
+        # commit hash -> "queued" | "running" | "cached" | "done" | "error: ..."
+        self.results: dict[str, str] = {h: ("cached" if h in cached else "queued") for h in commit_hashes}
+
+    @property
+    def status(self) -> str:
+        states = self.results.values()
+        if any(s in ("queued", "running") for s in states):
+            return "running" if any(s != "queued" for s in states) else "queued"
+        return "failed" if any(s.startswith("error") for s in states) else "done"
+
+    def to_dict(self) -> dict:
+        counts: dict[str, int] = {}
+        for state in self.results.values():
+            key = "error" if state.startswith("error") else state
+            counts[key] = counts.get(key, 0) + 1
+        finished = counts.get("done", 0) + counts.get("cached", 0) + counts.get("error", 0)
+        return {
+            "job_id": self.id,
+            "repo_url": self.repo_url,
+            "status": self.status,
+            "total": len(self.commit_hashes),
+            "progress": finished / len(self.commit_hashes) if self.commit_hashes else 1.0,
+            "counts": counts,
+            "commits": self.results,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class JobQueue:
+    """Local worker pool that analyzes the commits of batch jobs with bounded parallelism"""
+
+    def __init__(self, analyze: Callable[[Job, str], Awaitable[None]], workers: int = BATCH_WORKERS):
+        self.analyze = analyze
+        self.workers = workers
+        self.jobs: "OrderedDict[str, Job]" = OrderedDict()
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: list[asyncio.Task] = []
+
+    def submit(self, repo_url: str, commit_hashes: list[str], cached: set[str], options: dict) -> Job:
+        """Create a job and enqueue every commit that isn't already cached"""
+        self._ensure_workers()
+        job = Job(repo_url, commit_hashes, cached, options)
+        self.jobs[job.id] = job
+        while len(self.jobs) > MAX_RETAINED_JOBS:
+            self.jobs.popitem(last=False)
+
+        for commit_hash in commit_hashes:
+            if job.results[commit_hash] == "queued":
+                self._queue.put_nowait((job, commit_hash))
+        if job.status == "done":
+            job.finished_at = time.time()
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        return self.jobs.get(job_id)
+
+    def _ensure_workers(self):
+        # Started lazily so the queue and tasks belong to the server's event loop
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+        self._tasks = [t for t in self._tasks if not t.done()]
+        while len(self._tasks) < self.workers:
+            self._tasks.append(asyncio.create_task(self._worker()))
+
+    async def _worker(self):
+        while True:
+            job, commit_hash = await self._queue.get()
+            job.results[commit_hash] = "running"
+            try:
+                await self.analyze(job, commit_hash)
+                job.results[commit_hash] = "done"
+            except Exception as e:
+                logger.error("Batch job %s: error analyzing %s: %s", job.id, commit_hash, e)
+                job.results[commit_hash] = f"error: {getattr(e, 'detail', e)}"
+            finally:
+                if job.status in ("done", "failed") and job.finished_at is None:
+                    job.finished_at = time.time()
+                self._queue.task_done()
@@ -0,0 +1,375 @@
+import asyncio
+import hashlib
+import logging
+import os
+import random
+import re
+import threading
+import time
+import weakref
+from dataclasses import dataclass
+from typing import AsyncIterator, Callable, Optional
+
+from concurrency import llm_slot
+from diff_chunker import estimate_tokens
+from telemetry import LLM_CALLS, LLM_IN_FLIGHT, LLM_RETRIES, LLM_TOKENS, span
+
+# "gemini" calls the Gemini API; "fake" is a deterministic local stand-in for
+# load tests and offline development (no API key, no quota)
+LLM_BACKEND = os.environ.get("CTM_LLM_BACKEND", "gemini")
+# Attempts per LLM call, the first one included
+LLM_MAX_ATTEMPTS = int(os.environ.get("CTM_LLM_RETRIES", 4))
+# Token bucket shared by all LLM calls of the process; 0 disables rate limiting
+LLM_REQUESTS_PER_MINUTE = float(os.environ.get("CTM_LLM_REQUESTS_PER_MINUTE", 0))
+LLM_BURST = int(os.environ.get("CTM_LLM_BURST", 10))
+# Simulated latency of the fake backend, per response and per streamed piece
+FAKE_LLM_LATENCY_MS = float(os.environ.get("CTM_FAKE_LLM_LATENCY_MS", 0))
+# Texts per embedding request (the Gemini API takes at most 100)
+EMBED_BATCH_SIZE = 100
+# Dimensions of the fake backend's vectors
+FAKE_EMBEDDING_DIM = 64
+
+logger = logging.getLogger(__name__)
+
+
+class LLMError(Exception):
+    """An LLM call failed for good (not retryable, or out of retries)"""
+
+    def __init__(self, message: str, code: Optional[int] = None):
+        super().__init__(message)
+        self.code = code
+
+    @property
+    def retryable(self) -> bool:
+        return is_retryable(self)
+
+
+def is_retryable(error: Exception) -> bool:
+    """Rate limits (429) and server errors (5xx) are worth retrying, anything else is not"""
+    code = getattr(error, "code", None)
+    return code == 429 or (isinstance(code, int) and code >= 500)
+
+
+async def with_backoff(call, attempts: int = LLM_MAX_ATTEMPTS, base_delay: float = 1.0, max_delay: float = 30.0):
+    """Await `call()` and retry it with jittered exponential backoff on retryable errors
+
+    Callers take their llm_slot inside `call`, so a request waiting out a rate
+    limit does not hold a concurrency slot.
+    """
+    for attempt in range(attempts):
+        try:
+            return await call()
+        except Exception as e:
+            if attempt == attempts - 1 or not is_retryable(e):
+                raise
+            delay = min(max_delay, base_delay * 2 ** attempt) * random.uniform(0.5, 1.5)
+            logger.warning("⏳ LLM call failed with %s, retrying in %.1fs", getattr(e, "code", None), delay)
+            await asyncio.sleep(delay)
+
+
+class TokenBucket:
+    """Allows `rate` requests per second on average, with bursts of up to `capacity`"""
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    async def acquire(self):
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            await asyncio.sleep(wait)
+
+
+@dataclass
+class TokenUsage:
+    """Token counts the API reported for a call; None where it reported none (the fake backend never does)"""
+    prompt: Optional[int] = None
+    output: Optional[int] = None
+
+    def record(self, metadata):
+        """Take the counts from a response's usage_metadata; in a stream the last chunk carrying them wins"""
+        if metadata is None:
+            return
+        self.prompt = metadata.prompt_token_count or self.prompt
+        self.output = metadata.candidates_token_count or self.output
+
+
+class GeminiBackend:
+    name = "gemini"
+
+    def __init__(self):
+        self._client = None
+
+    @property
+    def client(self):
+        # One client for the whole process, so its HTTP connections are reused
+        if self._client is None:
+            from google import genai
+            self._client = genai.Client(api_key=os.environ["GOOGLE_API_KEY"])
+        return self._client
+
+    async def generate(self, model: str, prompt: str, usage: Optional[TokenUsage] = None) -> str:
+        response = await self.client.aio.models.generate_content(model=model, contents=prompt)
+        if usage is not None:
+            usage.record(response.usage_metadata)
+        return response.text
+
+    async def stream(self, model: str, prompt: str, usage: Optional[TokenUsage] = None) -> AsyncIterator[str]:
+        async for chunk in await self.client.aio.models.generate_content_stream(model=model, contents=prompt):
+            if usage is not None:
+                usage.record(chunk.usage_metadata)
+            if chunk.text:
+                yield chunk.text
+
+    async def embed(self, model: str, texts: list[str]) -> list[list[float]]:
+        response = await self.client.aio.models.embed_content(model=model, contents=texts)
+        return [embedding.values for embedding in response.embeddings]
+
+
+class FakeBackend:
+    """Deterministic stand-in: the same prompt always gets the same response
+
+    Responses follow the report format closely enough for the pipeline to run
+    end to end: notes for every numbered piece of a diff in the prompt, or
+    else a section for every file.
+    """
+    name = "fake"
+
+    def __init__(self, latency_ms: float = FAKE_LLM_LATENCY_MS):
+        self.latency = latency_ms / 1000
+        self.calls = 0
+
+    def respond(self, model: str, prompt: str) -> str:
+        digest = hashlib.sha1(f"{model}\n{prompt}".encode()).hexdigest()[:12]
+        pieces = re.findall(r"^### Piece (\d+): (.+)$", prompt, re.MULTILINE)
+        sections = "".join(f"#### Piece {n}: {path}\n- **Change type**: modified\n- **Details**: fake notes for hunk {n} of {path}\n"
+                           for n, path in pieces)
+        if not pieces:
+            files = list(dict.fromkeys(re.findall(r"^diff --git a/\S+ b/(\S+)", prompt, re.MULTILINE)))
+            sections = "".join(f"#### File: {path}\n- **Change type**: modified\n- **Details**: fake notes for {path}\n" for path in files)
+        return f"### 1. Commit summary\nFake response {digest} from {model} for a {len(prompt)}-character prompt.\n\n{sections}"
+
+    async def generate(self, model: str, prompt: str, usage: Optional[TokenUsage] = None) -> str:
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        return self.respond(model, prompt)
+
+    async def stream(self, model: str, prompt: str, usage: Optional[TokenUsage] = None) -> AsyncIterator[str]:
+        self.calls += 1
+        for line in self.respond(model, prompt).splitlines(keepends=True):
+            await asyncio.sleep(self.latency / 10)
+            yield line
+
+    def vector(self, model: str, text: str) -> list[float]:
+        """Hashed bag of words: texts sharing words land close, but unlike real embeddings synonyms don't"""
+        vector = [0.0] * FAKE_EMBEDDING_DIM
+        for word in re.findall(r"[a-z]{3,}", text.lower()):
+            h = int.from_bytes(hashlib.blake2b(word.encode(), digest_size=4).digest(), "big")
+            # The sign bit keeps hash collisions from only ever adding up
+            vector[h % FAKE_EMBEDDING_DIM] += 1.0 if h & 0x80000000 else -1.0
+        return vector
+
+    async def embed(self, model: str, texts: list[str]) -> list[list[float]]:
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        return [self.vector(model, text) for text in texts]
+
+
+BACKENDS = {"gemini": GeminiBackend, "fake": FakeBackend}
+
+
+class _SharedCall:
+    """A backend call and everyone waiting for its answer
+
+    A streamed call sends its pieces to one waiter's on_token at a time. When
+    that waiter goes away another streaming waiter takes over, starting with
+    the text so far.
+    """
+
+    def __init__(self, streamer: Optional[Callable[[str], None]]):
+        self.task: Optional[asyncio.Task] = None
+        # on_token of every waiter, None for those not streaming
+        self.waiters: list[Optional[Callable[[str], None]]] = []
+        self.streamer = streamer
+        self.text = ""
+
+    def forward(self, piece: str):
+        self.text += piece
+        if self.streamer is not None:
+            self.streamer(piece)
+
+    def hand_over_stream(self):
+        self.streamer = next((on_token for on_token in self.waiters if on_token is not None), None)
+        if self.streamer is not None and self.text:
+            self.streamer(self.text)
+
+
+class LLMClient:
+    """Shared entry point for every LLM call of the pipeline
+
+    Adds, around the backend: the process-wide token bucket, the per-loop
+    concurrency slots, jittered exponential retries on 429/5xx, and coalescing
+    of identical prompts that are in flight at the same time.
+    """
+
+    def __init__(self, backend=None, requests_per_minute: float = LLM_REQUESTS_PER_MINUTE, burst: int = LLM_BURST):
+        self.backend = backend or BACKENDS[LLM_BACKEND]()
+        self.bucket = TokenBucket(requests_per_minute / 60, burst)
+        self.coalesced = 0
+        # (model, prompt) -> the call in flight; its task belongs to one event loop
+        self._in_flight: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, dict]" = weakref.WeakKeyDictionary()
+
+    def cache_model(self, model: str) -> str:
+        """Model name for cache keys; output of the fake backend never mixes with real results"""
+        return model if self.backend.name == "gemini" else f"{self.backend.name}:{model}"
+
+    async def generate(self, prompt: str, model: str, on_token: Optional[Callable[[str], None]] = None) -> str:
+        """
+        Generate a completion
+
+        Args:
+            prompt: Prompt text
+            model: Model name
+            on_token: If given, the response is streamed and every piece is passed to it
+
+        Returns:
+            str: The full response
+
+        Raises:
+            LLMError: The call failed and retrying did not help
+        """
+        loop = asyncio.get_running_loop()
+        in_flight = self._in_flight.setdefault(loop, {})
+        key = (model, prompt)
+        call = in_flight.get(key)
+        if call is not None:
+            # Someone is already asking exactly this; share their answer
+            self.coalesced += 1
+            LLM_CALLS.inc(model=model, outcome="coalesced")
+        else:
+            call = in_flight[key] = _SharedCall(on_token)
+            call.task = loop.create_task(self._shared_generate(prompt, model, call, stream=on_token is not None))
+            call.task.add_done_callback(lambda _: in_flight.pop(key) if in_flight.get(key) is call else None)
+
+        call.waiters.append(on_token)
+        try:
+            # The call belongs to every waiter: cancelling one (say, the client that started it went away) leaves it running
+            text = await asyncio.shield(call.task)
+        finally:
+            call.waiters.remove(on_token)
+            if not call.task.done():
+                if on_token is not None and call.streamer is on_token:
+                    call.hand_over_stream()
+                if not call.waiters:
+                    call.task.cancel()
+        if on_token is not None and call.streamer is not on_token:
+            on_token(text)
+        return text
+
+    async def _shared_generate(self, prompt: str, model: str, call: "_SharedCall", stream: bool) -> str:
+        try:
+            with span("llm", model, streamed=stream) as trace:
+                return await self._generate(prompt, model, call.forward if stream else None, trace)
+        except (LLMError, asyncio.CancelledError):
+            raise
+        except Exception as e:
+            raise LLMError(f"LLM call failed: {e}", getattr(e, "code", None)) from e
+
+    async def embed(self, texts: list[str], model: str) -> list[list[float]]:
+        """
+        Embed texts, EMBED_BATCH_SIZE per request
+
+        Raises:
+            LLMError: A request failed and retrying did not help
+        """
+        vectors: list[list[float]] = []
+        for i in range(0, len(texts), EMBED_BATCH_SIZE):
+            batch = texts[i:i + EMBED_BATCH_SIZE]
+
+            async def attempt() -> list[list[float]]:
+                await self.bucket.acquire()
+                async with llm_slot():
+                    return await self.backend.embed(model, batch)
+
+            with span("llm", model, texts=len(batch)):
+                try:
+                    vectors += await with_backoff(attempt)
+                except Exception as e:
+                    LLM_CALLS.inc(model=model, outcome="error")
+                    if isinstance(e, LLMError):
+                        raise
+                    raise LLMError(f"Embedding failed: {e}", getattr(e, "code", None)) from e
+            LLM_CALLS.inc(model=model, outcome="ok")
+            # Embedding responses carry no token counts
+            LLM_TOKENS.inc(sum(estimate_tokens(text) for text in batch), model=model, direction="in", counted="estimated")
+        return vectors
+
+    async def _generate(self, prompt: str, model: str, on_token: Optional[Callable[[str], None]], trace) -> str:
+        streamed = False
+        attempts = 0
+        usage = TokenUsage()
+
+        async def attempt() -> str:
+            nonlocal streamed, attempts, usage
+            await self.bucket.acquire()
+            attempts += 1
+            if attempts > 1:
+                LLM_RETRIES.inc(model=model)
+            usage = TokenUsage()
+            async with llm_slot():
+                if on_token is None:
+                    return await self.backend.generate(model, prompt, usage)
+                text = ""
+                async for piece in self.backend.stream(model, prompt, usage):
+                    streamed = True
+                    text += piece
+                    on_token(piece)
+                return text
+
+        async def attempt_once_streamed() -> str:
+            try:
+                return await attempt()
+            except Exception as e:
+                # Pieces already sent to the client can't be taken back, so don't retry those
+                if streamed:
+                    raise LLMError(f"LLM stream failed midway: {e}") from e
+                raise
+
+        LLM_IN_FLIGHT.inc(model=model)
+        try:
+            text = await with_backoff(attempt_once_streamed)
+        except Exception:
+            LLM_CALLS.inc(model=model, outcome="error")
+            raise
+        finally:
+            LLM_IN_FLIGHT.dec(model=model)
+            trace.set("retries", max(attempts - 1, 0))
+        LLM_CALLS.inc(model=model, outcome="ok")
+        for direction, reported, content in (("in", usage.prompt, prompt), ("out", usage.output, text)):
+            tokens = reported if reported is not None else estimate_tokens(content)
+            LLM_TOKENS.inc(tokens, model=model, direction=direction, counted="reported" if reported is not None else "estimated")
+            trace.set(f"tokens_{direction}", tokens)
+        return text
+
+
+_client: Optional[LLMClient] = None
+
+
+def get_llm() -> LLMClient:
+    """The process-wide LLM client"""
+    global _client
+    if _client is None:
+        _client = LLMClient()
+    return _client
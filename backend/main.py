@@ -1,19 +1,81 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
-from typing import Optional
+from typing import TYPE_CHECKING, Optional
+import functools
 import git
+import inspect
+import json
+import logging
 import os
-from langgraph.graph import StateGraph, END
+import time
 import asyncio
+from contextlib import asynccontextmanager
 from fastapi.middleware.cors import CORSMiddleware
 
-from models.graph_state import GraphState
-from agents import FixSuggesterNode, StoreResultsNode, CodeChangeAnalyzerNode, CommitMetadataExtractorNode
+from models.graph_state import GraphState, PipelineMode
+from agents import FixSuggesterNode, StoreResultsNode, CodeChangeAnalyzerNode, CommitMetadataExtractorNode, ReportMergerNode
 from function_utils import *
-
-REPO_PATH = os.path.join(os.path.dirname(__file__), 'cloned_repo')
-
-app = FastAPI()
+from result_cache import ResultCache
+from result_store import ResultStore
+from repo_pool import RepoBusyError, RepoLease, RepoPool
+from concurrency import run_git
+from llm import LLMError, get_llm
+from embedder import Embedder
+from jobs import JobQueue, Job
+from commit_log import CommitLogCache
+from indexer import RepoIndexer
+from diff_compactor import budget_version
+from diff_reader import FILE_HISTORY_MAX_COMMITS, read_blame, read_file_history, read_range_commits
+from file_history import FileHistoryAnalyzer
+from telemetry import HTTP_REQUESTS, configure_logging, log_content, new_request_id, render_metrics, request_id, setup_tracing, span
+
+if TYPE_CHECKING:
+    # langgraph (and langchain_core) take about half a second to import, so they are
+    # only loaded once the first graph is built, in the background after startup
+    from langchain_core.runnables import RunnableConfig
+
+REPOS_PATH = os.environ.get("CTM_REPOS_PATH", os.path.join(os.path.dirname(__file__), 'cloned_repos'))
+DB_PATH = os.environ.get("CTM_DB_PATH", os.path.join(os.path.dirname(__file__), 'results.db'))
+DEFAULT_PIPELINE_MODE = os.environ.get("CTM_PIPELINE_MODE", "linear")
+BATCH_MAX_COMMITS = int(os.environ.get("CTM_BATCH_MAX_COMMITS", 1000))
+MAX_COMMITS_PAGE = 500
+MAX_QUERY_RESULTS = 100
+
+configure_logging()
+setup_tracing()
+logger = logging.getLogger(__name__)
+
+# Cache entries are only valid for the exact models and prompts that produced them
+CACHE_MODEL = get_llm().cache_model(f"{CodeChangeAnalyzerNode.MODEL}+{FixSuggesterNode.MODEL}")
+CACHE_PROMPT_VERSION = f"{CodeChangeAnalyzerNode.PROMPT_VERSION}.{FixSuggesterNode.PROMPT_VERSION}"
+
+
+def cache_prompt_version(mode: PipelineMode, merge: bool, is_range: bool = False, token_budget: Optional[int] = None) -> str:
+    """
+    Parallel runs prompt the fix suggester differently, ranges the analyzer, and a non-default
+    token budget trims the diff in both prompts, so they are all cached separately
+    """
+    version = CACHE_PROMPT_VERSION + ("-range" if is_range else "")
+    if mode != "linear":
+        version += "-parallel" + (f"-merge{ReportMergerNode.PROMPT_VERSION}" if merge else "")
+    return version + budget_version(token_budget)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Import langgraph and compile the default pipeline while the server already takes requests
+    warm_up = asyncio.create_task(asyncio.to_thread(get_graph, DEFAULT_PIPELINE_MODE))
+    yield
+    warm_up.cancel()
+    result_store.flush_touches()
+
+app = FastAPI(lifespan=lifespan)
+result_store = ResultStore(DB_PATH)
+result_cache = ResultCache(result_store)
+repo_pool = RepoPool(REPOS_PATH)
+commit_log = CommitLogCache()
+file_history_analyzer = FileHistoryAnalyzer(result_store)
+embedder = Embedder(result_store)
 
 app.add_middleware(
     CORSMiddleware,
@@ -24,23 +86,86 @@ app.add_middleware(
 )
 
 
-def init_graph(repo: git.Repo):
-    metadata_extractor = CommitMetadataExtractorNode(repo)
-    code_analyzer = CodeChangeAnalyzerNode()
-    fix_suggester = FixSuggesterNode()
-    store_results = StoreResultsNode()
+@app.middleware("http")
+async def trace_requests(request: Request, call_next):
+    """Give every request an id (taken from X-Request-ID if sent) and a span covering it"""
+    token = request_id.set(request.headers.get("x-request-id") or new_request_id())
+    try:
+        with span("http", request.method) as trace:
+            response = await call_next(request)
+            # The route template, not the raw path, keeps the metric labels bounded
+            route = getattr(request.scope.get("route"), "path", "unmatched")
+            trace.rename(f"{request.method} {route}")
+            trace.set("status_code", response.status_code)
+            if response.status_code >= 500:
+                trace.status = "error"
+        HTTP_REQUESTS.inc(method=request.method, route=route, status=response.status_code)
+        response.headers["X-Request-ID"] = request_id.get()
+        return response
+    finally:
+        request_id.reset(token)
+
+
+def timed_node(name: str, node):
+    """Wrap a node so its wall time is recorded in state["timings"] and traced as a span
+
+    Nodes taking a second argument also get the run's config, which carries the repo to read.
+    """
+    takes_config = len(inspect.signature(node).parameters) > 1
+
+    async def run(state: GraphState, config: "RunnableConfig") -> dict:
+        start = time.perf_counter()
+        with span("node", name, commit=state.get("commit_hash")):
+            update = await (node(state, config) if takes_config else node(state))
+        return {**(update or {}), "timings": {name: round(time.perf_counter() - start, 4)}}
+    return run
+
+
+@functools.cache
+def pipeline_nodes() -> dict:
+    """The nodes of the pipeline, built on first use and shared by every graph and request"""
+    return {
+        "metadata_extractor": CommitMetadataExtractorNode(store=result_store, pool=repo_pool).extract_metadata,
+        "code_analyzer": CodeChangeAnalyzerNode(result_store).analyze_changes,
+        "fix_suggester": FixSuggesterNode().suggest_fix,
+        "report_merger": ReportMergerNode().merge_reports,
+    }
+
+
+@functools.cache
+def get_graph(mode: PipelineMode = "linear", merge: bool = False, is_range: bool = False):
+    """
+    The compiled pipeline for a mode, built once
+
+    The repo to analyze is passed per run: `config={"configurable": {"repo": repo}}`.
+    """
+    from langgraph.graph import StateGraph, END
+
+    nodes = pipeline_nodes()
+    store_results = StoreResultsNode(result_cache, CACHE_MODEL, cache_prompt_version(mode, merge, is_range), embedder)
 
     workflow = StateGraph(GraphState)
 
-    workflow.add_node("metadata_extractor", metadata_extractor.extract_metadata)
-    workflow.add_node("code_analyzer", code_analyzer.analyze_changes)
-    workflow.add_node("fix_suggester", fix_suggester.suggest_fix)
-    workflow.add_node("store_results", store_results.store_results)
+    for name in ("metadata_extractor", "code_analyzer", "fix_suggester"):
+        workflow.add_node(name, timed_node(name, nodes[name]))
+    workflow.add_node("store_results", timed_node("store_results", store_results.store_results))
 
     workflow.set_entry_point("metadata_extractor")
-    workflow.add_edge("metadata_extractor", "code_analyzer")
-    workflow.add_edge("code_analyzer", "fix_suggester")
-    workflow.add_edge("fix_suggester", "store_results")
+    if mode == "parallel":
+        # The bug/fix pass only needs the diff and commit message, so it runs
+        # next to the summary pass instead of waiting for it
+        workflow.add_edge("metadata_extractor", "code_analyzer")
+        workflow.add_edge("metadata_extractor", "fix_suggester")
+        if merge:
+            workflow.add_node("report_merger", timed_node("report_merger", nodes["report_merger"]))
+            workflow.add_edge(["code_analyzer", "fix_suggester"], "report_merger")
+            workflow.add_edge("report_merger", "store_results")
+        else:
+            workflow.add_edge(["code_analyzer", "fix_suggester"], "store_results")
+    else:
+        workflow.add_edge("metadata_extractor", "code_analyzer")
+        workflow.add_edge("code_analyzer", "fix_suggester")
+        workflow.add_edge("fix_suggester", "store_results")
     workflow.add_edge("store_results", END)
 
     graph = workflow.compile()
@@ -48,24 +173,29 @@ def init_graph(repo: git.Repo):
     return graph
 
 
-async def main():
+async def main(repo_url: str):
     initial_state = GraphState(
+        repo_url=repo_url,
         commit_hash="90e5a21687fef349a765562ccb33600afec28d04",
         commit_metadata=None, # type: ignore
         analysis=None,
         fix_suggestion=None,
-        user_query="How can I improve this code?"
+        user_query="How can I improve this code?",
+        pipeline_mode=DEFAULT_PIPELINE_MODE,
+        token_budget=None,
+        timings={},
+        prompt_tokens={},
     )
 
-    graph = init_graph(REPO_PATH)
+    graph = get_graph(DEFAULT_PIPELINE_MODE)
+    config = {"configurable": {"repo": await repo_pool.get(repo_url)}}
 
-    print("🔄 ---Running LangGraph pipeline---")
+    logger.info("🔄 ---Running LangGraph pipeline---")
     final_state = None
-    async for s in graph.astream(initial_state):
-        # s is a dictionary where keys are node names and values are their outputs
-        print(f"\nState after node {list(s.keys())[0]}:")
-        print(s)
-        final_state = s[list(s.keys())[0]] # Get the state from the last executed node
+    async for s in graph.astream(initial_state, config, stream_mode="values"):
+        # s is the full state after each step
+        log_content(logger, "State after step", s)
+        final_state = s
     
     print("\n🟥 ---FINAL STATE---")
     if final_state:
@@ -74,89 +204,423 @@ async def main():
         print(f"Analysis: {final_state.get('analysis')}")
         print(f"Fix Suggestion: {final_state.get('fix_suggestion')}")
         print(f"User Query: {final_state.get('user_query')}")
+        print(f"Timings: {final_state.get('timings')}")
     else:
         print("Graph execution did not produce a final state.")
 
 # Example of how to run the graph (for testing purposes)
 if __name__ == "__main__":
-    asyncio.run(main())
-    delete_cloned_repo(REPO_PATH)
+    import sys
+    asyncio.run(main(sys.argv[1]))
 
 
 # FastAPI Endpoints
 class AnalyzeCommitRequest(BaseModel):
-    commit_hash: Optional[str]
+    commit_hash: Optional[str] = None
+    repo_url: str
+    # Instead of one commit, analyze "base..head" or everything a merge commit brought in as one change set
+    rev_range: Optional[str] = None
+    pipeline_mode: Optional[PipelineMode] = None
+    # Parallel mode only: reconcile the fix suggestions with the analysis afterwards
+    merge: bool = False
+    # Tokens of diff per prompt; context lines are trimmed to fit (CTM_PROMPT_TOKEN_BUDGET by default)
+    token_budget: Optional[int] = None
+
+class FileHistoryRequest(BaseModel):
     repo_url: str
+    # Path of the file at the end of the range; earlier names are followed through renames
+    path: str
+    # Revision or range to walk, e.g. "v1.2..v1.3" (the whole history up to HEAD by default)
+    rev_range: Optional[str] = None
+    # Newest commits to cover, at most CTM_FILE_HISTORY_MAX_COMMITS
+    max_commits: Optional[int] = None
+    token_budget: Optional[int] = None
 
 class QueryRequest(BaseModel):
     query: str
+    # Only search this repo's analyses
+    repo_url: Optional[str] = None
+    limit: int = 10
 
-
-
-@app.post("/analyze-commit")
-async def analyze_commit_endpoint(request: AnalyzeCommitRequest):
-    print("🔄 ---Running LangGraph pipeline---")
+class BatchAnalyzeRequest(BaseModel):
+    repo_url: str
+    # Either a revision range such as "v1.2..v1.3" or an explicit list of hashes
+    rev_range: Optional[str] = None
+    commit_hashes: Optional[list[str]] = None
+    pipeline_mode: Optional[PipelineMode] = None
+    merge: bool = False
+
+class RmRepoRequest(BaseModel):
+    repo_url: Optional[str] = None
+
+
+
+async def get_cached_result(repo_url: str, commit_hash: str, prompt_version: str) -> Optional[dict]:
+    start = time.perf_counter()
+    cached = await asyncio.to_thread(result_cache.get, repo_url, commit_hash.lower(), CACHE_MODEL, prompt_version)
+    if cached:
+        logger.info("⚡ Cache hit for %s", commit_hash)
+        cached["timings"] = {"cache": round(time.perf_counter() - start, 4)}
+    return cached
+
+
+def resolve_commit(repo: git.Repo, commit_hash: Optional[str]) -> str:
+    """Resolve an optional, possibly abbreviated commit hash to a full hash (HEAD if None)"""
+    if commit_hash is None:
+        return get_most_recent_commit(repo).hexsha
+    return repo.commit(commit_hash).hexsha
+
+
+def resolve_range(repo: git.Repo, rev_range: str) -> str:
+    """
+    Resolve "base..head" (or "base...head") or a merge commit to the "<base>..<head>" key of a range analysis
+
+    A range starts at the merge base of its ends, so a branch is compared with
+    where it forked off; a merge commit covers what it merged into its first parent.
+    """
+    if ".." in rev_range:
+        base, head = rev_range.replace("...", "..").split("..", 1)
+        head = repo.commit(head or "HEAD").hexsha
+        merge_bases = repo.merge_base(base or "HEAD", head)
+        if not merge_bases:
+            raise ValueError(f"{base} and {head} have no common history")
+        base = merge_bases[0].hexsha
+    else:
+        commit = repo.commit(rev_range)
+        if len(commit.parents) < 2:
+            raise ValueError(f"{rev_range} is not a merge commit, pass a base..head range instead")
+        base, head = commit.parents[0].hexsha, commit.hexsha
+    if base == head:
+        raise ValueError(f"{rev_range} contains no commits")
+    return f"{base}..{head}"
+
+
+def range_head(rev_range: str) -> str:
+    """The revision a range ends at, which the mirror must contain"""
+    return rev_range.rsplit("..", 1)[-1].lstrip(".") or "HEAD"
+
+
+async def analysis_events(request: AnalyzeCommitRequest):
+    """
+    Run the analysis pipeline for a request, yielding (event, payload) pairs as results become available
+
+    Events are "metadata" (commit metadata, as soon as the extractor finishes),
+    "delta" ({"field", "text"} pieces of the analysis or fix suggestion as the
+    LLM generates them) and finally "result" (the complete response).
+    Request errors (bad repo, bad commit) raise HTTPException before the first event.
+    """
+    start = time.perf_counter()
+    mode = request.pipeline_mode or DEFAULT_PIPELINE_MODE
+    merge = request.merge and mode == "parallel"
+    prompt_version = cache_prompt_version(mode, merge, bool(request.rev_range), request.token_budget)
+
+    # Full hashes can be answered from the cache before touching git at all
+    looked_up = None
+    if not request.rev_range and is_full_commit_hash(request.commit_hash):
+        looked_up = request.commit_hash.lower()
+        cached = await get_cached_result(request.repo_url, request.commit_hash, prompt_version)
+        if cached:
+            yield "metadata", cached["commit_metadata"]
+            yield "result", {**cached, "pipeline_mode": mode}
+            return
+
+    logger.info("🔄 ---Running LangGraph pipeline---")
     try:
-        repo = clone_repo(request.repo_url, REPO_PATH)
+        lease = await lease_repo(request.repo_url, range_head(request.rev_range) if request.rev_range else request.commit_hash)
     except git.InvalidGitRepositoryError:
-        print(f"Error: Not a valid Git repository at {request.repo_url}")
+        logger.error("Not a valid Git repository at %s", request.repo_url)
         raise HTTPException(status_code=400, detail=f"Not a valid Git repository at {request.repo_url}")
     except Exception as e:
-        print(f"Error initializing GitPython Repo: {e}")
+        logger.error("Error initializing GitPython Repo: %s", e)
         raise HTTPException(status_code=500, detail=f"Error initializing GitPython Repo: {e}")
-        
-    if request.commit_hash is None:
-        commit = get_most_recent_commit(repo)
-        request.commit_hash = commit.hexsha
+
+    # The mirror can't be deleted or re-cloned while the pipeline reads it
+    try:
+        async for event in pipeline_events(request, lease.repo, mode, merge, prompt_version, start, looked_up):
+            yield event
+    finally:
+        lease.release()
+
+
+async def pipeline_events(request: AnalyzeCommitRequest, repo: git.Repo, mode: PipelineMode, merge: bool,
+                          prompt_version: str, start: float, looked_up: Optional[str] = None):
+    """
+    The part of analysis_events that needs the repo: resolve the commit, then run the graph
+
+    `looked_up` is the hash analysis_events already missed the cache for; it isn't looked up twice.
+    """
+    try:
+        if request.rev_range:
+            request.commit_hash = await run_git(resolve_range, repo, request.rev_range)
+        else:
+            request.commit_hash = await run_git(resolve_commit, repo, request.commit_hash)
+    except (git.exc.BadName, git.exc.GitCommandError, ValueError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid commit hash or range: {e}")
+
+    # Abbreviated hashes and HEAD can still skip the LLM calls once resolved
+    cached = None
+    if request.commit_hash != looked_up:
+        cached = await get_cached_result(request.repo_url, request.commit_hash, prompt_version)
+    if cached:
+        commit_range = split_range_key(request.commit_hash)
+        if commit_range:
+            # Only the rendered attribution is stored; the structured list is cheap to list again
+            cached["commit_metadata"]["commits"], _ = await run_git(read_range_commits, repo, *commit_range)
+        yield "metadata", cached["commit_metadata"]
+        yield "result", {**cached, "pipeline_mode": mode}
+        return
     
     initial_state_api = GraphState(
+        repo_url=request.repo_url,
         commit_hash=request.commit_hash,
         commit_metadata=None, # type: ignore
         analysis=None,
         fix_suggestion=None,
         user_query=None,
+        pipeline_mode=mode,
+        token_budget=request.token_budget,
+        timings={},
+        prompt_tokens={},
     )
 
-    graph = init_graph(repo)
-    
+    graph = get_graph(mode, merge, bool(request.rev_range))
+    config = {"recursion_limit": 10, "configurable": {"repo": repo}}
+
     final_api_state = None
     try:
-        async for s in graph.astream(initial_state_api, {"recursion_limit": 10}): # Added recursion_limit for safety
-            # The final state is the accumulation of all node outputs
-            # We need to merge the states from the stream
-            if final_api_state is None:
-                final_api_state = {}
-            final_api_state.update(s[list(s.keys())[0]])
-            print("✅ Processed node: ", s[list(s.keys())[0]])
-
-        if final_api_state and final_api_state.get("commit_metadata") and final_api_state.get("commit_metadata").get("author") == "Error":
-             raise HTTPException(status_code=500, detail=f"Error processing commit: {final_api_state.get('commit_metadata').get('message')}")
-
-        # Ensure all expected keys are present, providing defaults if not
-        return {
+        # "values" yields the full state after each step, with parallel updates already merged;
+        # "custom" carries the LLM tokens the nodes write while generating
+        async for stream_mode, s in graph.astream(initial_state_api, config, stream_mode=["values", "custom"]):
+            if stream_mode == "custom":
+                yield "delta", s
+                continue
+
+            commit_metadata = s.get("commit_metadata")
+            if commit_metadata and not (final_api_state or {}).get("commit_metadata"):
+                if commit_metadata.get("author") == "Error":
+                    raise HTTPException(status_code=500, detail=f"Error processing commit: {commit_metadata.get('message')}")
+                yield "metadata", commit_metadata
+            final_api_state = s
+
+        result = {
             "commit_metadata": final_api_state.get("commit_metadata"),
             "analysis": final_api_state.get("analysis"),
             "fix_suggestion": final_api_state.get("fix_suggestion")
         }
+
+        timings = dict(final_api_state.get("timings") or {})
+        timings["total"] = round(time.perf_counter() - start, 4)
+        yield "result", {**result, "pipeline_mode": mode, "timings": timings,
+                         "prompt_tokens": final_api_state.get("prompt_tokens") or {}}
+    except HTTPException:
+        raise
+    except LLMError as e:
+        # Rate limited or provider down even after retries: worth trying again later
+        status_code = 503 if e.retryable else 502
+        raise HTTPException(status_code=status_code, detail=f"LLM backend error: {e}")
     except git.exc.GitCommandError as e:
         raise HTTPException(status_code=400, detail=f"Invalid commit hash or Git error: {e}")
     except Exception as e:
-        # Log the exception e for debugging
-        print(f"Unhandled error in analyze_commit_endpoint: {e}")
+        logger.exception("Unhandled error in analyze_commit_endpoint: %s", e)
         raise HTTPException(status_code=500, detail=f"An unexpected error occurred: {e}")
 
 
+@app.post("/analyze-commit")
+async def analyze_commit_endpoint(request: AnalyzeCommitRequest):
+    async for event, payload in analysis_events(request):
+        if event == "result":
+            return payload
+
+
+@app.post("/analyze-commit/stream")
+async def analyze_commit_stream_endpoint(request: AnalyzeCommitRequest):
+    """Same as /analyze-commit, but streamed as NDJSON events while the pipeline runs"""
+    return await ndjson_response(analysis_events(request))
+
+
+async def ndjson_response(events) -> StreamingResponse:
+    """Stream (event, payload) pairs as NDJSON; errors raised before the first event still get a proper status code"""
+    first = await events.__anext__()
+
+    async def ndjson():
+        yield json.dumps({"event": first[0], "data": first[1]}) + "\n"
+        try:
+            async for event, payload in events:
+                yield json.dumps({"event": event, "data": payload}) + "\n"
+        except HTTPException as e:
+            yield json.dumps({"event": "error", "data": {"status_code": e.status_code, "detail": e.detail}}) + "\n"
+
+    return StreamingResponse(ndjson(), media_type="application/x-ndjson")
+
+
+async def file_history_events(request: FileHistoryRequest):
+    """
+    Analyze how one file evolved, yielding (event, payload) pairs as results become available
+
+    Events are "history" (the commits that changed the file, oldest first, and
+    how many lines of the file at the end of the range each still owns), then
+    "commit" for each of them with its notes, "delta" pieces of the evolution
+    report and finally "result". Only the file's own patches are read, and
+    notes already stored for a patch are reused.
+    """
+    start = time.perf_counter()
+    rev = request.rev_range or "HEAD"
+    max_commits = max(1, min(request.max_commits or FILE_HISTORY_MAX_COMMITS, FILE_HISTORY_MAX_COMMITS))
+    try:
+        # The mirror is only needed to read the history; the LLM work runs after the lease is released
+        async with use_repo(request.repo_url, range_head(request.rev_range) if request.rev_range else None) as repo:
+            commits = await run_git(read_file_history, repo, request.path, rev, max_commits)
+            blame = await run_git(read_blame, repo, commits[-1]["path"], range_head(rev)) if commits else {}
+    except git.InvalidGitRepositoryError:
+        raise HTTPException(status_code=400, detail=f"Not a valid Git repository at {request.repo_url}")
+    except (git.exc.BadName, git.exc.GitCommandError, ValueError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid path or revision range: {e}")
+    except Exception as e:
+        logger.error("Error reading the history of %s: %s", request.path, e)
+        raise HTTPException(status_code=500, detail=f"Error reading file history: {e}")
+    if not commits:
+        raise HTTPException(status_code=404, detail=f"No commits changed {request.path} in {rev}")
+
+    for commit in commits:
+        commit["surviving_lines"] = blame.get(commit["hash"], 0)
+    history = {"path": request.path, "rev_range": rev, "lines": sum(blame.values())}
+    yield "history", {**history, "commits": [{k: v for k, v in commit.items() if k != "patch"} for commit in commits]}
+
+    analyzed = []
+    try:
+        partial = len(commits) == max_commits
+        async for event, payload in file_history_analyzer.events(commits, request.path, request.token_budget, partial):
+            if event == "commit":
+                analyzed.append(payload)
+            if event == "report":
+                summary = payload
+            else:
+                yield event, payload
+    except LLMError as e:
+        raise HTTPException(status_code=503 if e.retryable else 502, detail=f"LLM backend error: {e}")
+    yield "result", {**history, "commits": analyzed, **summary, "timings": {"total": round(time.perf_counter() - start, 4)}}
+
+
+@app.post("/file-history")
+async def file_history_endpoint(request: FileHistoryRequest):
+    async for event, payload in file_history_events(request):
+        if event == "result":
+            return payload
+
+
+@app.post("/file-history/stream")
+async def file_history_stream_endpoint(request: FileHistoryRequest):
+    """Same as /file-history, but streamed as NDJSON events while the notes and report are generated"""
+    return await ndjson_response(file_history_events(request))
+
+
+def resolve_batch_commits(repo: git.Repo, rev_range: Optional[str], commit_hashes: Optional[list[str]]) -> list[str]:
+    """Resolve a revision range or a list of hashes to unique full hashes, oldest first for ranges"""
+    if rev_range:
+        hashes = repo.git.rev_list("--reverse", f"--max-count={BATCH_MAX_COMMITS}", rev_range).split()
+    else:
+        hashes = [resolve_commit(repo, h) for h in commit_hashes[:BATCH_MAX_COMMITS]]
+    return list(dict.fromkeys(hashes))
+
+
+async def analyze_batch_commit(job: Job, commit_hash: str):
+    request = AnalyzeCommitRequest(repo_url=job.repo_url, commit_hash=commit_hash, **job.options)
+    async for _ in analysis_events(request):
+        pass
+
+
+job_queue = JobQueue(analyze_batch_commit)
+
+
+async def prewarm_analysis(repo_url: str, commit_hash: str):
+    request = AnalyzeCommitRequest(repo_url=repo_url, commit_hash=commit_hash)
+    async for _ in analysis_events(request):
+        pass
+
+
+def analyzed_with_defaults(repo_url: str, commit_hashes: list[str]) -> set[str]:
+    return result_cache.cached_hashes(repo_url, commit_hashes, CACHE_MODEL, cache_prompt_version(DEFAULT_PIPELINE_MODE, False))
+
+
+repo_indexer = RepoIndexer(result_store, repo_pool, prewarm_analysis, analyzed_with_defaults)
+
+
+async def lease_repo(repo_url: str, commit_hash: Optional[str] = None) -> RepoLease:
+    """
+    Lease the mirror of a repo; release it when done
+
+    A clone, or the background fetch of a stale mirror once it lands, queues
+    indexing of the repo's new commits.
+    """
+    lease = await repo_pool.lease(repo_url, commit_hash)
+    repo_indexer.notify(repo_url, repo_pool.generation(repo_url))
+    if lease.fetching is not None:
+        asyncio.wrap_future(lease.fetching).add_done_callback(lambda fetch: on_fetched(repo_url, fetch))
+    return lease
+
+
+def on_fetched(repo_url: str, fetch: asyncio.Future):
+    if fetch.cancelled():
+        return
+    if fetch.exception():
+        logger.error("Background fetch of %s failed: %s", repo_url, fetch.exception())
+        return
+    repo_indexer.notify(repo_url, repo_pool.generation(repo_url))
+
+
+@asynccontextmanager
+async def use_repo(repo_url: str, commit_hash: Optional[str] = None):
+    """`async with use_repo(url) as repo:` holds a lease on the mirror for the block"""
+    lease = await lease_repo(repo_url, commit_hash)
+    try:
+        yield lease.repo
+    finally:
+        lease.release()
+
+
+@app.post("/batch-analyze")
+async def batch_analyze_endpoint(request: BatchAnalyzeRequest):
+    if not request.rev_range and not request.commit_hashes:
+        raise HTTPException(status_code=400, detail="Either rev_range or commit_hashes is required")
+
+    try:
+        async with use_repo(request.repo_url) as repo:
+            commit_hashes = await run_git(resolve_batch_commits, repo, request.rev_range, request.commit_hashes)
+    except (git.exc.GitCommandError, git.exc.BadName, ValueError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid revision range or commit hash: {e}")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error resolving commits: {e}")
+
+    mode = request.pipeline_mode or DEFAULT_PIPELINE_MODE
+    merge = request.merge and mode == "parallel"
+    # Commits already in results.db are not analyzed again
+    cached = await asyncio.to_thread(result_cache.cached_hashes, request.repo_url, commit_hashes, CACHE_MODEL, cache_prompt_version(mode, merge))
+
+    job = job_queue.submit(request.repo_url, commit_hashes, cached, {"pipeline_mode": mode, "merge": merge})
+    logger.info("📦 Batch job %s: %d commits, %d already cached", job.id, len(commit_hashes), len(cached))
+    return {"job_id": job.id, "status": job.status, "total": len(commit_hashes), "cached": len(cached)}
+
+
+@app.get("/jobs/{job_id}")
+async def job_status_endpoint(job_id: str):
+    job = job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Unknown job {job_id}")
+    return job.to_dict()
+
+
 @app.get("/commits")
-async def get_commits_endpoint(repo_url: str, count: int = 10):
-    print(f"🔄 ---Getting commits from {repo_url}---")
+async def get_commits_endpoint(repo_url: str, count: int = 10, after: Optional[str] = None,
+                               branch: Optional[str] = None, path: Optional[str] = None, author: Optional[str] = None):
+    """List commits newest first; pass the last hash of a page as `after` to get the next one"""
+    logger.debug("🔄 ---Getting commits from %s---", repo_url)
+    count = max(1, min(count, MAX_COMMITS_PAGE))
     try:
-        repo = clone_repo(repo_url, REPO_PATH)
-        commits = list(repo.iter_commits(max_count=count))
-        commit_list = [
-            {"hash": commit.hexsha, "message": commit.message.strip(), "author": commit.author.name, "date": commit.authored_datetime.isoformat()}
-            for commit in commits
-        ]
-        return commit_list
+        async with use_repo(repo_url) as repo:
+            return await run_git(commit_log.page, repo, repo_pool.generation(repo_url), count,
+                                 after=after, branch=branch, path=path, author=author)
+    except (ValueError, git.exc.GitCommandError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid cursor, branch or filter: {e}")
     except git.InvalidGitRepositoryError:
         raise HTTPException(status_code=500, detail="Not a valid Git repository")
     except Exception as e:
@@ -165,15 +629,36 @@ async def get_commits_endpoint(repo_url: str, count: int = 10):
 
 @app.post("/query")
 async def query_endpoint(request: QueryRequest):
-    # Placeholder for user-written queries
-    # This will be implemented later
-    return {"message": "Query endpoint not yet implemented", "received_query": request.query}
+    """Search everything already analyzed; the only Gemini call embeds the query"""
+    start = time.perf_counter()
+    limit = max(1, min(request.limit, MAX_QUERY_RESULTS))
+    query_vector = await embedder.embed_query(request.query)
+    results = await asyncio.to_thread(result_store.search, request.query, request.repo_url, limit,
+                                      query_vector, embedder.stored_model)
+    return {"query": request.query, "results": results, "took": round(time.perf_counter() - start, 4)}
 
 
 @app.post("/rm-repo")
-async def rm_repo_endpoint():
-    delete_cloned_repo(REPO_PATH)
-    return {"message": "Repo deleted successfully"}
+async def rm_repo_endpoint(request: Optional[RmRepoRequest] = None):
+    # Without a repo_url every mirror that isn't in use is deleted
+    if request and request.repo_url:
+        try:
+            # Waits for running analyses of the repo to finish first
+            await asyncio.to_thread(repo_pool.remove, request.repo_url)
+        except RepoBusyError as e:
+            raise HTTPException(status_code=409, detail=str(e))
+        return {"message": "Repo deleted successfully"}
+    removed, busy = await asyncio.to_thread(repo_pool.clear)
+    return {"message": "Repo deleted successfully", "removed": removed, "in_use": busy}
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    """Span timings, HTTP and LLM counters in the Prometheus text format"""
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+@app.get("/cache-stats")
+async def cache_stats_endpoint():
+    return {**await asyncio.to_thread(result_cache.stats), "prefetch": repo_indexer.stats()}
 
 @app.get("/")
 async def root():
@@ -1,15 +1,40 @@
-from typing import TypedDict, Optional
+import operator
+from typing import Annotated, Literal, NotRequired, TypedDict, Optional
+
+# linear: analysis, then fix suggestions based on it
+# parallel: analysis and fix suggestions run side by side from the diff
+PipelineMode = Literal["linear", "parallel"]
 
 class CommitMetadata(TypedDict):
+    hash: str
     author: str
     date: str
     message: str
     diff: str
     files_changed: list[str]
+    # path -> additions, deletions, binary, renamed_from
+    file_stats: dict[str, dict]
+    # Range analyses only: the commits of the range, oldest first, each with the files it touched
+    commits: NotRequired[list[dict]]
 
 class GraphState(TypedDict):
+    repo_url: str
+    # A full hash, or "<base>..<head>" to analyze a range of commits as one change set
     commit_hash: str
     commit_metadata: CommitMetadata
     analysis: Optional[str]
     fix_suggestion: Optional[str]
-    user_query: Optional[str]
\ No newline at end of file
+    user_query: Optional[str]
+    pipeline_mode: PipelineMode
+    # Tokens of diff a prompt should carry; context lines are trimmed to fit (CTM_PROMPT_TOKEN_BUDGET if None)
+    token_budget: Optional[int]
+    # Seconds spent per node; merged across nodes (parallel nodes write in the same step)
+    timings: Annotated[dict[str, float], operator.or_]
+    # Diff compaction per prompting node (CompactionStats.to_dict()), merged like timings
+    prompt_tokens: Annotated[dict[str, dict], operator.or_]
+
+
+def stream_writer():
+    """Writer of the running graph's "custom" stream; langgraph is only imported once a graph runs"""
+    from langgraph.config import get_stream_writer
+    return get_stream_writer()
@@ -0,0 +1,499 @@
+import asyncio
+import contextvars
+import git
+import hashlib
+import logging
+import os
+import re
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Optional
+
+from concurrency import run_git
+from function_utils import normalize_repo_url, delete_cloned_repo, resolve_default_branch, is_full_commit_hash
+from telemetry import span
+
+logger = logging.getLogger(__name__)
+
+# Touched on every use; its mtime drives LRU eviction and survives restarts
+LAST_USED_MARKER = "ctm-last-used"
+
+# full: every object; blobless: commits and trees, blobs fetched on demand;
+# treeless: commits only; shallow: the last CTM_SHALLOW_DEPTH commits of the default branch
+CLONE_STRATEGIES = ("full", "blobless", "treeless", "shallow")
+# Background fetches running at once, across all mirrors
+FETCH_CONCURRENCY = int(os.environ.get("CTM_FETCH_CONCURRENCY", 2))
+# Commits a shallow mirror may be deepened to while looking for a requested commit
+SHALLOW_MAX_DEPTH = int(os.environ.get("CTM_SHALLOW_MAX_DEPTH", 1000))
+# How long deleting a mirror waits for the requests using it to finish
+REMOVE_TIMEOUT = float(os.environ.get("CTM_REMOVE_TIMEOUT_SECONDS", 30))
+# Threads for leases waiting on a mirror lock; a wait only lasts while that mirror is cloned or deleted
+LOCK_WAIT_THREADS = 32
+
+
+class RepoBusyError(Exception):
+    """A mirror is still leased and could not be deleted within the timeout"""
+
+
+class RWLock:
+    """Reader/writer lock that doesn't care which thread releases it
+
+    Leases are taken on the event loop or a lock-wait thread and released
+    wherever the request finishes, so ownership can't be tied to a thread. Waiting writers block new
+    readers, so a delete is not starved by a steady stream of requests.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self.readers = 0
+        self._writer = False
+        self._writers_waiting = 0
+
+    def acquire_read(self, yield_to_writers: bool = True, timeout: Optional[float] = None) -> bool:
+        with self._cond:
+            if not self._cond.wait_for(lambda: not self._writer and not (yield_to_writers and self._writers_waiting), timeout):
+                return False
+            self.readers += 1
+            return True
+
+    def release_read(self):
+        with self._cond:
+            self.readers -= 1
+            if not self.readers:
+                self._cond.notify_all()
+
+    def acquire_write(self, timeout: Optional[float] = None) -> bool:
+        with self._cond:
+            self._writers_waiting += 1
+            try:
+                if not self._cond.wait_for(lambda: not self._writer and not self.readers, timeout):
+                    return False
+                self._writer = True
+                return True
+            finally:
+                self._writers_waiting -= 1
+                # Readers held back by this writer may go ahead if it gave up
+                self._cond.notify_all()
+
+    def release_write(self):
+        with self._cond:
+            self._writer = False
+            self._cond.notify_all()
+
+
+class _Mirror:
+    """Per-mirror state: the lock guarding its directory and its single in-flight fetch"""
+
+    def __init__(self, path: str):
+        self.path = path
+        # Leases read the mirror; clones and deletes rewrite it
+        self.lock = RWLock()
+        self.fetch_guard = threading.Lock()
+        self.fetch: Optional[Future] = None
+        # Held by every git fetch into the mirror: two at once race on shallow.lock and the ref locks
+        self.fetch_lock = threading.Lock()
+        self.last_fetch = 0.0
+        # Bumped whenever the refs may have changed, so ref-keyed caches know to refresh
+        self.generation = 0
+        # Bytes on disk, measured after each clone and fetch (None until measured)
+        self.size: Optional[int] = None
+
+    def exists(self) -> bool:
+        return os.path.exists(os.path.join(self.path, 'HEAD'))
+
+
+class RepoLease:
+    """A mirror handed out by the pool; it won't be deleted or re-cloned until released"""
+
+    def __init__(self, mirror: _Mirror, repo: git.Repo, fetching: Optional[Future] = None):
+        self.repo = repo
+        # Background fetch started for this lease, if the mirror was stale
+        self.fetching = fetching
+        self._mirror = mirror
+        self._released = False
+        self._release_lock = threading.Lock()
+
+    def release(self):
+        with self._release_lock:
+            if self._released:
+                return
+            self._released = True
+        self._mirror.lock.release_read()
+
+    def __enter__(self) -> git.Repo:
+        return self.repo
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class RepoPool:
+    """Pool of bare mirrors, one directory per normalized repo URL
+
+    Every user of a mirror holds a lease (a read lock), so clones, evictions and
+    deletes (write locks) never pull a directory out from under a running
+    analysis. Existing mirrors are refreshed with an incremental `git fetch` in
+    the background; concurrent requests share one in-flight fetch per mirror.
+    When the pool grows past its disk budget the least recently used idle
+    mirrors are deleted.
+    """
+
+    def __init__(self, root: str, budget_bytes: Optional[int] = None, fetch_interval: Optional[float] = None,
+                 strategy: Optional[str] = None, shallow_depth: Optional[int] = None, max_depth: int = SHALLOW_MAX_DEPTH):
+        self.root = root
+        self.strategy = strategy or os.environ.get("CTM_CLONE_STRATEGY", "full")
+        if self.strategy not in CLONE_STRATEGIES:
+            raise ValueError(f"Unknown clone strategy {self.strategy!r}, expected one of {CLONE_STRATEGIES}")
+        self.shallow_depth = shallow_depth or int(os.environ.get("CTM_SHALLOW_DEPTH", 50))
+        self.max_depth = max_depth
+        self.budget_bytes = budget_bytes if budget_bytes is not None else int(os.environ.get("CTM_REPO_POOL_BUDGET_MB", 2048)) * 1024 * 1024
+        # Skip the network round trip if the mirror was fetched this recently
+        self.fetch_interval = fetch_interval if fetch_interval is not None else float(os.environ.get("CTM_FETCH_INTERVAL_SECONDS", 60))
+        # The pool lock only guards the mirror table; each mirror has its own locks
+        self._lock = threading.Lock()
+        self._mirror_states: dict[str, _Mirror] = {}
+        # Fetches get their own threads, so a request waiting on one never ties up a git worker it needs
+        self._fetch_executor = ThreadPoolExecutor(max_workers=FETCH_CONCURRENCY, thread_name_prefix="ctm-fetch")
+        # The same goes for lock waits: a request queued behind one mirror's clone must not hold up other repos
+        self._lock_wait_executor = ThreadPoolExecutor(max_workers=LOCK_WAIT_THREADS, thread_name_prefix="ctm-lock-wait")
+        os.makedirs(self.root, exist_ok=True)
+        # Mirrors left by a previous run count against the budget too; they are measured on the first check
+        for path in self._mirrors():
+            self._mirror(path)
+
+    def mirror_path(self, repo_url: str) -> str:
+        """Directory of the mirror for a repo URL, readable but collision free"""
+        normalized = normalize_repo_url(repo_url)
+        slug = re.sub(r'[^A-Za-z0-9._-]+', '_', normalized.split('://')[-1])[-60:].strip('_')
+        digest = hashlib.sha1(normalized.encode()).hexdigest()[:12]
+        return os.path.join(self.root, f"{slug}-{digest}")
+
+    def _mirror(self, path: str) -> _Mirror:
+        with self._lock:
+            mirror = self._mirror_states.get(path)
+            if mirror is None:
+                mirror = self._mirror_states[path] = _Mirror(path)
+            return mirror
+
+    async def lease(self, repo_url: str, commit_hash: Optional[str] = None) -> RepoLease:
+        """Lease a mirror of a repository, cloning it if needed
+
+        A stale mirror is handed out as is while a fetch runs in the background;
+        only a request for a commit the mirror doesn't have waits for the fetch.
+        Lock waits and fetches are awaited without holding one of the
+        CTM_GIT_CONCURRENCY git workers; only clones and object lookups are
+        run with run_git. A slow clone or fetch of one repo therefore never
+        keeps leases of other repos waiting. Outside the event loop, use
+        asyncio.run(pool.lease(...)).
+
+        Args:
+            repo_url: URL of the repository
+            commit_hash: Commit the caller needs; waits for a fetch if it is missing locally
+
+        Returns:
+            RepoLease: Release it (or use it as a context manager) when done with the repo
+        """
+        mirror = self._mirror(self.mirror_path(repo_url))
+        cloned = False
+        while True:
+            await self._wait_for_lock(mirror.lock.acquire_read, mirror.lock.release_read)
+            if mirror.exists():
+                break
+            mirror.lock.release_read()
+            await self._wait_for_lock(mirror.lock.acquire_write, mirror.lock.release_write)
+            # Shielded: the clone releases the write lock when it finishes, even if this request is cancelled
+            cloned = await asyncio.shield(run_git(self._clone_locked, repo_url, mirror))
+
+        try:
+            repo = git.Repo(mirror.path)
+            fetching = None
+            if commit_hash and not await run_git(has_commit, repo, commit_hash):
+                # A fetch already in flight may have been started for another commit; then fetch again
+                for _ in range(2):
+                    await asyncio.wrap_future(self._start_fetch(repo_url, mirror, commit_hash))
+                    if await run_git(has_commit, repo, commit_hash):
+                        break
+            elif time.time() - mirror.last_fetch > self.fetch_interval:
+                fetching = self._start_fetch(repo_url, mirror)
+            else:
+                logger.debug("✅ Mirror of %s is fresh, skipping fetch", repo_url)
+            self._touch(mirror.path)
+        except BaseException:
+            mirror.lock.release_read()
+            raise
+
+        if cloned:
+            await asyncio.to_thread(self._evict, keep=mirror.path)
+        return RepoLease(mirror, repo, fetching)
+
+    async def lease_existing(self, repo_url: str) -> Optional[RepoLease]:
+        """Lease the existing mirror of repo_url as it is, without fetching; None if there is none
+
+        The lock is awaited without holding a git worker.
+        """
+        mirror = self._mirror(self.mirror_path(repo_url))
+        await self._wait_for_lock(mirror.lock.acquire_read, mirror.lock.release_read)
+        if not mirror.exists():
+            mirror.lock.release_read()
+            return None
+        return RepoLease(mirror, git.Repo(mirror.path))
+
+    async def _wait_for_lock(self, acquire, release):
+        """Take a mirror lock, waiting on a lock-wait thread if it is not free right away"""
+        if acquire(timeout=0):
+            return
+        waiting = self._lock_wait_executor.submit(acquire)
+        try:
+            await asyncio.wrap_future(waiting)
+        except asyncio.CancelledError:
+            # The abandoned wait still gets the lock eventually; hand it straight back
+            waiting.add_done_callback(lambda wait: wait.cancelled() or wait.exception() or release())
+            raise
+
+    async def get(self, repo_url: str, commit_hash: Optional[str] = None) -> git.Repo:
+        """A mirror without holding a lease; for scripts and tools, not concurrent request handling"""
+        with await self.lease(repo_url, commit_hash) as repo:
+            return repo
+
+    def fetch(self, repo_url: str):
+        """Fetch an existing mirror now, joining a fetch that is already running"""
+        mirror = self._mirror(self.mirror_path(repo_url))
+        self._start_fetch(repo_url, mirror).result()
+
+    def fetch_objects(self, repo_url: str, fetch: Callable[..., Any], *args) -> Future:
+        """
+        Run `fetch(repo, *args)`, which fetches objects a request needs, on the fetch executor
+
+        It never overlaps another fetch into the same mirror (the refresh included),
+        and waiting for it doesn't hold a git worker. The caller must hold a lease.
+        """
+        mirror = self._mirror(self.mirror_path(repo_url))
+        context = contextvars.copy_context()
+        return self._fetch_executor.submit(context.run, self._fetch_objects, mirror, fetch, args)
+
+    @staticmethod
+    def _fetch_objects(mirror: _Mirror, fetch: Callable[..., Any], args: tuple):
+        with mirror.fetch_lock, span("git", "fetch_objects"):
+            return fetch(git.Repo(mirror.path), *args)
+
+    def _start_fetch(self, repo_url: str, mirror: _Mirror, commit_hash: Optional[str] = None) -> Future:
+        """Single flight: start a fetch unless one is running, and return the running one"""
+        with mirror.fetch_guard:
+            if mirror.fetch is None or mirror.fetch.done():
+                # The fetch thread keeps the request id and trace of whoever started it
+                context = contextvars.copy_context()
+                mirror.fetch = self._fetch_executor.submit(context.run, self._fetch, repo_url, mirror, commit_hash)
+            return mirror.fetch
+
+    def _fetch(self, repo_url: str, mirror: _Mirror, commit_hash: Optional[str]):
+        # A read lock, so the mirror isn't deleted mid-fetch; git itself keeps concurrent readers consistent.
+        # Leases may be waiting on this fetch, so it must not queue behind a delete that waits on them
+        mirror.lock.acquire_read(yield_to_writers=False)
+        try:
+            if not mirror.exists():
+                return
+            repo = git.Repo(mirror.path)
+            logger.info("🔄 Fetching updates into %s", mirror.path)
+            with mirror.fetch_lock:
+                # Tags in a shallow mirror would pull in the history behind every tag
+                tags = "--no-tags" if is_shallow(repo) else "--tags"
+                with span("git", "fetch"):
+                    repo.git.fetch("origin", "--prune", tags)
+                mirror.last_fetch = time.time()
+                mirror.generation += 1
+                if commit_hash and not has_commit(repo, commit_hash) and is_shallow(repo):
+                    self._deepen_until_found(repo, commit_hash)
+            mirror.size = directory_size(mirror.path)
+        finally:
+            mirror.lock.release_read()
+        self._evict(keep=mirror.path)
+
+    def _clone_locked(self, repo_url: str, mirror: _Mirror) -> bool:
+        """Clone the mirror unless it exists by now and release the write lock held for it; True if cloned"""
+        # One clone per mirror: whoever gets the write lock first clones, the rest find it done
+        try:
+            if mirror.exists():
+                return False
+            self._clone(repo_url, mirror)
+            return True
+        finally:
+            mirror.lock.release_write()
+
+    def _clone(self, repo_url: str, mirror: _Mirror) -> git.Repo:
+        path = mirror.path
+        logger.info("📥 Cloning %s into mirror %s (%s clone)", repo_url, path, self.strategy)
+        options = {"bare": True}
+        branches = "*"
+        if self.strategy == "blobless":
+            options["filter"] = "blob:none"
+        elif self.strategy == "treeless":
+            options["filter"] = "tree:0"
+        elif self.strategy == "shallow":
+            # One ls-remote instead of trying clones until a branch name works
+            branch = resolve_default_branch(repo_url)
+            options.update(depth=self.shallow_depth, single_branch=True)
+            if branch:
+                options["branch"] = branch
+                branches = branch
+
+        try:
+            with span("git", "clone", strategy=self.strategy):
+                repo = git.Repo.clone_from(repo_url, path, **options)
+        except Exception as e:
+            logger.error("❌ Repo cloning failed: %s", e)
+            delete_cloned_repo(path)
+            raise e
+        # Bare clones have no fetch refspec; track branches directly so fetch updates them
+        repo.git.config("remote.origin.fetch", f"+refs/heads/{branches}:refs/heads/{branches}")
+        mirror.last_fetch = time.time()
+        mirror.generation += 1
+        mirror.size = directory_size(path)
+        logger.info("✅ Repo cloned successfully: %s", path)
+        return repo
+
+    def generation(self, repo_url: str) -> int:
+        """Counter that changes every time the mirror of repo_url is cloned or fetched"""
+        return self._mirror(self.mirror_path(repo_url)).generation
+
+    def leases(self, repo_url: str) -> int:
+        """How many leases of the mirror of repo_url are held right now"""
+        return self._mirror(self.mirror_path(repo_url)).lock.readers
+
+    def _deepen_until_found(self, repo: git.Repo, commit_hash: str):
+        """
+        Deepen a shallow mirror on demand until it contains a requested commit
+
+        A mistyped or made-up hash must not turn the mirror into a full clone:
+        the search stops when the server says it has no such object, and the
+        mirror is never deepened past CTM_SHALLOW_MAX_DEPTH commits.
+        """
+        if is_full_commit_hash(commit_hash):
+            try:
+                # Fetch just the commit and its parent when the server allows fetching by SHA
+                repo.git.fetch("origin", commit_hash, depth=2)
+                return
+            except git.GitCommandError as e:
+                if "not our ref" in str(e):
+                    logger.info("Remote has no commit %s, not deepening the mirror", commit_hash)
+                    return
+
+        deepen = self.shallow_depth
+        while not has_commit(repo, commit_hash) and is_shallow(repo):
+            depth = int(repo.git.rev_list("--count", "--all"))
+            if depth >= self.max_depth:
+                logger.warning("Commit %s not found within %d commits of the shallow mirror", commit_hash, depth)
+                return
+            deepen = min(deepen, self.max_depth - depth)
+            logger.info("📥 Deepening shallow mirror by %d commits to find %s", deepen, commit_hash)
+            repo.git.fetch("origin", deepen=deepen)
+            deepen *= 2
+
+    def _touch(self, path: str):
+        marker = os.path.join(path, LAST_USED_MARKER)
+        with open(marker, 'a'):
+            pass
+        os.utime(marker)
+
+    def _mirrors(self) -> list[str]:
+        return [
+            os.path.join(self.root, name) for name in os.listdir(self.root)
+            if os.path.exists(os.path.join(self.root, name, 'HEAD'))
+        ]
+
+    def disk_usage(self) -> int:
+        """Bytes used by all mirrors, from the sizes measured after each clone and fetch"""
+        with self._lock:
+            mirrors = list(self._mirror_states.values())
+        for mirror in mirrors:
+            if mirror.size is None and mirror.exists():
+                mirror.size = directory_size(mirror.path)
+        return sum(mirror.size or 0 for mirror in mirrors)
+
+    def _evict(self, keep: str):
+        """Delete least recently used idle mirrors until the pool fits its disk budget
+
+        Runs after clones and fetches, the only times the pool grows. Mirrors
+        are deleted without holding the pool lock, so other repos are handed
+        out in the meantime.
+        """
+        total = self.disk_usage()
+        if total <= self.budget_bytes:
+            return
+
+        def last_used(mirror: _Mirror) -> float:
+            marker = os.path.join(mirror.path, LAST_USED_MARKER)
+            return os.path.getmtime(marker) if os.path.exists(marker) else 0.0
+
+        with self._lock:
+            candidates = [mirror for mirror in self._mirror_states.values() if mirror.path != keep and mirror.size]
+        for mirror in sorted(candidates, key=last_used):
+            if total <= self.budget_bytes:
+                break
+            # Mirrors in use are skipped rather than waited for
+            if not mirror.lock.acquire_write(timeout=0):
+                continue
+            try:
+                logger.info("🗑️ Evicting mirror %s to stay within the pool budget", mirror.path)
+                if delete_cloned_repo(mirror.path):
+                    total -= mirror.size
+                    mirror.size = 0
+                    mirror.last_fetch = 0.0
+            finally:
+                mirror.lock.release_write()
+
+    def remove(self, repo_url: str, timeout: float = REMOVE_TIMEOUT) -> bool:
+        """Delete the mirror of a single repository once nobody is using it
+
+        Raises:
+            RepoBusyError: The mirror was still leased after `timeout` seconds
+        """
+        mirror = self._mirror(self.mirror_path(repo_url))
+        if not mirror.lock.acquire_write(timeout):
+            raise RepoBusyError(f"{repo_url} is in use by {mirror.lock.readers} running requests")
+        try:
+            mirror.last_fetch = 0.0
+            mirror.size = 0
+            return delete_cloned_repo(mirror.path)
+        finally:
+            mirror.lock.release_write()
+
+    def clear(self) -> tuple[int, int]:
+        """Delete every idle mirror in the pool, returning how many were removed and how many were in use"""
+        removed = busy = 0
+        for path in self._mirrors():
+            mirror = self._mirror(path)
+            if not mirror.lock.acquire_write(timeout=0):
+                busy += 1
+                continue
+            try:
+                removed += delete_cloned_repo(path)
+                mirror.last_fetch = 0.0
+                mirror.size = 0
+            finally:
+                mirror.lock.release_write()
+        return removed, busy
+
+
+def has_commit(repo: git.Repo, commit_hash: str) -> bool:
+    """Check if a commit object exists locally"""
+    try:
+        repo.git.cat_file("-e", f"{commit_hash}^{{commit}}")
+        return True
+    except git.GitCommandError:
+        return False
+
+
+def is_shallow(repo: git.Repo) -> bool:
+    return os.path.exists(os.path.join(repo.git_dir, 'shallow'))
+
+
+def directory_size(path: str) -> int:
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for name in filenames:
+            try:
+                total += os.path.getsize(os.path.join(dirpath, name))
+            except OSError:
+                pass
+    return total
@@ -0,0 +1,74 @@
+import os
+import threading
+import time
+from typing import Optional
+
+from result_store import ResultStore
+
+
+class ResultCache:
+    """Read-through cache of finished analyses, stored in results.db
+
+    Entries are keyed by (repo URL, commit hash, model, prompt version) so a
+    model or prompt change never serves a stale report. Eviction is TTL based
+    plus a cap on the number of analyses (least recently used rows go first).
+    """
+
+    def __init__(self, store: ResultStore, ttl_seconds: Optional[int] = None, max_entries: Optional[int] = None):
+        self.store = store
+        self.ttl_seconds = ttl_seconds if ttl_seconds is not None else int(os.environ.get("CTM_CACHE_TTL_SECONDS", 7 * 24 * 3600))
+        self.max_entries = max_entries if max_entries is not None else int(os.environ.get("CTM_CACHE_MAX_ENTRIES", 5000))
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+    def get(self, repo_url: str, commit_hash: str, model: str, prompt_version: str) -> Optional[dict]:
+        """Return the cached result for a commit, or None on a miss
+
+        Only full commit hashes are looked up; abbreviated hashes have to be
+        resolved against the repository first since they may be ambiguous there.
+        """
+        stored = self.store.get_analysis(repo_url, commit_hash, model, prompt_version)
+        if stored is None or time.time() - stored.pop("created_at") > self.ttl_seconds:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        self.store.touch_analysis(repo_url, commit_hash, model, prompt_version)
+        with self._lock:
+            self.hits += 1
+        return stored
+
+    def cached_hashes(self, repo_url: str, commit_hashes: list[str], model: str, prompt_version: str) -> set[str]:
+        """Which of the given commits have a live cache entry (without counting hits or misses)"""
+        return self.store.analyzed_hashes(repo_url, commit_hashes, model, prompt_version, since=time.time() - self.ttl_seconds)
+
+    def put(self, repo_url: str, commit_hash: str, model: str, prompt_version: str,
+            commit_metadata: dict, analysis: Optional[str], fix_suggestion: Optional[str]):
+        """Store a finished analysis and evict expired or excess entries"""
+        self.store.save_analyses([{
+            "repo_url": repo_url,
+            "model": model,
+            "prompt_version": prompt_version,
+            "commit_metadata": {**commit_metadata, "hash": commit_hash},
+            "analysis": analysis,
+            "fix_suggestion": fix_suggestion,
+        }])
+        evicted = self.store.evict_analyses(time.time() - self.ttl_seconds, self.max_entries)
+        with self._lock:
+            self.evictions += evicted
+
+    def stats(self) -> dict:
+        entries = self.store.count_analyses()
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "ttl_seconds": self.ttl_seconds,
+                "max_entries": self.max_entries,
+            }
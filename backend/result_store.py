@@ -0,0 +1,650 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Iterable, Optional
+
+from function_utils import normalize_repo_url, split_range_key
+from search_index import VectorIndex, fts_query, fuse_rankings, unpack_vector
+
+logger = logging.getLogger(__name__)
+
+# Bump whenever SCHEMA or LEGACY_CLEANUP change; databases already at this version
+# skip the DDL and the search index backfill when the server starts
+SCHEMA_VERSION = 6
+
+# Characters of a search document sent to the embedding model
+EMBED_MAX_CHARS = 8000
+
+# Cache hits record their access time in memory; it is written at most this often
+TOUCH_FLUSH_SECONDS = 30
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS repos (
+    id INTEGER PRIMARY KEY,
+    url TEXT NOT NULL UNIQUE
+);
+
+CREATE TABLE IF NOT EXISTS commits (
+    repo_id INTEGER NOT NULL REFERENCES repos (id),
+    hash TEXT NOT NULL,
+    author TEXT,
+    date TEXT,
+    message TEXT,
+    diff TEXT,
+    -- `date` is ISO 8601 in the author's time zone; this is the same instant in seconds since the epoch (UTC)
+    authored_at REAL,
+    PRIMARY KEY (repo_id, hash)
+);
+CREATE INDEX IF NOT EXISTS idx_commits_repo_authored_at ON commits (repo_id, authored_at);
+CREATE INDEX IF NOT EXISTS idx_commits_repo_author ON commits (repo_id, author, authored_at);
+
+CREATE TABLE IF NOT EXISTS commit_files (
+    repo_id INTEGER NOT NULL,
+    hash TEXT NOT NULL,
+    path TEXT NOT NULL,
+    additions INTEGER,
+    deletions INTEGER,
+    PRIMARY KEY (repo_id, hash, path),
+    FOREIGN KEY (repo_id, hash) REFERENCES commits (repo_id, hash)
+);
+CREATE INDEX IF NOT EXISTS idx_commit_files_path ON commit_files (path, repo_id);
+
+CREATE TABLE IF NOT EXISTS analyses (
+    repo_id INTEGER NOT NULL,
+    hash TEXT NOT NULL,
+    model TEXT NOT NULL,
+    prompt_version TEXT NOT NULL,
+    analysis TEXT,
+    fix_suggestion TEXT,
+    created_at REAL NOT NULL,
+    last_accessed REAL NOT NULL,
+    PRIMARY KEY (repo_id, hash, model, prompt_version),
+    FOREIGN KEY (repo_id, hash) REFERENCES commits (repo_id, hash)
+);
+CREATE INDEX IF NOT EXISTS idx_analyses_last_accessed ON analyses (last_accessed);
+CREATE INDEX IF NOT EXISTS idx_analyses_created_at ON analyses (created_at);
+
+-- Analyses of commit ranges, keyed "<base>..<head>". A range is not a commit, so its metadata is
+-- kept here as JSON, out of commits, commit_files and the search index
+CREATE TABLE IF NOT EXISTS range_analyses (
+    repo_id INTEGER NOT NULL,
+    range_key TEXT NOT NULL,
+    model TEXT NOT NULL,
+    prompt_version TEXT NOT NULL,
+    commit_metadata TEXT NOT NULL,
+    analysis TEXT,
+    fix_suggestion TEXT,
+    created_at REAL NOT NULL,
+    last_accessed REAL NOT NULL,
+    PRIMARY KEY (repo_id, range_key, model, prompt_version)
+);
+CREATE INDEX IF NOT EXISTS idx_range_analyses_last_accessed ON range_analyses (last_accessed);
+CREATE INDEX IF NOT EXISTS idx_range_analyses_created_at ON range_analyses (created_at);
+
+-- One search document per analyzed commit; its text is in search_fts under the same rowid
+CREATE TABLE IF NOT EXISTS search_docs (
+    id INTEGER PRIMARY KEY,
+    repo_id INTEGER NOT NULL,
+    hash TEXT NOT NULL,
+    updated_at REAL NOT NULL,
+    UNIQUE (repo_id, hash)
+);
+-- Embedding of each search document's text, from the model named in the row
+CREATE TABLE IF NOT EXISTS search_vectors (
+    doc_id INTEGER PRIMARY KEY,
+    model TEXT NOT NULL,
+    vector BLOB NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_search_vectors_model_updated_at ON search_vectors (model, updated_at);
+-- LLM output keyed by patch content rather than commit, shared across cherry-picks, rebases and forks
+CREATE TABLE IF NOT EXISTS patch_analyses (
+    fingerprint TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    model TEXT NOT NULL,
+    prompt_version TEXT NOT NULL,
+    text TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    PRIMARY KEY (fingerprint, kind, model, prompt_version)
+);
+CREATE INDEX IF NOT EXISTS idx_patch_analyses_created_at ON patch_analyses (created_at);
+
+-- Newest commit of each repo's default branch the background indexer has stored
+CREATE TABLE IF NOT EXISTS repo_index (
+    repo_id INTEGER PRIMARY KEY REFERENCES repos (id),
+    tip TEXT NOT NULL,
+    indexed_at REAL NOT NULL
+);
+
+CREATE VIRTUAL TABLE IF NOT EXISTS search_fts USING fts5 (message, files, analysis, tokenize = 'porter unicode61');
+"""
+
+# The original results table keyed analyses by commit hash alone and already
+# had a primary key index; the cache table from before the schema was normalized
+# is superseded by analyses. Version 1 indexed the author-local date text, which
+# does not sort across time zones (its indexes are replaced by ones on authored_at), and version 2 kept hashed bag-of-words vectors
+# next to the keyword index
+LEGACY_CLEANUP = """
+DROP INDEX IF EXISTS idx_commit_hash;
+DROP TABLE IF EXISTS analysis_cache;
+DROP INDEX IF EXISTS idx_commits_author;
+DROP INDEX IF EXISTS idx_commits_repo_date;
+DROP INDEX IF EXISTS idx_search_docs_updated_at;
+"""
+
+
+def utc_timestamp(date: Optional[str]) -> Optional[float]:
+    """Seconds since the epoch of an ISO 8601 date with a UTC offset, or None if it can't be parsed"""
+    try:
+        return datetime.fromisoformat(date).timestamp() if date else None
+    except ValueError:
+        return None
+
+
+class ResultStore:
+    """SQLite store for analyzed commits, the files they touch and their analyses
+
+    Writes go through one long-lived connection (serialized by a lock, one
+    transaction per batch); reads use one connection per thread. The database
+    runs in WAL mode so readers never wait for the writer.
+    """
+
+    def __init__(self, db_path: str = "results.db"):
+        self.db_path = db_path
+        self._write_lock = threading.Lock()
+        self._local = threading.local()
+        self._repo_ids: dict[str, int] = {}
+        self._touch_lock = threading.Lock()
+        self._touches: dict[tuple[str, str, str, str], float] = {}
+        self._touches_flushed = time.monotonic()
+        self._vectors = VectorIndex()
+        self._writer = self._connect()
+        if self._writer.execute("PRAGMA user_version").fetchone()[0] < SCHEMA_VERSION:
+            self._migrate()
+
+    def _migrate(self):
+        # CREATE TABLE IF NOT EXISTS leaves an existing table alone, and SCHEMA indexes the new column
+        columns = {row[1] for row in self._writer.execute("PRAGMA table_info(commits)")}
+        if columns and "authored_at" not in columns:
+            self._writer.execute("ALTER TABLE commits ADD COLUMN authored_at REAL")
+        if "vector" in {row[1] for row in self._writer.execute("PRAGMA table_info(search_docs)")}:
+            self._writer.execute("ALTER TABLE search_docs DROP COLUMN vector")
+        self._writer.executescript(SCHEMA + LEGACY_CLEANUP)
+        with self.transaction() as conn:
+            rows = conn.execute("SELECT repo_id, hash, date FROM commits WHERE authored_at IS NULL AND date IS NOT NULL").fetchall()
+            conn.executemany("UPDATE commits SET authored_at = ? WHERE repo_id = ? AND hash = ?",
+                             [(utc_timestamp(date), repo_id, commit_hash) for repo_id, commit_hash, date in rows])
+            self._move_range_analyses(conn)
+            self._drop_unanalyzed_search_docs(conn)
+        self._index_unindexed_analyses()
+        self._writer.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        logger.info("Set up the schema of %s (version %d)", self.db_path, SCHEMA_VERSION)
+
+    def _move_range_analyses(self, conn: sqlite3.Connection):
+        """Move range analyses that version 5 and earlier stored as commits into range_analyses"""
+        rows = conn.execute("""
+            SELECT a.repo_id, a.hash, a.model, a.prompt_version, a.analysis, a.fix_suggestion, a.created_at, a.last_accessed,
+                   c.author, c.date, c.message, c.diff
+            FROM analyses a JOIN commits c ON c.repo_id = a.repo_id AND c.hash = a.hash
+            WHERE a.hash LIKE '%..%'
+        """).fetchall()
+        for repo_id, key, model, prompt_version, analysis, fix_suggestion, created_at, last_accessed, *commit in rows:
+            metadata = self._commit_metadata(conn, repo_id, key, *commit)
+            conn.execute("""
+                INSERT OR REPLACE INTO range_analyses (repo_id, range_key, model, prompt_version, commit_metadata,
+                                                       analysis, fix_suggestion, created_at, last_accessed)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, (repo_id, key, model, prompt_version, json.dumps(metadata), analysis, fix_suggestion, created_at, last_accessed))
+        for table in ("analyses", "commit_files", "commits"):
+            conn.execute(f"DELETE FROM {table} WHERE hash LIKE '%..%'")
+        if rows:
+            logger.info("Moved %d range analyses out of the commits table", len(rows))
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=5000")
+        return conn
+
+    def _reader(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        """Run a batch of writes on the shared writer connection as a single transaction"""
+        with self._write_lock:
+            self._writer.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._writer
+                self._writer.execute("COMMIT")
+            except BaseException:
+                self._writer.execute("ROLLBACK")
+                raise
+
+    def _repo_id(self, conn: sqlite3.Connection, repo_url: str, create: bool = True) -> Optional[int]:
+        url = normalize_repo_url(repo_url)
+        if url in self._repo_ids:
+            return self._repo_ids[url]
+        row = conn.execute("SELECT id FROM repos WHERE url = ?", (url,)).fetchone()
+        if row is None:
+            # Not memoized yet: the surrounding transaction could still roll back
+            return conn.execute("INSERT INTO repos (url) VALUES (?)", (url,)).lastrowid if create else None
+        self._repo_ids[url] = row[0]
+        return row[0]
+
+    def save_commit(self, conn: sqlite3.Connection, repo_url: str, commit_metadata: dict) -> int:
+        """Upsert a commit and its files inside an open transaction, returning the repo id"""
+        repo_id = self._repo_id(conn, repo_url)
+        commit_hash = commit_metadata["hash"]
+        conn.execute("""
+            INSERT INTO commits (repo_id, hash, author, date, message, diff, authored_at) VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (repo_id, hash) DO UPDATE SET
+                author = excluded.author, date = excluded.date, message = excluded.message, diff = excluded.diff,
+                authored_at = excluded.authored_at
+        """, (repo_id, commit_hash, commit_metadata.get("author"), commit_metadata.get("date"),
+              commit_metadata.get("message"), commit_metadata.get("diff"), utc_timestamp(commit_metadata.get("date"))))
+
+        stats = commit_metadata.get("file_stats") or {}
+        conn.executemany("""
+            INSERT OR REPLACE INTO commit_files (repo_id, hash, path, additions, deletions) VALUES (?, ?, ?, ?, ?)
+        """, [
+            (repo_id, commit_hash, path, stats.get(path, {}).get("additions"), stats.get(path, {}).get("deletions"))
+            for path in commit_metadata.get("files_changed") or []
+        ])
+        return repo_id
+
+    def save_commits(self, repo_url: str, commits: list[dict], tip: Optional[str] = None):
+        """
+        Store the metadata of several commits in one transaction, without analyses
+
+        Args:
+            repo_url: Repository the commits belong to
+            commits: CommitMetadata dicts
+            tip: If given, recorded as the repo's last indexed tip in the same transaction
+        """
+        with self.transaction() as conn:
+            for commit_metadata in commits:
+                self.save_commit(conn, repo_url, commit_metadata)
+            if tip:
+                conn.execute("""
+                    INSERT OR REPLACE INTO repo_index (repo_id, tip, indexed_at) VALUES (?, ?, ?)
+                """, (self._repo_id(conn, repo_url), tip, time.time()))
+
+    def indexed_tip(self, repo_url: str) -> Optional[str]:
+        conn = self._reader()
+        repo_id = self._repo_id(conn, repo_url, create=False)
+        if repo_id is None:
+            return None
+        row = conn.execute("SELECT tip FROM repo_index WHERE repo_id = ?", (repo_id,)).fetchone()
+        return row[0] if row else None
+
+    def stored_commits(self, repo_url: str, commit_hashes: list[str]) -> set[str]:
+        """Which of the given commits already have their metadata stored"""
+        conn = self._reader()
+        repo_id = self._repo_id(conn, repo_url, create=False)
+        if repo_id is None:
+            return set()
+        found = set()
+        for i in range(0, len(commit_hashes), 500):
+            batch = commit_hashes[i:i + 500]
+            rows = conn.execute(f"""
+                SELECT hash FROM commits WHERE repo_id = ? AND hash IN ({','.join('?' * len(batch))})
+            """, (repo_id, *batch)).fetchall()
+            found.update(row[0] for row in rows)
+        return found
+
+    def save_analyses(self, records: Iterable[dict]):
+        """
+        Store several analyses in one transaction
+
+        Args:
+            records: dicts with repo_url, model, prompt_version, commit_metadata, analysis and fix_suggestion
+        """
+        now = time.time()
+        with self.transaction() as conn:
+            for record in records:
+                if split_range_key(record["commit_metadata"]["hash"]):
+                    self._save_range_analysis(conn, record, now)
+                    continue
+                repo_id = self.save_commit(conn, record["repo_url"], record["commit_metadata"])
+                conn.execute("""
+                    INSERT OR REPLACE INTO analyses
+                        (repo_id, hash, model, prompt_version, analysis, fix_suggestion, created_at, last_accessed)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                """, (repo_id, record["commit_metadata"]["hash"], record["model"], record["prompt_version"],
+                      record.get("analysis"), record.get("fix_suggestion"), now, now))
+                self._index_commit(conn, repo_id, record["commit_metadata"], record.get("analysis"), now)
+
+    def _save_range_analysis(self, conn: sqlite3.Connection, record: dict, now: float):
+        # The commits of the range are listed from git again on a cache hit, so only the rest is kept
+        metadata = {key: value for key, value in record["commit_metadata"].items() if key != "commits"}
+        conn.execute("""
+            INSERT OR REPLACE INTO range_analyses (repo_id, range_key, model, prompt_version, commit_metadata,
+                                                   analysis, fix_suggestion, created_at, last_accessed)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, (self._repo_id(conn, record["repo_url"]), metadata["hash"], record["model"], record["prompt_version"],
+              json.dumps(metadata), record.get("analysis"), record.get("fix_suggestion"), now, now))
+
+    def _index_commit(self, conn: sqlite3.Connection, repo_id: int, commit_metadata: dict, analysis: Optional[str], now: float):
+        """Add or replace a commit's search document inside an open transaction"""
+        message = commit_metadata.get("message") or ""
+        files = "\n".join(commit_metadata.get("files_changed") or [])
+        row = conn.execute("SELECT id FROM search_docs WHERE repo_id = ? AND hash = ?",
+                           (repo_id, commit_metadata["hash"])).fetchone()
+        if row is None:
+            doc_id = conn.execute("""
+                INSERT INTO search_docs (repo_id, hash, updated_at) VALUES (?, ?, ?)
+            """, (repo_id, commit_metadata["hash"], now)).lastrowid
+        else:
+            doc_id = row[0]
+            conn.execute("UPDATE search_docs SET updated_at = ? WHERE id = ?", (now, doc_id))
+            conn.execute("DELETE FROM search_fts WHERE rowid = ?", (doc_id,))
+            # The text changed, so the document is embedded again
+            conn.execute("DELETE FROM search_vectors WHERE doc_id = ?", (doc_id,))
+        conn.execute("INSERT INTO search_fts (rowid, message, files, analysis) VALUES (?, ?, ?, ?)",
+                     (doc_id, message, files, analysis or ""))
+
+    def unembedded_documents(self, model: str, limit: int) -> list[tuple[int, float, str]]:
+        """Search documents without a vector from `model`: (id, updated_at, text), newest first"""
+        rows = self._reader().execute("""
+            SELECT d.id, d.updated_at, f.message, f.files, f.analysis FROM search_docs d
+            JOIN search_fts f ON f.rowid = d.id
+            LEFT JOIN search_vectors v ON v.doc_id = d.id AND v.model = ?
+            WHERE v.doc_id IS NULL
+            ORDER BY d.updated_at DESC LIMIT ?
+        """, (model, limit)).fetchall()
+        return [
+            (doc_id, updated_at, f"{message}\n{files}\n{analysis}"[:EMBED_MAX_CHARS])
+            for doc_id, updated_at, message, files, analysis in rows
+        ]
+
+    def save_vectors(self, model: str, vectors: dict[tuple[int, float], bytes]):
+        """
+        Store document vectors in one transaction
+
+        Args:
+            model: Embedding model that produced them
+            vectors: Packed vectors by (document id, updated_at the text was read at); documents
+                re-indexed or deleted since then are skipped
+        """
+        now = time.time()
+        with self.transaction() as conn:
+            conn.executemany("""
+                INSERT OR REPLACE INTO search_vectors (doc_id, model, vector, updated_at)
+                SELECT ?, ?, ?, ? WHERE EXISTS (SELECT 1 FROM search_docs WHERE id = ? AND updated_at = ?)
+            """, [(doc_id, model, blob, now, doc_id, updated_at) for (doc_id, updated_at), blob in vectors.items()])
+
+    def _index_unindexed_analyses(self):
+        """Index analyses stored before the search index existed"""
+        rows = self._writer.execute("""
+            SELECT c.repo_id, c.hash, c.message, a.analysis FROM commits c
+            JOIN analyses a ON a.repo_id = c.repo_id AND a.hash = c.hash
+            LEFT JOIN search_docs d ON d.repo_id = c.repo_id AND d.hash = c.hash
+            WHERE d.id IS NULL
+            GROUP BY c.repo_id, c.hash
+        """).fetchall()
+        if not rows:
+            return
+        now = time.time()
+        with self.transaction() as conn:
+            for repo_id, commit_hash, message, analysis in rows:
+                files = [path for path, in conn.execute(
+                    "SELECT path FROM commit_files WHERE repo_id = ? AND hash = ?", (repo_id, commit_hash))]
+                self._index_commit(conn, repo_id, {"hash": commit_hash, "message": message, "files_changed": files}, analysis, now)
+        logger.info("Indexed %d stored analyses for search", len(rows))
+
+    def get_analysis(self, repo_url: str, commit_hash: str, model: str, prompt_version: str) -> Optional[dict]:
+        """Return a stored analysis with its commit metadata, or None"""
+        conn = self._reader()
+        repo_id = self._repo_id(conn, repo_url, create=False)
+        if repo_id is None:
+            return None
+        if split_range_key(commit_hash):
+            row = conn.execute("""
+                SELECT commit_metadata, analysis, fix_suggestion, created_at FROM range_analyses
+                WHERE repo_id = ? AND range_key = ? AND model = ? AND prompt_version = ?
+            """, (repo_id, commit_hash, model, prompt_version)).fetchone()
+            if row is None:
+                return None
+            metadata, analysis, fix_suggestion, created_at = row
+            return {"commit_metadata": json.loads(metadata), "analysis": analysis,
+                    "fix_suggestion": fix_suggestion, "created_at": created_at}
+        row = conn.execute("""
+            SELECT c.author, c.date, c.message, c.diff, a.analysis, a.fix_suggestion, a.created_at
+            FROM analyses a JOIN commits c ON c.repo_id = a.repo_id AND c.hash = a.hash
+            WHERE a.repo_id = ? AND a.hash = ? AND a.model = ? AND a.prompt_version = ?
+        """, (repo_id, commit_hash, model, prompt_version)).fetchone()
+        if row is None:
+            return None
+
+        author, date, message, diff, analysis, fix_suggestion, created_at = row
+        return {
+            "commit_metadata": self._commit_metadata(conn, repo_id, commit_hash, author, date, message, diff),
+            "analysis": analysis,
+            "fix_suggestion": fix_suggestion,
+            "created_at": created_at,
+        }
+
+    def get_commit(self, repo_url: str, commit_hash: str) -> Optional[dict]:
+        """Stored metadata (with diff) of a commit, analyzed or only indexed; None if not stored"""
+        conn = self._reader()
+        repo_id = self._repo_id(conn, repo_url, create=False)
+        if repo_id is None:
+            return None
+        row = conn.execute("SELECT author, date, message, diff FROM commits WHERE repo_id = ? AND hash = ?",
+                           (repo_id, commit_hash)).fetchone()
+        return self._commit_metadata(conn, repo_id, commit_hash, *row) if row else None
+
+    def _commit_metadata(self, conn: sqlite3.Connection, repo_id: int, commit_hash: str, author, date, message, diff) -> dict:
+        files = conn.execute("""
+            SELECT path, additions, deletions FROM commit_files WHERE repo_id = ? AND hash = ? ORDER BY path
+        """, (repo_id, commit_hash)).fetchall()
+        return {
+            "hash": commit_hash,
+            "author": author,
+            "date": date,
+            "message": message,
+            "diff": diff,
+            "files_changed": [path for path, _, _ in files],
+            "file_stats": {path: {"additions": a, "deletions": d} for path, a, d in files},
+        }
+
+    def touch_analysis(self, repo_url: str, commit_hash: str, model: str, prompt_version: str):
+        """Record a read of an analysis; access times are written in batches, see flush_touches"""
+        with self._touch_lock:
+            self._touches[(repo_url, commit_hash, model, prompt_version)] = time.time()
+            due = time.monotonic() - self._touches_flushed >= TOUCH_FLUSH_SECONDS
+        if due:
+            self.flush_touches()
+
+    def flush_touches(self):
+        """Write the access times recorded since the last flush in one transaction"""
+        with self._touch_lock:
+            touches, self._touches = self._touches, {}
+            self._touches_flushed = time.monotonic()
+        if not touches:
+            return
+        with self.transaction() as conn:
+            updates = {"analyses": [], "range_analyses": []}
+            for (repo_url, commit_hash, model, prompt_version), accessed in touches.items():
+                table = "range_analyses" if split_range_key(commit_hash) else "analyses"
+                updates[table].append((accessed, self._repo_id(conn, repo_url, create=False), commit_hash, model, prompt_version))
+            conn.executemany("""
+                UPDATE analyses SET last_accessed = MAX(last_accessed, ?)
+                WHERE repo_id = ? AND hash = ? AND model = ? AND prompt_version = ?
+            """, updates["analyses"])
+            conn.executemany("""
+                UPDATE range_analyses SET last_accessed = MAX(last_accessed, ?)
+                WHERE repo_id = ? AND range_key = ? AND model = ? AND prompt_version = ?
+            """, updates["range_analyses"])
+
+    def analyzed_hashes(self, repo_url: str, commit_hashes: list[str], model: str, prompt_version: str, since: float) -> set[str]:
+        """Which of the given commits have an analysis created after `since`"""
+        conn = self._reader()
+        repo_id = self._repo_id(conn, repo_url, create=False)
+        if repo_id is None:
+            return set()
+        found = set()
+        for i in range(0, len(commit_hashes), 500):
+            batch = commit_hashes[i:i + 500]
+            rows = conn.execute(f"""
+                SELECT hash FROM analyses
+                WHERE repo_id = ? AND model = ? AND prompt_version = ? AND created_at >= ?
+                  AND hash IN ({','.join('?' * len(batch))})
+            """, (repo_id, model, prompt_version, since, *batch)).fetchall()
+            found.update(row[0] for row in rows)
+        return found
+
+    def get_patch_analyses(self, kind: str, fingerprints: list[str], model: str, prompt_version: str) -> dict[str, str]:
+        """Stored LLM output for the given patch fingerprints, by fingerprint"""
+        found = {}
+        for i in range(0, len(fingerprints), 500):
+            batch = fingerprints[i:i + 500]
+            found.update(self._reader().execute(f"""
+                SELECT fingerprint, text FROM patch_analyses
+                WHERE kind = ? AND model = ? AND prompt_version = ? AND fingerprint IN ({','.join('?' * len(batch))})
+            """, (kind, model, prompt_version, *batch)).fetchall())
+        return found
+
+    def save_patch_analyses(self, kind: str, model: str, prompt_version: str, texts: dict[str, str]):
+        """Store LLM output by patch fingerprint, in one transaction"""
+        now = time.time()
+        with self.transaction() as conn:
+            conn.executemany("""
+                INSERT OR REPLACE INTO patch_analyses (fingerprint, kind, model, prompt_version, text, created_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, [(fingerprint, kind, model, prompt_version, text, now) for fingerprint, text in texts.items()])
+
+    def evict_analyses(self, created_before: float, max_entries: int) -> int:
+        """Delete expired analyses and the least recently used ones beyond max_entries
+
+        Commits and files are kept; they stay useful for history queries. The
+        search documents of commits left without any analysis are deleted.
+        """
+        # Least recently used has to account for the reads not written yet
+        self.flush_touches()
+        with self.transaction() as conn:
+            expired = conn.execute("DELETE FROM analyses WHERE created_at < ?", (created_before,)).rowcount
+            conn.execute("DELETE FROM patch_analyses WHERE created_at < ?", (created_before,))
+            overflow = conn.execute("""
+                DELETE FROM analyses WHERE rowid IN (
+                    SELECT rowid FROM analyses ORDER BY last_accessed DESC LIMIT -1 OFFSET ?
+                )
+            """, (max_entries,)).rowcount
+            if expired or overflow:
+                self._drop_unanalyzed_search_docs(conn)
+            # Ranges are far fewer than commits, and are capped on their own
+            ranges = conn.execute("DELETE FROM range_analyses WHERE created_at < ?", (created_before,)).rowcount
+            ranges += conn.execute("""
+                DELETE FROM range_analyses WHERE rowid IN (
+                    SELECT rowid FROM range_analyses ORDER BY last_accessed DESC LIMIT -1 OFFSET ?
+                )
+            """, (max_entries,)).rowcount
+        return expired + overflow + ranges
+
+    @staticmethod
+    def _drop_unanalyzed_search_docs(conn: sqlite3.Connection):
+        """Delete the search documents of commits that no longer have an analysis, inside an open transaction"""
+        doc_ids = conn.execute("""
+            SELECT id FROM search_docs d
+            WHERE NOT EXISTS (SELECT 1 FROM analyses a WHERE a.repo_id = d.repo_id AND a.hash = d.hash)
+        """).fetchall()
+        conn.executemany("DELETE FROM search_fts WHERE rowid = ?", doc_ids)
+        conn.executemany("DELETE FROM search_vectors WHERE doc_id = ?", doc_ids)
+        conn.executemany("DELETE FROM search_docs WHERE id = ?", doc_ids)
+
+    def search(self, query: str, repo_url: Optional[str] = None, limit: int = 10,
+               query_vector: Optional[bytes] = None, model: Optional[str] = None) -> list[dict]:
+        """
+        Find the analyzed commits most relevant to a free-text query
+
+        Commit messages, touched files and analyses are matched by keyword
+        (FTS5, stemmed, each keyword also as a prefix) and ranked with BM25,
+        message matches weighing most. Given the query's embedding, documents
+        are also ranked by cosine similarity to it, and the two rankings are
+        combined with reciprocal rank fusion.
+
+        Args:
+            query: Question or keywords, e.g. "which commits changed the auth flow"
+            repo_url: Only search this repo
+            limit: Number of results
+            query_vector: The query embedded by `model` (packed with search_index.pack_vector)
+            model: Embedding model of query_vector; only document vectors from it are compared
+
+        Returns:
+            list[dict]: Commits with repo_url, hash, author, date, message, files_changed, snippet and score
+        """
+        conn = self._reader()
+        repo_id = None
+        if repo_url:
+            repo_id = self._repo_id(conn, repo_url, create=False)
+            if repo_id is None:
+                return []
+        candidates = limit * 5
+
+        keyword_ranks = []
+        match = fts_query(query)
+        if match:
+            sql = "SELECT f.rowid, bm25(search_fts, 5.0, 3.0, 1.0) AS rank FROM search_fts f"
+            params: list = [match]
+            if repo_id is not None:
+                sql += " JOIN search_docs d ON d.id = f.rowid WHERE search_fts MATCH ? AND d.repo_id = ?"
+                params.append(repo_id)
+            else:
+                sql += " WHERE search_fts MATCH ?"
+            sql += " ORDER BY rank LIMIT ?"
+            params.append(candidates)
+            keyword_ranks = conn.execute(sql, params).fetchall()
+
+        vector_ids = []
+        if query_vector is not None and model:
+            self._vectors.refresh(conn, model)
+            vector_ids = self._vectors.search(unpack_vector(query_vector), candidates, repo_id)
+
+        if vector_ids:
+            scores = fuse_rankings([doc_id for doc_id, _ in keyword_ranks], vector_ids)
+        else:
+            # BM25 is lower for better matches
+            scores = {doc_id: -rank for doc_id, rank in keyword_ranks}
+        ranked = sorted(scores, key=scores.get, reverse=True)[:limit]
+        if not ranked:
+            return []
+
+        placeholders = ','.join('?' * len(ranked))
+        # Highlighted snippets only exist for keyword matches; embedding-only hits show the start of the analysis
+        snippets = {}
+        if match:
+            snippets = dict(conn.execute(f"""
+                SELECT rowid, snippet(search_fts, 2, '**', '**', '...', 24) FROM search_fts
+                WHERE search_fts MATCH ? AND rowid IN ({placeholders})
+            """, (match, *ranked)).fetchall())
+        rows = conn.execute(f"""
+            SELECT d.id, r.url, c.hash, c.author, c.date, c.message, substr(f.analysis, 1, 200),
+                   (SELECT group_concat(path, char(10)) FROM commit_files cf WHERE cf.repo_id = c.repo_id AND cf.hash = c.hash)
+            FROM search_docs d
+            JOIN search_fts f ON f.rowid = d.id
+            JOIN commits c ON c.repo_id = d.repo_id AND c.hash = d.hash
+            JOIN repos r ON r.id = d.repo_id
+            WHERE d.id IN ({placeholders})
+        """, ranked).fetchall()
+        results = {
+            doc_id: {
+                "repo_url": url, "hash": h, "author": a, "date": d, "message": m,
+                "files_changed": files.split("\n") if files else [],
+                "snippet": snippets.get(doc_id) or preview, "score": round(scores[doc_id], 5),
+            }
+            for doc_id, url, h, a, d, m, preview, files in rows
+        }
+        return [results[doc_id] for doc_id in ranked if doc_id in results]
+
+    def count_analyses(self) -> int:
+        return self._reader().execute(
+            "SELECT (SELECT COUNT(*) FROM analyses) + (SELECT COUNT(*) FROM range_analyses)").fetchone()[0]
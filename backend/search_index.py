@@ -0,0 +1,131 @@
+import re
+import threading
+from array import array
+from typing import Optional
+
+try:
+    import numpy as np
+except ImportError:  # optional; scoring falls back to plain Python, fine for small indexes
+    np = None
+
+# Reciprocal rank fusion constant for combining keyword and embedding rankings
+RRF_K = 60
+
+STOPWORDS = {
+    "a", "about", "all", "an", "and", "any", "are", "as", "at", "be", "by", "changed", "changes", "commit",
+    "commits", "did", "do", "does", "for", "from", "how", "i", "in", "is", "it", "of", "on", "or", "that",
+    "the", "this", "to", "was", "were", "what", "when", "where", "which", "who", "why", "with",
+}
+
+_WORD_RE = re.compile(r"[A-Za-z][a-z]+|[A-Z]+(?![a-z])|\d+")
+
+
+def tokenize(text: str) -> list[str]:
+    """Lowercase words, with camelCase and snake_case identifiers split into their parts"""
+    return [word.lower() for word in _WORD_RE.findall(text)]
+
+
+def fts_query(text: str) -> Optional[str]:
+    """Turn a free-text question into an FTS5 query matching any of its (prefixed) keywords"""
+    terms = dict.fromkeys(t for t in tokenize(text) if t not in STOPWORDS and len(t) > 1)
+    if not terms:
+        return None
+    return " OR ".join(f'"{term}"*' for term in terms)
+
+
+def fuse_rankings(*rankings: list[int]) -> dict[int, float]:
+    """Reciprocal rank fusion of several rankings of document ids"""
+    scores: dict[int, float] = {}
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking):
+            scores[doc_id] = scores.get(doc_id, 0.0) + 1.0 / (RRF_K + rank + 1)
+    return scores
+
+
+def pack_vector(values: list[float]) -> bytes:
+    """L2-normalized float32 bytes, so a dot product of two packed vectors is their cosine similarity"""
+    norm = sum(v * v for v in values) ** 0.5 or 1.0
+    return array("f", (v / norm for v in values)).tobytes()
+
+
+def unpack_vector(blob: bytes) -> array:
+    vector = array("f")
+    vector.frombytes(blob)
+    return vector
+
+
+class VectorIndex:
+    """In-memory copy of the stored document vectors of one embedding model
+
+    Only rows written since the last refresh are read from SQLite, so the index
+    also picks up vectors stored by other processes. When rows disappeared
+    (evicted analyses) the copy is rebuilt.
+    """
+
+    def __init__(self):
+        self.model: Optional[str] = None
+        self._reset()
+        self._lock = threading.Lock()
+
+    def _reset(self):
+        self.ids: list[int] = []
+        self.repo_ids: list[int] = []
+        self.vectors: list[array] = []
+        self._positions: dict[int, int] = {}
+        self._matrix = None
+        self._repo_array = None
+        self._loaded_until = 0.0
+
+    def refresh(self, conn, model: str):
+        with self._lock:
+            if model != self.model:
+                self.model = model
+                self._reset()
+            self._load(conn)
+            stored = conn.execute("SELECT COUNT(*) FROM search_vectors WHERE model = ?", (model,)).fetchone()[0]
+            if stored != len(self.ids):
+                self._reset()
+                self._load(conn)
+
+    def _load(self, conn):
+        rows = conn.execute("""
+            SELECT v.doc_id, d.repo_id, v.vector, v.updated_at FROM search_vectors v JOIN search_docs d ON d.id = v.doc_id
+            WHERE v.model = ? AND v.updated_at > ? ORDER BY v.updated_at
+        """, (self.model, self._loaded_until)).fetchall()
+        for doc_id, repo_id, blob, updated_at in rows:
+            vector = unpack_vector(blob)
+            if doc_id in self._positions:
+                self.vectors[self._positions[doc_id]] = vector
+            else:
+                self._positions[doc_id] = len(self.ids)
+                self.ids.append(doc_id)
+                self.repo_ids.append(repo_id)
+                self.vectors.append(vector)
+            self._loaded_until = updated_at
+        if rows:
+            self._matrix = None
+
+    def search(self, query_vector: array, limit: int, repo_id: Optional[int] = None) -> list[int]:
+        """Ids of the `limit` documents most similar to the query, best first"""
+        with self._lock:
+            if not self.ids:
+                return []
+            if np is not None:
+                if self._matrix is None:
+                    # Rebuilt lazily after new vectors arrive, then reused by every query
+                    self._matrix = np.frombuffer(b"".join(v.tobytes() for v in self.vectors), dtype=np.float32)
+                    self._matrix = self._matrix.reshape(len(self.vectors), -1)
+                    self._repo_array = np.asarray(self.repo_ids)
+                scores = self._matrix @ np.frombuffer(query_vector.tobytes(), dtype=np.float32)
+                if repo_id is not None:
+                    scores = np.where(self._repo_array == repo_id, scores, -np.inf)
+                order = np.argsort(-scores)[:limit]
+                return [self.ids[i] for i in order if scores[i] > 0]
+
+            scored = [
+                (sum(q * v for q, v in zip(query_vector, vector)), doc_id)
+                for doc_id, doc_repo, vector in zip(self.ids, self.repo_ids, self.vectors)
+                if repo_id is None or doc_repo == repo_id
+            ]
+            scored.sort(reverse=True)
+            return [doc_id for score, doc_id in scored[:limit] if score > 0]
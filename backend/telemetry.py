@@ -0,0 +1,232 @@
+import asyncio
+import contextvars
+import logging
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+try:
+    from opentelemetry import trace as otel_trace
+except ImportError:  # optional; spans still feed /metrics and the debug log
+    otel_trace = None
+
+LOG_LEVEL = os.environ.get("CTM_LOG_LEVEL", "INFO").upper()
+# Full commit metadata, analyses and fix suggestions in the log; large, and may contain source code
+LOG_CONTENT = os.environ.get("CTM_LOG_CONTENT", "").lower() in ("1", "true", "yes")
+# Export spans over OTLP (needs opentelemetry-sdk and opentelemetry-exporter-otlp);
+# the standard OTEL_EXPORTER_OTLP_* variables configure the exporter
+OTEL_ENABLED = os.environ.get("CTM_OTEL_ENABLED", "").lower() in ("1", "true", "yes")
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+logger = logging.getLogger(__name__)
+
+# Id of the HTTP request being served, carried into tasks and git threads by contextvars
+request_id: contextvars.ContextVar[str] = contextvars.ContextVar("request_id", default="-")
+
+
+class _RequestIdFilter(logging.Filter):
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = request_id.get()
+        return True
+
+
+def configure_logging():
+    """Log to stderr with the request id on every line; safe to call more than once"""
+    root = logging.getLogger()
+    if any(isinstance(f, _RequestIdFilter) for h in root.handlers for f in h.filters):
+        return
+    handler = logging.StreamHandler()
+    handler.addFilter(_RequestIdFilter())
+    handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s [%(request_id)s] %(name)s: %(message)s"))
+    root.addHandler(handler)
+    root.setLevel(LOG_LEVEL)
+
+
+def log_content(log: logging.Logger, label: str, content) -> None:
+    """Log generated or extracted content, only when CTM_LOG_CONTENT is on"""
+    if LOG_CONTENT:
+        log.info("%s: %s", label, content)
+
+
+def new_request_id() -> str:
+    return uuid.uuid4().hex[:16]
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values: dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(str(labels.get(label, "")) for label in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_labels(self.labels, key)} {value:g}")
+        return lines
+
+
+class Gauge(Counter):
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def render(self) -> list[str]:
+        lines = super().render()
+        lines[1] = f"# TYPE {self.name} gauge"
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = (), buckets: tuple[float, ...] = DURATION_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        # label values -> [count per bucket..., count, sum]
+        self._values: dict[tuple, list[float]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels.get(label, "")) for label in self.labels)
+        with self._lock:
+            counts = self._values.setdefault(key, [0] * (len(self.buckets) + 2))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-2] += 1
+            counts[-1] += value
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, counts in sorted(self._values.items()):
+                for bound, count in zip(self.buckets, counts):
+                    lines.append(f"{self.name}_bucket{_labels(self.labels + ('le',), key + (f'{bound:g}',))} {count}")
+                lines.append(f"{self.name}_bucket{_labels(self.labels + ('le',), key + ('+Inf',))} {counts[-2]}")
+                lines.append(f"{self.name}_count{_labels(self.labels, key)} {counts[-2]}")
+                lines.append(f"{self.name}_sum{_labels(self.labels, key)} {counts[-1]:g}")
+        return lines
+
+
+def _labels(names: tuple[str, ...], values: tuple) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+SPAN_SECONDS = Histogram("ctm_span_seconds", "Duration of pipeline nodes, git operations, LLM calls and HTTP requests",
+                         ("kind", "name", "status"))
+HTTP_REQUESTS = Counter("ctm_http_requests_total", "HTTP requests by route and status", ("method", "route", "status"))
+LLM_CALLS = Counter("ctm_llm_calls_total", "LLM calls by model and outcome (ok, error, coalesced)", ("model", "outcome"))
+LLM_TOKENS = Counter("ctm_llm_tokens_total", "LLM tokens sent and received, as reported by the API or else estimated "
+                     "(about 4 characters each)", ("model", "direction", "counted"))
+LLM_RETRIES = Counter("ctm_llm_retries_total", "LLM attempts retried after a 429 or 5xx", ("model",))
+LLM_IN_FLIGHT = Gauge("ctm_llm_in_flight", "LLM calls waiting for a response", ("model",))
+PROMPT_TOKENS_SAVED = Counter("ctm_prompt_tokens_saved_total", "Estimated diff tokens kept out of prompts by compaction",
+                              ("node",))
+METRICS = [SPAN_SECONDS, HTTP_REQUESTS, LLM_CALLS, LLM_TOKENS, LLM_RETRIES, LLM_IN_FLIGHT, PROMPT_TOKENS_SAVED]
+
+
+def render_metrics() -> str:
+    """All metrics in the Prometheus text exposition format"""
+    return "\n".join(line for metric in METRICS for line in metric.render()) + "\n"
+
+
+class Span:
+    """A timed unit of work; attributes set on it end up in the debug log and the OpenTelemetry span"""
+
+    def __init__(self, kind: str, name: str, attributes: dict):
+        self.kind = kind
+        self.name = name
+        self.attributes = attributes
+        self.status = "ok"
+        self._otel = None
+
+    def rename(self, name: str):
+        """Names known only once the work is done, e.g. the route of an HTTP request"""
+        self.name = name
+        if self._otel is not None:
+            self._otel.update_name(f"{self.kind} {name}")
+
+    def set(self, key: str, value):
+        self.attributes[key] = value
+        if self._otel is not None and value is not None:
+            self._otel.set_attribute(f"ctm.{key}", value)
+
+
+_tracer = None
+
+
+def setup_tracing():
+    """Export spans over OTLP when CTM_OTEL_ENABLED is set and the OpenTelemetry SDK is installed"""
+    global _tracer
+    if not OTEL_ENABLED or _tracer is not None:
+        return
+    if otel_trace is None:
+        logger.warning("CTM_OTEL_ENABLED is set but opentelemetry is not installed; not exporting spans")
+        return
+    try:
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+    except ImportError as e:
+        logger.warning("OpenTelemetry export needs opentelemetry-sdk and opentelemetry-exporter-otlp (%s)", e)
+        return
+    provider = TracerProvider(resource=Resource.create({"service.name": os.environ.get("OTEL_SERVICE_NAME", "code-time-machine")}))
+    provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+    otel_trace.set_tracer_provider(provider)
+    _tracer = otel_trace.get_tracer("code-time-machine")
+    logger.info("📡 Exporting traces over OTLP")
+
+
+@contextmanager
+def span(kind: str, name: str, **attributes):
+    """
+    Time a unit of work
+
+    Records its duration in ctm_span_seconds, logs it at debug level and, with
+    tracing set up, exports it as an OpenTelemetry span nested under the
+    request's span.
+
+    Args:
+        kind: "http", "node", "git" or "llm"
+        name: What ran, e.g. the node name or the git operation
+        **attributes: Extra attributes; more can be added with Span.set
+    """
+    current = Span(kind, name, attributes)
+    start = time.perf_counter()
+    otel_context = _tracer.start_as_current_span(f"{kind} {name}") if _tracer else None
+    try:
+        if otel_context is not None:
+            current._otel = otel_context.__enter__()
+            for key, value in attributes.items():
+                current.set(key, value)
+        yield current
+    except BaseException as e:
+        current.status = "cancelled" if isinstance(e, (asyncio.CancelledError, GeneratorExit)) else "error"
+        if current._otel is not None:
+            current._otel.record_exception(e)
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        if otel_context is not None:
+            otel_context.__exit__(None, None, None)
+        SPAN_SECONDS.observe(elapsed, kind=kind, name=current.name, status=current.status)
+        if logger.isEnabledFor(logging.DEBUG):
+            extra = " ".join(f"{k}={v}" for k, v in current.attributes.items())
+            logger.debug("%s %s %s in %.4fs %s", kind, current.name, current.status, elapsed, extra)
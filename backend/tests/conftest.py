@@ -0,0 +1,39 @@
+import os
+import subprocess
+import sys
+import tempfile
+
+import pytest
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND)
+
+# The app reads its database, mirrors and LLM backend from the environment when imported;
+# tests never touch backend/results.db or call Gemini
+_work_dir = tempfile.mkdtemp(prefix="ctm-tests-")
+os.environ.setdefault("CTM_DB_PATH", os.path.join(_work_dir, "results.db"))
+os.environ.setdefault("CTM_REPOS_PATH", os.path.join(_work_dir, "mirrors"))
+os.environ.setdefault("CTM_LLM_BACKEND", "fake")
+os.environ.setdefault("CTM_LOG_LEVEL", "WARNING")
+
+
+def git(repo: str, *args: str) -> str:
+    return subprocess.run(["git", "-C", repo, *args], check=True, capture_output=True, text=True).stdout.strip()
+
+
+@pytest.fixture
+def make_repo(tmp_path):
+    """Build a git repo with `commits` commits, each appending a line to file.txt; returns its path"""
+    def make(commits: int = 3, name: str = "src") -> str:
+        path = str(tmp_path / name)
+        os.makedirs(path)
+        git(path, "init", "-q", "-b", "main")
+        git(path, "config", "user.email", "dev@example.com")
+        git(path, "config", "user.name", "Dev")
+        for i in range(commits):
+            with open(os.path.join(path, "file.txt"), "a") as f:
+                f.write(f"line {i}\n")
+            git(path, "add", "-A")
+            git(path, "commit", "-qm", f"commit {i}")
+        return path
+    return make
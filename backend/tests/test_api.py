@@ -0,0 +1,52 @@
+import asyncio
+
+import httpx
+
+import main
+from conftest import git
+
+
+async def post(endpoint: str, body: dict) -> httpx.Response:
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://test", timeout=60) as client:
+        return await client.post(endpoint, json=body)
+
+
+def test_cold_full_hash_is_looked_up_once(make_repo):
+    path = make_repo()
+    head = git(path, "rev-parse", "HEAD")
+    body = {"repo_url": f"file://{path}", "commit_hash": head}
+    misses, hits = main.result_cache.misses, main.result_cache.hits
+
+    response = asyncio.run(post("/analyze-commit", body))
+    assert response.status_code == 200
+    assert response.json()["commit_metadata"]["hash"] == head
+    assert (main.result_cache.misses, main.result_cache.hits) == (misses + 1, hits)
+
+    response = asyncio.run(post("/analyze-commit", body))
+    assert response.status_code == 200
+    assert (main.result_cache.misses, main.result_cache.hits) == (misses + 1, hits + 1)
+
+
+def test_abbreviated_hash_is_looked_up_after_resolving(make_repo):
+    path = make_repo()
+    head = git(path, "rev-parse", "HEAD")
+    asyncio.run(post("/analyze-commit", {"repo_url": f"file://{path}", "commit_hash": head}))
+    hits = main.result_cache.hits
+
+    response = asyncio.run(post("/analyze-commit", {"repo_url": f"file://{path}", "commit_hash": head[:10]}))
+    assert response.status_code == 200
+    assert main.result_cache.hits == hits + 1
+
+
+def test_results_are_cached_per_token_budget(make_repo):
+    path = make_repo()
+    body = {"repo_url": f"file://{path}", "commit_hash": git(path, "rev-parse", "HEAD")}
+    asyncio.run(post("/analyze-commit", body))
+    misses, hits = main.result_cache.misses, main.result_cache.hits
+
+    # A smaller budget trims the diff in the prompts, so the default budget's result doesn't answer it
+    trimmed = {**body, "token_budget": 10}
+    assert asyncio.run(post("/analyze-commit", trimmed)).status_code == 200
+    assert (main.result_cache.misses, main.result_cache.hits) == (misses + 1, hits)
+    assert asyncio.run(post("/analyze-commit", trimmed)).status_code == 200
+    assert (main.result_cache.misses, main.result_cache.hits) == (misses + 1, hits + 1)
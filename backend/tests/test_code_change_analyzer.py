@@ -0,0 +1,56 @@
+import asyncio
+
+from agents import code_change_analyzer
+from agents.code_change_analyzer import CodeChangeAnalyzerNode
+from llm import FakeBackend, LLMClient
+from result_store import ResultStore
+
+
+class RecordingBackend(FakeBackend):
+    """Keeps the prompts it was sent"""
+
+    def __init__(self):
+        super().__init__(latency_ms=0)
+        self.prompts: list[str] = []
+
+    def respond(self, model: str, prompt: str) -> str:
+        self.prompts.append(prompt)
+        return super().respond(model, prompt)
+
+
+def file_diff(path: str, *hunks: list[str]) -> str:
+    return f"diff --git a/{path} b/{path}\n--- a/{path}\n+++ b/{path}\n" + "".join(
+        f"@@ -{i * 10 + 1},1 +{i * 10 + 1},1 @@\n" + "".join(line + "\n" for line in hunk) for i, hunk in enumerate(hunks))
+
+
+def analyze(node: CodeChangeAnalyzerNode, message: str, diff: str) -> str:
+    state = {"commit_metadata": {"hash": "0" * 40, "message": message, "diff": diff}}
+    return asyncio.run(node.analyze_changes(state))["analysis"]
+
+
+def test_hunk_notes_are_reused_by_later_commits(tmp_path, monkeypatch):
+    monkeypatch.setattr(code_change_analyzer, "stream_writer", lambda: lambda chunk: None)
+    backend = RecordingBackend()
+    node = CodeChangeAnalyzerNode(ResultStore(str(tmp_path / "results.db")), LLMClient(backend))
+    login = ["-    check(password)", "+    check_password(user, password)"]
+    cache = ["-TTL = 60", "+TTL = 300"]
+
+    # A small diff is reported on in one prompt; its hunk notes are generated alongside
+    analyze(node, "Fix login", file_diff("auth.py", login, cache))
+    notes_prompts = [p for p in backend.prompts if "### Piece" in p]
+    assert len(backend.prompts) == 2 and len(notes_prompts) == 1
+    assert "### Piece 2: auth.py" in notes_prompts[0]
+
+    # The same login hunk in another commit (next to a new one) is not analyzed again
+    backend.prompts.clear()
+    retry = ["-    retries = 1", "+    retries = 3"]
+    analyze(node, "Cherry-pick the login fix", file_diff("auth.py", login, retry))
+    notes_prompt, reduce_prompt = backend.prompts
+    assert "### Piece 1: auth.py" in notes_prompt and "### Piece 2" not in notes_prompt
+    assert "check_password" not in notes_prompt and "retries = 3" in notes_prompt
+    assert "fake notes for hunk 1 of auth.py" in reduce_prompt.partition("The per-hunk notes, by file, are:")[2]
+
+    # Once every hunk has notes only the report is written
+    backend.prompts.clear()
+    analyze(node, "Squash of both", file_diff("auth.py", login, cache, retry))
+    assert len(backend.prompts) == 1 and "A commit was analyzed hunk by hunk" in backend.prompts[0]
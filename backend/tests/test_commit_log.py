@@ -0,0 +1,95 @@
+import os
+
+import git as gitpython
+import pytest
+
+from commit_log import CommitLogCache
+from conftest import git
+
+
+@pytest.fixture
+def branchy_repo(make_repo):
+    """History with merges, two authors and two files, with distinct commit dates"""
+    path = make_repo(0)
+    stamp = 1_700_000_000
+
+    def commit(name: str, author: str, message: str):
+        nonlocal stamp
+        stamp += 60
+        with open(os.path.join(path, name), "a") as f:
+            f.write(f"{message}\n")
+        git(path, "add", "-A")
+        env = {**os.environ, "GIT_AUTHOR_DATE": f"{stamp} +0000", "GIT_COMMITTER_DATE": f"{stamp} +0000",
+               "GIT_AUTHOR_NAME": author, "GIT_AUTHOR_EMAIL": f"{author.lower()}@example.com"}
+        gitpython.Repo(path).git.commit("-qm", message, env=env)
+
+    for i in range(30):
+        commit("a.txt" if i % 3 else "b.txt", "Ada" if i % 2 else "Bob", f"main {i}")
+        if i % 10 == 5:
+            git(path, "checkout", "-q", "-b", f"topic{i}")
+            for j in range(3):
+                commit("b.txt", "Bob", f"topic {i}.{j}")
+            git(path, "checkout", "-q", "main")
+            commit("a.txt", "Ada", f"main {i} before merge")
+            stamp += 60
+            gitpython.Repo(path).git.merge("-q", "--no-ff", "-m", f"merge {i}", f"topic{i}",
+                                           env={**os.environ, "GIT_COMMITTER_DATE": f"{stamp} +0000",
+                                                "GIT_AUTHOR_DATE": f"{stamp} +0000"})
+    return gitpython.Repo(path)
+
+
+def page_through(log: CommitLogCache, repo, size: int, **filters) -> list[str]:
+    hashes, after = [], None
+    while True:
+        page = log.page(repo, 0, size, after=after, **filters)
+        if not page:
+            return hashes
+        hashes += [commit["hash"] for commit in page]
+        after = page[-1]["hash"]
+
+
+@pytest.mark.parametrize("filters, git_args", [
+    ({}, []),
+    ({"path": "b.txt"}, ["--", "b.txt"]),
+    ({"author": "Ada"}, ["--author=Ada"]),
+    ({"author": "bob@", "path": "b.txt"}, ["--author=bob@", "--", "b.txt"]),
+])
+def test_pages_match_a_single_git_log(branchy_repo, filters, git_args):
+    expected = branchy_repo.git.log("--format=%H", *git_args).split()
+    assert page_through(CommitLogCache(), branchy_repo, 7, **filters) == expected
+
+
+def test_resumes_without_skip(branchy_repo, monkeypatch):
+    log = CommitLogCache()
+    monkeypatch.setattr("commit_log.LOG_BATCH_SIZE", 5)
+    calls = []
+    execute = gitpython.cmd.Git.execute
+    monkeypatch.setattr(gitpython.cmd.Git, "execute", lambda self, command, **kwargs: calls.append(command) or execute(self, command, **kwargs))
+
+    page_through(log, branchy_repo, 5)
+    logs = [command for command in calls if "log" in command]
+    assert len(logs) > 5
+    assert not any(str(arg).startswith("--skip") for command in logs for arg in command)
+
+
+@pytest.mark.parametrize("after", ["0" * 40, "not-a-ref"])
+def test_unknown_cursor_is_rejected(branchy_repo, after):
+    with pytest.raises(ValueError):
+        CommitLogCache().page(branchy_repo, 0, 10, after=after)
+
+
+def test_cursor_off_the_branch_is_rejected(branchy_repo):
+    path = branchy_repo.working_tree_dir
+    git(path, "checkout", "-q", "-b", "elsewhere")
+    git(path, "commit", "-q", "--allow-empty", "-m", "not on main")
+    off_branch = git(path, "rev-parse", "HEAD")
+    git(path, "checkout", "-q", "main")
+
+    with pytest.raises(ValueError):
+        CommitLogCache().page(branchy_repo, 0, 10, after=off_branch, branch="main")
+
+
+def test_cursor_outside_the_filter_is_rejected(branchy_repo):
+    bob_commit = branchy_repo.git.log("-1", "--format=%H", "--author=Bob")
+    with pytest.raises(ValueError):
+        CommitLogCache().page(branchy_repo, 0, 10, after=bob_commit, author="Ada")
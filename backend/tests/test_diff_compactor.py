@@ -0,0 +1,32 @@
+import time
+
+from diff_compactor import compact_diff
+
+
+def file_diff(path: str, *hunks: list[str]) -> str:
+    return f"diff --git a/{path} b/{path}\n" + "".join("@@ -1,1 +1,1 @@\n" + "".join(line + "\n" for line in hunk) for hunk in hunks)
+
+
+def test_block_moved_next_to_other_edits():
+    body = ["def helper():", "    value = load()", "    return value * 2"]
+    diff = (file_diff("old.py", [" import os", *("-" + line for line in body), " x = 1"])
+            + file_diff("new.py", ["+import sys", "+", *("+" + line for line in body), "+print(helper())"]))
+    files, _, stats = compact_diff(diff, 10 ** 9)
+
+    assert stats.moved_lines == 3
+    assert "... [3 lines moved to new.py]" in files[0].text
+    assert "... [3 lines moved here from old.py]" in files[1].text
+    assert "+import sys" in files[1].text and "load()" not in files[1].text
+
+
+def test_runs_sharing_their_first_line_are_not_compared_pairwise():
+    # Every removed and added run starts with the same line, which made the lookup quadratic
+    removed = [line for i in range(1500) for line in ("-}", f"-    old_{i}()", f"-    more_{i}()", "-}", " ctx")]
+    added = [line for i in range(1500) for line in ("+}", f"+    new_{i}()", f"+    other_{i}()", "+}", " ctx")]
+    moved = ["-    shared()", "-    twice()", "-    thrice()"]
+    diff = file_diff("a.py", removed, moved) + file_diff("b.py", added, [m.replace("-", "+", 1) for m in moved])
+
+    start = time.perf_counter()
+    _, _, stats = compact_diff(diff, 10 ** 9)
+    assert time.perf_counter() - start < 3
+    assert stats.moved_lines == 3
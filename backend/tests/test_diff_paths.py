@@ -0,0 +1,44 @@
+import os
+
+from conftest import git
+from diff_chunker import diff_header_path, parse_diff
+from diff_reader import read_commit_diff, read_file_history
+import git as gitpython
+
+
+def commit_files(path: str, files: dict[str, str], message: str):
+    for name, content in files.items():
+        os.makedirs(os.path.dirname(os.path.join(path, name)), exist_ok=True)
+        with open(os.path.join(path, name), "w") as f:
+            f.write(content)
+    git(path, "add", "-A")
+    git(path, "commit", "-qm", message)
+
+
+def test_header_path_handles_spaces_quotes_and_b_slash():
+    assert diff_header_path("diff --git a/src/app.py b/src/app.py\n") == "src/app.py"
+    assert diff_header_path("diff --git a/my file.txt b/my file.txt\n") == "my file.txt"
+    assert diff_header_path("diff --git a/x b/y.txt b/x b/y.txt\n") == "x b/y.txt"
+    assert diff_header_path('diff --git "a/caf\\303\\251.txt" "b/caf\\303\\251.txt"\n') == "café.txt"
+    assert diff_header_path('diff --git "a/tab\\there" "b/tab\\there"\n') == "tab\there"
+
+
+def test_parse_diff_takes_renamed_paths_from_the_extended_header():
+    diff = ("diff --git a/old b/dir b/new\nsimilarity index 90%\nrename from old\nrename to dir b/new\n"
+            "--- a/old\n+++ b/dir b/new\n@@ -1 +1 @@\n-a\n+b\n")
+    assert [f.path for f in parse_diff(diff)] == ["dir b/new"]
+
+
+def test_paths_match_numstat_for_unusual_names(make_repo):
+    path = make_repo(1)
+    names = ["with space.txt", "x b/y.txt", "café.txt", 'quote".txt']
+    commit_files(path, {name: "hello\n" for name in names}, "unusual names")
+    repo = gitpython.Repo(path)
+    head = repo.head.commit
+
+    diff = read_commit_diff(repo, head.parents[0].hexsha, head.hexsha)
+    assert sorted(f.path for f in parse_diff(diff.patch)) == sorted(diff.files) == sorted(names)
+
+    history = read_file_history(repo, "café.txt")
+    assert [commit["path"] for commit in history] == ["café.txt"]
+    assert history[0]["additions"] == 1
@@ -0,0 +1,84 @@
+import asyncio
+
+from agents import StoreResultsNode
+from embedder import Embedder
+from llm import FakeBackend, LLMClient
+from result_cache import ResultCache
+from result_store import ResultStore
+
+REPO_URL = "https://example.com/repo.git"
+
+# Words meaning the same thing share a dimension, like they would share a direction in a real embedding
+CONCEPTS = [{"auth", "login", "session", "sign"}, {"cache", "eviction"}, {"parser", "tokenizer"}]
+
+
+class ConceptBackend(FakeBackend):
+    """Embeds texts by which of CONCEPTS they mention, and records the batches it is sent"""
+
+    def __init__(self):
+        super().__init__(latency_ms=0)
+        self.batches: list[list[str]] = []
+
+    def vector(self, model: str, text: str) -> list[float]:
+        words = set(text.lower().replace("/", " ").split())
+        return [float(bool(words & concept)) for concept in CONCEPTS]
+
+    async def embed(self, model: str, texts: list[str]) -> list[list[float]]:
+        self.batches.append(texts)
+        return await super().embed(model, texts)
+
+
+def metadata(commit_hash: str, message: str) -> dict:
+    return {"hash": commit_hash, "author": "a", "date": "2024-01-01T00:00:00+00:00", "message": message,
+            "diff": "", "files_changed": ["app.py"]}
+
+
+def store_result(node: StoreResultsNode, commit_hash: str, message: str, analysis: str):
+    asyncio.run(node.store_results({
+        "repo_url": REPO_URL, "commit_hash": commit_hash, "commit_metadata": metadata(commit_hash, message),
+        "analysis": analysis, "fix_suggestion": "None needed",
+    }))
+
+
+def search(store: ResultStore, embedder: Embedder, query: str) -> list[str]:
+    vector = asyncio.run(embedder.embed_query(query))
+    return [r["hash"] for r in store.search(query, REPO_URL, 10, vector, embedder.stored_model)]
+
+
+def test_query_finds_analyses_by_meaning(tmp_path):
+    store = ResultStore(str(tmp_path / "results.db"))
+    backend = ConceptBackend()
+    embedder = Embedder(store, LLMClient(backend))
+    node = StoreResultsNode(ResultCache(store), "m", "1", embedder)
+    store_result(node, "a" * 40, "Rework login/session handling", "Moves the session cookie into the login handler")
+    store_result(node, "b" * 40, "Tune the cache", "Raises the eviction threshold")
+
+    # No keyword of the query occurs in the first commit
+    assert store.search("auth flow", REPO_URL) == []
+    assert search(store, embedder, "auth flow") == ["a" * 40]
+    # Keyword and embedding rankings are blended
+    assert search(store, embedder, "cache eviction")[0] == "b" * 40
+    # Each stored result was embedded once, and each query in one call of its own
+    assert [len(batch) for batch in backend.batches] == [1, 1, 1, 1]
+
+
+def test_pending_documents_are_embedded_in_one_batch(tmp_path):
+    store = ResultStore(str(tmp_path / "results.db"))
+    store.save_analyses([
+        {"repo_url": REPO_URL, "model": "m", "prompt_version": "1", "commit_metadata": metadata(h * 40, f"change {h}"),
+         "analysis": "Refactors the parser", "fix_suggestion": None}
+        for h in "abc"
+    ])
+    backend = ConceptBackend()
+    embedder = Embedder(store, LLMClient(backend))
+
+    assert asyncio.run(embedder.index_pending()) == 3
+    assert asyncio.run(embedder.index_pending()) == 0
+    assert [len(batch) for batch in backend.batches] == [3]
+
+    # A re-analyzed commit gets a new vector, evicted ones lose theirs
+    store.save_analyses([{"repo_url": REPO_URL, "model": "m", "prompt_version": "2",
+                          "commit_metadata": metadata("a" * 40, "change a"), "analysis": "Speeds up login", "fix_suggestion": None}])
+    assert asyncio.run(embedder.index_pending()) == 1
+    store.evict_analyses(created_before=0, max_entries=0)
+    assert store._reader().execute("SELECT COUNT(*) FROM search_vectors").fetchone()[0] == 0
@@ -0,0 +1,75 @@
+import asyncio
+import os
+
+import git as gitpython
+
+from conftest import git
+from diff_reader import read_file_history
+from file_history import FileHistoryAnalyzer
+from llm import FakeBackend, LLMClient
+from result_store import ResultStore
+
+
+class RecordingBackend(FakeBackend):
+    """Keeps the evolution report prompts it was sent"""
+
+    def __init__(self):
+        super().__init__(latency_ms=0)
+        self.reports: list[str] = []
+
+    def respond(self, model: str, prompt: str) -> str:
+        if "evolution report" in prompt:
+            self.reports.append(prompt)
+        return super().respond(model, prompt)
+
+
+def add_commits(path: str, count: int):
+    for i in range(count):
+        with open(os.path.join(path, "file.txt"), "a") as f:
+            f.write(f"later line {i}\n")
+        git(path, "commit", "-qam", f"later commit {i}")
+
+
+def analyze(analyzer: FileHistoryAnalyzer, path: str, max_commits: int) -> tuple[list[dict], dict]:
+    commits = read_file_history(gitpython.Repo(path), "file.txt", max_commits=max_commits)
+
+    async def run() -> dict:
+        async for event, payload in analyzer.events(commits, "file.txt", partial=len(commits) == max_commits):
+            if event == "report":
+                return payload
+
+    return commits, asyncio.run(run())
+
+
+def test_report_is_extended_when_the_window_moves(make_repo, tmp_path):
+    repo = make_repo(commits=8)
+    backend = RecordingBackend()
+    analyzer = FileHistoryAnalyzer(ResultStore(str(tmp_path / "results.db")), LLMClient(backend))
+    analyze(analyzer, repo, max_commits=5)
+    assert len(backend.reports) == 1
+
+    # Two new commits push the two oldest out of the window; only the new ones are added to the stored report
+    add_commits(repo, 2)
+    commits, summary = analyze(analyzer, repo, max_commits=5)
+    assert len(backend.reports) == 2
+    report, _, entries = backend.reports[-1].partition("The newer commits, oldest first, are:")
+    assert f"up to commit {commits[-3]['hash'][:8]}" in report
+    assert all(commit["hash"][:8] in entries for commit in commits[-2:])
+    assert not any(commit["hash"][:8] in entries for commit in commits[:-2])
+    assert not summary["reused_report"]
+
+    _, summary = analyze(analyzer, repo, max_commits=5)
+    assert len(backend.reports) == 2
+    assert summary["reused_report"]
+
+
+def test_report_of_a_shorter_window_is_not_reused_for_a_longer_one(make_repo, tmp_path):
+    repo = make_repo(commits=8)
+    backend = RecordingBackend()
+    analyzer = FileHistoryAnalyzer(ResultStore(str(tmp_path / "results.db")), LLMClient(backend))
+    analyze(analyzer, repo, max_commits=5)
+
+    # The stored report starts at the 4th commit, so it lacks the first three
+    analyze(analyzer, repo, max_commits=20)
+    assert len(backend.reports) == 2
+    assert "Newer commits changed the file since" not in backend.reports[-1]
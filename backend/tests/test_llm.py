@@ -0,0 +1,122 @@
+import asyncio
+from types import SimpleNamespace
+
+import llm
+from diff_chunker import estimate_tokens
+from llm import FakeBackend, LLMClient, LLMError
+from telemetry import LLM_RETRIES, LLM_TOKENS
+
+
+class FlakyBackend(FakeBackend):
+    """Fails the first `failures` calls with the given status code"""
+
+    def __init__(self, failures: int, code: int):
+        super().__init__()
+        self.failures = failures
+        self.code = code
+
+    async def generate(self, model: str, prompt: str, usage=None) -> str:
+        if self.failures:
+            self.failures -= 1
+            self.calls += 1
+            raise LLMError("flaky", self.code)
+        return await super().generate(model, prompt, usage)
+
+
+class MeteredBackend(FakeBackend):
+    """Reports token counts like Gemini does: on the response, or on the last chunk of a stream"""
+
+    async def generate(self, model: str, prompt: str, usage=None) -> str:
+        usage.record(SimpleNamespace(prompt_token_count=1000, candidates_token_count=7))
+        return await super().generate(model, prompt, usage)
+
+    async def stream(self, model: str, prompt: str, usage=None):
+        async for piece in super().stream(model, prompt, usage):
+            yield piece
+        usage.record(SimpleNamespace(prompt_token_count=2000, candidates_token_count=None))
+
+
+def retries(model: str) -> float:
+    return LLM_RETRIES._values.get((model,), 0)
+
+
+def tokens(model: str, direction: str, counted: str) -> float:
+    return LLM_TOKENS._values.get((model, direction, counted), 0)
+
+
+def test_retries_a_rate_limited_call(monkeypatch):
+    async def no_sleep(delay):
+        pass
+    monkeypatch.setattr(llm.asyncio, "sleep", no_sleep)
+    backend = FlakyBackend(failures=1, code=429)
+    before = retries("retry-model")
+
+    text = asyncio.run(LLMClient(backend).generate("prompt", "retry-model"))
+
+    assert text == FakeBackend().respond("retry-model", "prompt")
+    assert backend.calls == 2
+    assert retries("retry-model") == before + 1
+
+
+def test_does_not_retry_client_errors():
+    backend = FlakyBackend(failures=1, code=400)
+
+    try:
+        asyncio.run(LLMClient(backend).generate("prompt", "client-error-model"))
+    except LLMError as e:
+        assert e.code == 400
+    else:
+        raise AssertionError("expected an LLMError")
+    assert backend.calls == 1
+    assert retries("client-error-model") == 0
+
+
+def test_coalesced_callers_outlive_a_cancelled_first_caller():
+    backend = FakeBackend(latency_ms=50)
+    client = LLMClient(backend)
+    streamed: dict[str, list[str]] = {"first": [], "second": []}
+
+    async def run():
+        first = asyncio.create_task(client.generate("prompt", "coalesce-model", streamed["first"].append))
+        await asyncio.sleep(0.01)
+        second = asyncio.create_task(client.generate("prompt", "coalesce-model", streamed["second"].append))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        return await second
+
+    text = asyncio.run(run())
+    assert text == backend.respond("coalesce-model", "prompt")
+    assert backend.calls == 1
+    # The second caller took over the stream: what was sent so far, then the rest, all exactly once
+    assert "".join(streamed["second"]) == text
+
+
+def test_call_is_cancelled_once_nobody_waits_for_it():
+    backend = FakeBackend(latency_ms=1000)
+    client = LLMClient(backend)
+
+    async def run():
+        callers = [asyncio.create_task(client.generate("prompt", "abandoned-model")) for _ in range(2)]
+        await asyncio.sleep(0.01)
+        for caller in callers:
+            caller.cancel()
+        await asyncio.gather(*callers, return_exceptions=True)
+        await asyncio.sleep(0)
+        return client._in_flight[asyncio.get_running_loop()]
+
+    assert asyncio.run(asyncio.wait_for(run(), 0.5)) == {}
+
+
+def test_token_counts_come_from_the_api_when_it_reports_them():
+    client = LLMClient(MeteredBackend(latency_ms=0))
+    asyncio.run(client.generate("prompt", "metered-model"))
+    assert tokens("metered-model", "in", "reported") == 1000
+    assert tokens("metered-model", "out", "reported") == 7
+
+    # The stream reported no output count, so that one is estimated
+    text = asyncio.run(client.generate("another prompt", "metered-model", lambda piece: None))
+    assert tokens("metered-model", "in", "reported") == 3000
+    assert tokens("metered-model", "out", "estimated") == estimate_tokens(text)
+
+    asyncio.run(LLMClient(FakeBackend(latency_ms=0)).generate("prompt", "unmetered-model"))
+    assert tokens("unmetered-model", "in", "estimated") == estimate_tokens("prompt")
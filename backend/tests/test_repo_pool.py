@@ -0,0 +1,141 @@
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import concurrency
+import function_utils
+import repo_pool
+from agents.commit_metadata_extractor import CommitMetadataExtractorNode
+from conftest import git
+from repo_pool import RepoLease, RepoPool
+
+
+def acquire(pool: RepoPool, url: str, commit_hash: str = None) -> RepoLease:
+    return asyncio.run(pool.lease(url, commit_hash))
+
+
+def test_lease_does_not_measure_the_pool(make_repo, tmp_path, monkeypatch):
+    url = f"file://{make_repo()}"
+    pool = RepoPool(str(tmp_path / "mirrors"), fetch_interval=3600)
+    acquire(pool, url).release()
+
+    walks = []
+    measure = repo_pool.directory_size
+    monkeypatch.setattr(repo_pool, "directory_size", lambda path: walks.append(path) or measure(path))
+    for _ in range(3):
+        acquire(pool, url).release()
+    assert walks == []
+
+
+def test_evicts_the_least_recently_used_idle_mirror(make_repo, tmp_path):
+    first, second = f"file://{make_repo(name='first')}", f"file://{make_repo(name='second')}"
+    pool = RepoPool(str(tmp_path / "mirrors"), budget_bytes=1, fetch_interval=3600)
+
+    acquire(pool, first).release()
+    lease = acquire(pool, second)
+    assert not os.path.exists(pool.mirror_path(first))
+    assert os.path.exists(pool.mirror_path(second))
+    assert pool.disk_usage() == pool._mirror(pool.mirror_path(second)).size
+
+    # A mirror in use is never evicted
+    acquire(pool, first).release()
+    assert os.path.exists(pool.mirror_path(second))
+    lease.release()
+
+
+def commits_in(pool: RepoPool, url: str) -> int:
+    with acquire(pool, url) as repo:
+        return int(repo.git.rev_list("--count", "--all"))
+
+
+def test_unknown_hash_does_not_deepen_a_shallow_mirror(make_repo, tmp_path):
+    url = f"file://{make_repo(40)}"
+    pool = RepoPool(str(tmp_path / "mirrors"), strategy="shallow", shallow_depth=5, fetch_interval=3600)
+
+    acquire(pool, url, "1234567890" * 4).release()
+    with acquire(pool, url) as repo:
+        assert repo_pool.is_shallow(repo)
+    assert commits_in(pool, url) == 5
+
+
+def test_deepening_is_bounded(make_repo, tmp_path):
+    url = f"file://{make_repo(40)}"
+    pool = RepoPool(str(tmp_path / "mirrors"), strategy="shallow", shallow_depth=5, fetch_interval=3600, max_depth=12)
+
+    # Abbreviated hashes can't be fetched by SHA, so the mirror is deepened, but only up to max_depth
+    acquire(pool, url, "deadbeef").release()
+    assert commits_in(pool, url) == 12
+
+
+def test_old_commit_is_fetched_into_a_shallow_mirror(make_repo, tmp_path):
+    path = make_repo(40)
+    old = git(path, "rev-parse", "HEAD~30")
+    url = f"file://{path}"
+    pool = RepoPool(str(tmp_path / "mirrors"), strategy="shallow", shallow_depth=5, fetch_interval=3600)
+
+    with acquire(pool, url, old) as repo:
+        assert repo_pool.has_commit(repo, old)
+
+
+def test_lock_waits_do_not_hold_git_workers(make_repo, tmp_path, monkeypatch):
+    slow, other = make_repo(name="slow"), make_repo(name="other")
+    slow_url, other_url = f"file://{slow}", f"file://{other}"
+    pool = RepoPool(str(tmp_path / "mirrors"), fetch_interval=3600)
+    acquire(pool, slow_url).release()
+    acquire(pool, other_url).release()
+    monkeypatch.setattr(concurrency, "_git_executor", ThreadPoolExecutor(max_workers=2))
+    # Held as if the slow repo were being re-cloned or deleted
+    slow_lock = pool._mirror(pool.mirror_path(slow_url)).lock
+    slow_lock.acquire_write()
+
+    async def run():
+        waiting = [asyncio.create_task(pool.lease(slow_url, git(slow, "rev-parse", "HEAD"))) for _ in range(3)]
+        await asyncio.sleep(0.2)
+        lease = await asyncio.wait_for(pool.lease(other_url, git(other, "rev-parse", "HEAD")), timeout=5)
+        lease.release()
+
+        waiting[0].cancel()
+        slow_lock.release_write()
+        for lease in await asyncio.gather(*waiting[1:]):
+            lease.release()
+        await asyncio.gather(waiting[0], return_exceptions=True)
+
+    asyncio.run(run())
+    # The cancelled wait handed its lock back
+    for _ in range(50):
+        if not pool.leases(slow_url):
+            break
+        time.sleep(0.01)
+    assert pool.leases(slow_url) == 0
+
+
+def test_diff_objects_are_fetched_through_the_pool(make_repo, tmp_path, monkeypatch):
+    path = make_repo(10)
+    url = f"file://{path}"
+    pool = RepoPool(str(tmp_path / "mirrors"), strategy="shallow", shallow_depth=3, fetch_interval=3600)
+    boundary = git(path, "rev-parse", "HEAD~2")
+    mirror = pool._mirror(pool.mirror_path(url))
+    deepened = []
+    deepen = function_utils.deepen_to_parent
+
+    def recording_deepen(repo, commit_hash):
+        deepened.append((threading.current_thread().name, mirror.fetch_lock.locked()))
+        deepen(repo, commit_hash)
+    monkeypatch.setattr(function_utils, "deepen_to_parent", recording_deepen)
+
+    async def extract() -> dict:
+        lease = await pool.lease(url)
+        try:
+            extractor = CommitMetadataExtractorNode(pool=pool)
+            state = {"repo_url": url, "commit_hash": boundary}
+            return await extractor.extract_metadata(state, {"configurable": {"repo": lease.repo}})
+        finally:
+            lease.release()
+
+    metadata = asyncio.run(extract())["commit_metadata"]
+    # Deepened on a fetch thread, never alongside another fetch into the mirror
+    assert len(deepened) == 1 and deepened[0][0].startswith("ctm-fetch") and deepened[0][1]
+    # Diffed against its parent rather than the empty tree
+    assert (metadata["file_stats"]["file.txt"]["additions"], metadata["file_stats"]["file.txt"]["deletions"]) == (1, 0)
@@ -0,0 +1,128 @@
+import sqlite3
+
+import result_store
+from result_store import ResultStore
+
+
+def record(commit_hash, date="2024-01-01T00:00:00+00:00", analysis="Refactors the parser", message=None):
+    return {
+        "repo_url": "https://example.com/repo.git", "model": "m", "prompt_version": "1",
+        "commit_metadata": {"hash": commit_hash, "author": "a", "date": date, "message": message or f"change {commit_hash}",
+                            "diff": "", "files_changed": ["parser.py"]},
+        "analysis": analysis, "fix_suggestion": None,
+    }
+
+
+def test_dates_sort_across_time_zones(tmp_path):
+    store = ResultStore(str(tmp_path / "results.db"))
+    # As text, the first date sorts after the second, though it is two hours earlier
+    store.save_analyses([record("a" * 40, "2024-01-01T10:00:00+05:00"), record("b" * 40, "2024-01-01T07:00:00+00:00")])
+    rows = store._reader().execute("SELECT hash FROM commits ORDER BY authored_at").fetchall()
+    assert [h for h, in rows] == ["a" * 40, "b" * 40]
+
+
+def test_older_database_is_migrated(tmp_path):
+    path = str(tmp_path / "results.db")
+    ResultStore(path).save_analyses([record("a" * 40, "2024-01-01T10:00:00+05:00")])
+    conn = sqlite3.connect(path)
+    conn.executescript("""
+        DROP INDEX idx_commits_repo_authored_at;
+        DROP INDEX idx_commits_repo_author;
+        ALTER TABLE commits DROP COLUMN authored_at;
+        CREATE INDEX idx_commits_repo_date ON commits (repo_id, date);
+        ALTER TABLE search_docs ADD COLUMN vector BLOB;
+        PRAGMA user_version = 1;
+    """)
+    conn.close()
+
+    store = ResultStore(path)
+    assert store._reader().execute("SELECT authored_at FROM commits").fetchone()[0] == 1704085200
+    indexes = {name for name, in store._reader().execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+    assert "idx_commits_repo_date" not in indexes
+    assert {"idx_commits_repo_authored_at", "idx_commits_repo_author", "idx_commit_files_path"} <= indexes
+    assert "vector" not in {row[1] for row in store._reader().execute("PRAGMA table_info(search_docs)")}
+    assert [r["hash"] for r in store.search("parser")] == ["a" * 40]
+
+
+def test_cache_hits_are_written_in_batches(tmp_path, monkeypatch):
+    store = ResultStore(str(tmp_path / "results.db"))
+    store.save_analyses([record("a" * 40)])
+    transactions = []
+    transaction = store.transaction
+    monkeypatch.setattr(store, "transaction", lambda: transactions.append(1) or transaction())
+
+    for _ in range(100):
+        store.touch_analysis("https://example.com/repo.git", "a" * 40, "m", "1")
+    assert transactions == []
+
+    monkeypatch.setattr(result_store, "TOUCH_FLUSH_SECONDS", 0)
+    store.touch_analysis("https://example.com/repo.git", "a" * 40, "m", "1")
+    assert len(transactions) == 1
+
+
+def test_evicted_analyses_leave_the_search_index(tmp_path):
+    store = ResultStore(str(tmp_path / "results.db"))
+    store.save_analyses([record("a" * 40, analysis="Refactors the tokenizer"), record("b" * 40)])
+    assert [r["hash"] for r in store.search("tokenizer")] == ["a" * 40]
+
+    store.evict_analyses(created_before=0, max_entries=0)
+    assert store.search("tokenizer") == []
+    assert store._reader().execute("SELECT COUNT(*) FROM search_fts").fetchone()[0] == 0
+
+
+def test_search_ranks_message_matches_first(tmp_path):
+    store = ResultStore(str(tmp_path / "results.db"))
+    store.save_analyses([record("a" * 40, analysis="Touches the cache as well"), record("b" * 40, message="Rework the cache")])
+
+    results = store.search("cache", repo_url="https://example.com/repo.git")
+    assert [r["hash"] for r in results] == ["b" * 40, "a" * 40]
+    assert store.search("cache", repo_url="https://example.com/other.git") == []
+
+
+def test_commit_lookups_use_indexes(tmp_path):
+    store = ResultStore(str(tmp_path / "results.db"))
+    plans = {
+        "author": "SELECT hash FROM commits WHERE repo_id = 1 AND author = 'a' ORDER BY authored_at DESC",
+        "date": "SELECT hash FROM commits WHERE repo_id = 1 AND authored_at > 0 ORDER BY authored_at",
+        "file": "SELECT hash FROM commit_files WHERE path = 'parser.py' AND repo_id = 1",
+    }
+    for name, query in plans.items():
+        plan = " ".join(row[-1] for row in store._reader().execute(f"EXPLAIN QUERY PLAN {query}"))
+        assert "USING" in plan and "TEMP B-TREE" not in plan, (name, plan)
+
+
+def test_range_analyses_stay_out_of_commits_and_search(tmp_path):
+    store = ResultStore(str(tmp_path / "results.db"))
+    key = f"{'a' * 40}..{'b' * 40}"
+    ranged = record(key, message="Range of 3 commits", analysis="Refactors the parser across the range")
+    ranged["commit_metadata"]["commits"] = [{"hash": "b" * 40}]
+    store.save_analyses([ranged])
+
+    for table in ("commits", "commit_files", "analyses", "search_docs"):
+        assert store._reader().execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0] == 0, table
+    assert store.search("parser") == []
+    stored = store.get_analysis("https://example.com/repo.git", key, "m", "1")
+    assert stored["analysis"] == "Refactors the parser across the range"
+    assert "commits" not in stored["commit_metadata"] and stored["commit_metadata"]["files_changed"] == ["parser.py"]
+
+    assert store.evict_analyses(created_before=0, max_entries=0) == 1
+    assert store.count_analyses() == 0
+
+
+def test_ranges_stored_as_commits_are_moved_out(tmp_path):
+    path = str(tmp_path / "results.db")
+    key = f"{'a' * 40}..{'b' * 40}"
+    store = ResultStore(path)
+    store.save_analyses([record("c" * 40)])
+    # How version 5 stored a range: as a commit with files, an analysis and a search document
+    with store.transaction() as conn:
+        repo_id = store.save_commit(conn, "https://example.com/repo.git", record(key)["commit_metadata"])
+        conn.execute("INSERT INTO analyses VALUES (?, ?, 'm', '1', 'Range report', NULL, 1, 1)", (repo_id, key))
+        store._index_commit(conn, repo_id, {"hash": key, "message": "range"}, "Range report", 1)
+    store._writer.execute("PRAGMA user_version = 5")
+
+    store = ResultStore(path)
+    assert [h for h, in store._reader().execute("SELECT hash FROM commits")] == ["c" * 40]
+    assert [h for h, in store._reader().execute("SELECT hash FROM search_docs")] == ["c" * 40]
+    assert store._reader().execute("SELECT COUNT(*) FROM commit_files WHERE hash = ?", (key,)).fetchone()[0] == 0
+    assert store.get_analysis("https://example.com/repo.git", key, "m", "1")["analysis"] == "Range report"
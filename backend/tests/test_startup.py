@@ -0,0 +1,29 @@
+from benchmarks.startup import MAX_IMPORT_SECONDS, MAX_REQUEST_MS, run_child
+
+
+def best_of_runs(work_dir: str, stage: str, budget: float, runs: int = 3) -> float:
+    """Seconds a stage took in the best of up to `runs` fresh interpreters, stopping at the first within budget
+
+    A fresh interpreter per run, as an autoscaled instance starts; the best of a few runs absorbs a noisy machine.
+    """
+    best = None
+    for _ in range(runs):
+        measured, _ = run_child(work_dir)
+        best = measured[stage] if best is None else min(best, measured[stage])
+        if best <= budget:
+            break
+    return best
+
+
+def test_import_stays_within_the_startup_budget(tmp_path):
+    assert best_of_runs(str(tmp_path), "import", MAX_IMPORT_SECONDS) <= MAX_IMPORT_SECONDS
+
+
+def test_cached_request_stays_within_the_request_budget(tmp_path):
+    # Median overhead of /analyze-commit answered from results.db, without git or the LLM
+    assert best_of_runs(str(tmp_path), "request_cached_analysis", MAX_REQUEST_MS / 1000) * 1000 <= MAX_REQUEST_MS
+
+
+def test_import_does_not_load_langgraph_or_genai(tmp_path):
+    measured, _ = run_child(str(tmp_path))
+    assert measured["heavy_modules_at_import"] == []
@@ -3,24 +3,32 @@ import ReactMarkdown from 'react-markdown';
 import './App.css';
 
 const API_BASE = 'http://localhost:8000';
+const COMMIT_PAGE_SIZE = 10;
 
 function App() {
   const [repoUrl, setRepoUrl] = useState('');
   const [commitHash, setCommitHash] = useState('');
   const [commitHistory, setCommitHistory] = useState([]);
+  const [hasMoreCommits, setHasMoreCommits] = useState(false);
   const [analysisResult, setAnalysisResult] = useState(null);
   const [loading, setLoading] = useState(false);
   const [error, setError] = useState('');
 
   const handleNewAnalysis = async () => {
+    const previousRepoUrl = repoUrl;
     setRepoUrl('');
     setCommitHash('');
     setCommitHistory([]);
+    setHasMoreCommits(false);
     setAnalysisResult(null);
     setError('');
     setLoading(true);
     try {
-      await fetch(`${API_BASE}/rm-repo`, { method: 'POST' });
+      await fetch(`${API_BASE}/rm-repo`, {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({ repo_url: previousRepoUrl || null })
+      });
     } catch (e) {
       // Ignore errors for repo deletion
       setError(e.message);
@@ -28,14 +36,33 @@ function App() {
     setLoading(false);
   };
 
+  const fetchCommitPage = async (after) => {
+    const params = new URLSearchParams({ repo_url: repoUrl, count: COMMIT_PAGE_SIZE });
+    if (after) params.set('after', after);
+    const res = await fetch(`${API_BASE}/commits?${params}`);
+    if (!res.ok) throw new Error('Failed to fetch commit history');
+    const data = await res.json();
+    setHasMoreCommits(data.length === COMMIT_PAGE_SIZE);
+    return data;
+  };
+
   const handleCommitHistory = async () => {
     setLoading(true);
     setError('');
     try {
-      const res = await fetch(`${API_BASE}/commits?repo_url=${repoUrl}&count=10`);
-      if (!res.ok) throw new Error('Failed to fetch commit history');
-      const data = await res.json();
-      setCommitHistory(data);
+      setCommitHistory(await fetchCommitPage());
+    } catch (e) {
+      setError(e.message);
+    }
+    setLoading(false);
+  };
+
+  const handleLoadMoreCommits = async () => {
+    setLoading(true);
+    setError('');
+    try {
+      const page = await fetchCommitPage(commitHistory[commitHistory.length - 1].hash);
+      setCommitHistory(prev => [...prev, ...page]);
     } catch (e) {
       setError(e.message);
     }
@@ -47,21 +74,47 @@ function App() {
     setError('');
     setAnalysisResult(null);
     try {
-      const res = await fetch(`${API_BASE}/analyze-commit`, {
+      const res = await fetch(`${API_BASE}/analyze-commit/stream`, {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
         body: JSON.stringify({ repo_url: repoUrl, commit_hash: commitHash || null })
       });
       if (!res.ok) throw new Error('Failed to analyze commit');
-      const data = await res.json();
-      setAnalysisResult(data);
-      console.log(data);
+
+      // The response is NDJSON: metadata first, then analysis/fix suggestion
+      // tokens as they are generated, then the complete result
+      const reader = res.body.getReader();
+      const decoder = new TextDecoder();
+      let buffer = '';
+      while (true) {
+        const { done, value } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+        const lines = buffer.split('\n');
+        buffer = lines.pop();
+        for (const line of lines) {
+          if (line.trim()) handleAnalysisEvent(JSON.parse(line));
+        }
+      }
     } catch (e) {
       setError(e.message);
     }
     setLoading(false);
   };
 
+  const handleAnalysisEvent = ({ event, data }) => {
+    if (event === 'metadata') {
+      setAnalysisResult({ commit_metadata: data, analysis: '', fix_suggestion: '' });
+    } else if (event === 'delta') {
+      setAnalysisResult(prev => ({ ...prev, [data.field]: (prev?.[data.field] || '') + data.text }));
+    } else if (event === 'result') {
+      setAnalysisResult(data);
+      console.log(data);
+    } else if (event === 'error') {
+      throw new Error(data.detail || 'Failed to analyze commit');
+    }
+  };
+
   const formatCommitHash = (hash) => {
     return hash.substring(0, 8);
   };
@@ -170,6 +223,13 @@ function App() {
                 </tbody>
               </table>
             </div>
+            {hasMoreCommits && (
+              <div className="ctm-btn-row">
+                <button className="ctm-btn" onClick={handleLoadMoreCommits} disabled={loading}>
+                  Load More
+                </button>
+              </div>
+            )}
           </section>
         )}
         